@@ -5,26 +5,81 @@ import os
 import os.path
 import glob
 import re
-import errno
 import subprocess
 import shutil
 import inspect
+import signal
+import asyncio
+import threading
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import time
+import datetime
+import xml.etree.ElementTree as ElementTree
+import tarfile
+import contextlib
+import select
+import socket
+import http.server
+import traceback
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    #not available on windows, child cpu/memory use just isn't traced there
+    resource=None
+
+#the parts of the build split out into modules next to this script, see build_core.py
+import build_core
+from build_core import (os_path, unix_path, is_windows, BuildError, task_output, current_task, Console, log, error,
+    write_out, output_sink, prompt, live_output, run_concurrently, ensure_dir_exists, file_stamp, hash_file, link_or_copy)
+from build_nuget import nuspec_files, NupkgWriter, extract_nupkg, LocalRepo
+from build_feed import NugetFeed, FeedRequestHandler
+from build_cache import fetch_outputs, store_outputs, DirOutputCache, HttpOutputCache, CacheRequestHandler
+from build_testing import (TestRun, read_test_results, source_fixtures, fixture_durations, pack_shards, merge_test_results,
+    merge_coverage)
+from build_perf import perf_stats, print_perf_stats, perf_regressions, open_perf_store
+from build_log import zstd, TaskLog, LogReader, ProcessOutput
+from build_files import FileIndex, InotifyWatcher, PollWatcher
 
 #---- some methods required at the very start ----
 
-def os_path(path):
-    if is_windows():     
-        return path.replace('/','\\')
-    else:
-        return path.replace('\\','/')
+def requires(*taskNames):
+    """Decorator declaring the tasks which must complete before this task is run
+
+    Usage:
+        @requires('init','build')
+        def task_foo():
+            ...
+
+    A task name can instead be a function, called when the tasks are planned (after the command line variables
+    are set), returning the names of the tasks required, as in skipping the build when there is nothing to run
+    """
+    def decorate(f):
+        f.requires=taskNames
+        return f
+    return decorate
 
 
-def unix_path(path):
-    return path.replace('\\','/')
+def per_project(projects,summary=None,after=None):
+    """Decorator marking a task as run once per project, as the task '<task>:<project>'
 
+    'projects' is called when the tasks are planned (after the command line variables are set) and
+    returns the project names to run for. The task function is passed the project name. Running the
+    plain '<task>' runs it for all the projects, each one able to run concurrently.
 
-def is_windows():
-    return os.name == 'nt'
+    The optional 'summary' is called with the project names once they have all been run.
+    The optional 'after' is called with a project name and returns the projects the task must be run for
+    first, as in building the projects a project references
+    """
+    def decorate(f):
+        f.projects=projects
+        f.summary=summary
+        f.after=after
+        return f
+    return decorate
 
 
 #---- build variables. User can override by passing in varname=varval on the commandline
@@ -41,6 +96,9 @@ PROJECT=None
 TESTS=None
 TEST_SKIP=False
 
+#number of tasks to run concurrently. Also set via -j<N>, or -j to use all the cpus
+JOBS=1
+
 VERBOSITY='minimal'
 #VERBOSITY=quiet,  minimal,  normal, detailed, diagnostic
 CONFIG='Release'
@@ -67,25 +125,186 @@ NUGET_CONFIG=os_path(SOLUTION_DIR + '/.nuget/NuGet.Config')
 
 USER_HOME=os.path.expanduser("~")
 LOCAL_REPO=os_path(USER_HOME + '/workspace/local-nuget-repo/')
+#versions of each package kept in LOCAL_REPO, older ones are pruned. 0 to keep them all
+LOCAL_REPO_KEEP=5
 BUILD_ASSEMBLY=os_path(SOLUTION_DIR + '/BuildVersionAssemblyInfo.cs')
 
+#find the build tools again rather than using those found by a previous init
+TOOLCHAIN_REFRESH=False
+#where the build keeps what it knows about previous runs, fingerprints etc
+BUILD_CACHE_DIR=os_path(SOLUTION_DIR + '/.build-cache')
+#ignore the build cache, do a full clean and build
+BUILD_FORCE=False
+#optional git ref, to only build and test the projects affected by the changes since it, as in affected=origin/master
+AFFECTED=None
+#max seconds a task, or the whole build, may run for before its processes are killed. 0 for no limit
+TASK_TIMEOUT=0
+BUILD_TIMEOUT=0
+#dirs never looked in when searching for files
+INDEX_PRUNE_DIRS=['.git','packages','obj','.build-trash','.build-cache']
+
+#---- nuget restore, the tools mirror and the local repo feed ----
+#address task serve-feed serves LOCAL_REPO on as a nuget feed, port 0 for any free port. The feed is for development,
+#with no authentication, so anyone who can connect to it can download every package in the repo
+FEED_HOST='localhost'
+FEED_PORT=8624
+#url of a nuget feed, as in one run by serve-feed, that restores and tool installs look in along with NUGET_SRC
+NUGET_FEED=None
+#machine wide cache of restored packages, shared by every checkout, which packages/ is hardlinked from
+NUGET_CACHE=os_path(USER_HOME + '/workspace/nuget-package-cache/')
+#restore the packages even if the packages.config files are unchanged, and how many to restore at the same time
+RESTORE_FORCE=False
+RESTORE_JOBS=8
+#local copies of the tool packages (nunit, opencover etc), used before going to NUGET_SRC
+NUGET_MIRROR=os_path(USER_HOME + '/workspace/nuget-mirror/')
+#optional tarball of .nupkg files to seed the mirror with
+MIRROR_SEED=None
+#only install tools from NUGET_MIRROR, never from NUGET_SRC
+OFFLINE=False
+
+#---- clean ----
+#where clean moves what it removes to, for a background reaper to delete. On the same drive as the solution so it's a rename
+TRASH_DIR=os_path(SOLUTION_DIR + '/.build-trash')
+#delete what clean removes before returning, rather than in the background, and how many dirs to delete at the same time
+CLEAN_WAIT=False
+CLEAN_JOBS=4
+
+#---- tests, the test result cache, test shards and test workers ----
+#where each test project's NUnit results and coverage are written to
+TEST_RESULTS_DIR=os_path(SOLUTION_DIR + '/test-results')
+#where task test-coverage generates the coverage report of all the test projects
+COVERAGE_REPORT_DIR=os_path(SOLUTION_DIR + '/coverage-report')
+#run the tests even if the same test assemblies already passed
+TEST_FORCE=False
+#max size of the passed test results kept to skip rerunning unchanged tests
+TEST_CACHE_MAX_MB=100
+#split each test project's fixtures into shards balanced by how long each took before, run by this many local processes
+#or by the test-worker agents at TEST_WORKERS (host:port,..). 0 and no workers to run each project's tests in one go
+TEST_SHARDS=0
+TEST_WORKERS=None
+#secs of (previously timed) fixtures a shard runs in each nunit run, and the address task test-worker listens on
+TEST_BATCH_SECS=30
+TEST_WORKER_HOST='localhost'
+TEST_WORKER_PORT=8625
+#secret shared by test-worker and its clients, without which it runs nothing, as it runs what it's sent
+TEST_WORKER_TOKEN=None
+
+#---- remote cache of built outputs ----
+#cache of built project outputs shared between machines, keyed by their inputs, CONFIG and the compiler versions:
+#a dir, or the http:// url of a cache-server. Read only for machines which shouldn't upload, as in developers'
+REMOTE_CACHE=None
+REMOTE_CACHE_READONLY=False
+#max size of a dir cache (as cache-server keeps), beyond which the least recently used outputs are evicted
+REMOTE_CACHE_MAX_MB=2048
+#where task cache-server keeps the outputs it serves, and the address it listens on
+CACHE_SERVER_DIR=os_path(USER_HOME + '/workspace/build-output-cache/')
+CACHE_SERVER_HOST='localhost'
+CACHE_SERVER_PORT=8626
+#secret cache-server requires uploads to be sent with, which remote_cache builds send. Read only without one
+CACHE_SERVER_TOKEN=None
+#max size of an upload to cache-server, the zip of a project's outputs
+CACHE_SERVER_MAX_UPLOAD_MB=512
+
+#---- perf tests ----
+#the test project and (NUnit -run) tests for task perf to run
+PERF_PROJECT='TestFirst.Net.Performance.Test'
+PERF_TESTS=None
+#metrics to compare perf runs against, and the % a metric can get worse by before failing the build
+PERF_BASELINE=os_path(SOLUTION_DIR + '/perf-baseline.json')
+PERF_THRESHOLD=10
+PERF_UPDATE_BASELINE=False
+#where the metrics files of each perf run are collected
+PERF_RESULTS_DIR=os_path(SOLUTION_DIR + '/perf-results')
+#metrics file (or converted store) for task perf-query, by default the latest collected. And its throughput interval in secs
+PERF_METRICS=None
+PERF_INTERVAL=1
+
+#---- trace and task logs ----
+#record the tasks and processes run as a chrome://tracing or ui.perfetto.dev timeline, and log the slowest
+TRACE=True
+TRACE_FILE=os_path(BUILD_CACHE_DIR + '/build-trace.json')
+TRACE_TOP=10
+#write the output of the processes run to a compressed log per task in LOG_DIR, indexing its errors and warnings, and
+#only show the errors and warnings, the latest line every LOG_TAIL_SECS and, if a process fails, its last lines
+LOG_CAPTURE=True
+LOG_DIR=os_path(BUILD_CACHE_DIR + '/logs/')
+LOG_COMPRESSION='zstd' if zstd else 'gzip'
+#logs are compressed in chunks of this size, so any part can be read without decompressing what's before it
+LOG_CHUNK_KB=1024
+LOG_TAIL_SECS=2
+LOG_TAIL_LINES=20
+#warnings shown per task, the rest are only logged
+LOG_MAX_WARNINGS=50
+#for task logs: the task whose log to show (default all), what of it (errors, warnings or all), and lines of context
+LOG_TASK=None
+LOG_SHOW='errors'
+LOG_CONTEXT=3
+
+#---- bench ----
+#task bench times build.py's own overhead against a synthetic solution of BENCH_PROJECTS projects of BENCH_FILES files,
+#and fake tools writing BENCH_OUTPUT_MB of output. It fails on a case slower or bigger than in BENCH_BASELINE by more
+#than BENCH_TOLERANCE, or with BENCH_SAVE saves the results as the baseline. BENCH_CASES picks the cases, default all
+BENCH_DIR=os_path(BUILD_CACHE_DIR + '/bench/')
+BENCH_BASELINE=os_path(SOLUTION_DIR + '/bench-baseline.json')
+BENCH_SAVE=False
+BENCH_TOLERANCE=0.25
+BENCH_CASES=None
+BENCH_REPEAT=5
+BENCH_PROJECTS=20
+BENCH_FILES=500
+BENCH_DOC_KB=1024
+BENCH_OUTPUT_MB=20
+BENCH_TASKS=1000
+#set by bench for the process it runs each case in
+BENCH_CASE=None
+BENCH_RESULT=None
+
+#---- watch and the build daemon ----
+#tasks task watch runs when files change, the secs of quiet to wait for after a change, and whether to poll rather than use inotify
+WATCH_TASKS='build,test'
+WATCH_DEBOUNCE=0.5
+WATCH_POLL=False
+WATCH_POLL_SECS=1
+#run the build in a long lived daemon which keeps the toolchain, file index and fingerprints loaded between builds
+DAEMON=False
+DAEMON_SOCKET=os_path(BUILD_CACHE_DIR + '/daemon.sock')
+#secs the daemon waits for another build before exiting, 0 to wait forever
+DAEMON_IDLE_SECS=3600
+
+
 def task_help():
     log('USAGE:')
     log('   build.py task [task..] [varname1=value1..]')
     log('   eg build.py clean restore build test')
     log('TASKS:')
     log('  clean : remove all built artifacts (*.dll)')
+    log('  reap-trash : delete what clean moved into the trash dir, which clean runs in the background')
     log('  clean-repo : remove all *.nupkg files from local repo ' + LOCAL_REPO)
+    log('  repo-list : list the packages in the local repo, from its index')
+    log('  serve-feed : serve the local repo as an unauthenticated nuget v2/v3 feed for development, on feed_host:feed_port. Stop with ctrl-c')
+    log('  repo-prune : remove all but the last local_repo_keep versions of each package from the local repo')
     log('  clean-all : clean,clean-repo')
-    log('  nuget-restore : restore nuget packages to dir ' + NUGET_PKG_DIR)
-    log('  build : build the solution using msbuild/xbuild')
-    log('  test : run the unit tests')
-    log('  test-coverage : generate the test coverage reports')
-    log('  nuget-pack : pack the built artifacts into nuget packages')
+    log('  nuget-restore : restore the missing nuget packages to dir ' + NUGET_PKG_DIR + ', skipped if no packages.config has changed')
+    log('  build : build the changed projects using msbuild/xbuild, independent projects concurrently when run with -j')
+    log('  bench : time build.py itself on a synthetic solution and fake tools, and compare with bench_baseline')
+    log('  logs : list the task logs of the processes run, and show the errors in them (see log_show)')
+    log('  cache-server : serve cache_server_dir over http as a remote_cache of built outputs. Stop with ctrl-c')
+    log('  watch : on each change to the source, build and test the projects affected by it. Stop with ctrl-c')
+    log('  affected : list the projects and test projects affected by the changes since the git ref affected')
+    log('  test : run the unit tests, each test project concurrently when run with -j')
+    log('  test-worker : run shards of tests for test_workers=<host:port> builds, from this checkout\'s build. Stop with ctrl-c')
+    log('  test-coverage : run the unit tests under opencover, once each, and generate the combined coverage report')
+    log('  perf : run the performance tests and fail if they have regressed against the baseline')
+    log('  perf-query : summarise a (large) perf metrics file by interval, percentile and thread, via a columnar store. Needs numpy')
+    log('  nuget-pack : pack the built artifacts into main and symbols nuget packages, each project concurrently when run with -j')
     log('  release-build : clean, build, test, pack')
     log('  release-push : push all the nuget packages to the nuget repo')
     log('  release : release-build,git-tag')
+    log('  mirror-seed : copy packages from the local repo, packages/ and mirror_seed into the nuget mirror ' + NUGET_MIRROR)
+    log('  daemon : serve builds to daemon=true clients, keeping the toolchain, file index and fingerprints in memory')
+    log('  daemon-stop : stop the running build daemon')
     log('  tasks : print all the available tasks')
+    log('  Tasks marked with [:<project>] can also be run for a single project, as in "test:TestFirst.Net.Test"')
     log('VARIABLES:')
     log('  config : the solution config to use. Debug|Release. Current ' + CONFIG)
     log('  version : version to release at. Format MAJOR.MINOR.BUILD. Current ' + VERSION)
@@ -96,54 +315,104 @@ def task_help():
     log('  local_repo : path to local nuget test repo. Current ' + LOCAL_REPO)
     log('  nunit_version : Version of nunit to use for testing. Current ' + NUNIT_VERSION)
     log('  nuget_src : Nuget source to install nunit runner from. Current ' + NUGET_SRC)
+    log('  jobs : max number of tasks to run concurrently. Same as -j<N>, -j uses all cpus. Current ' + str(JOBS))
+    log('  toolchain_refresh : find msbuild/xbuild/mono/nunit etc again, ignoring those found previously. Current ' + str(TOOLCHAIN_REFRESH))
+    log('  build_force : ignore the build cache and clean build the whole solution. Current ' + str(BUILD_FORCE))
+    log('  affected : git ref, as in origin/master. Only build and test the projects changed since it and those depending on them. Current ' + str(AFFECTED))
+    log('  task_timeout : max seconds any one task may take before its processes are killed, 0 for none. Current ' + str(TASK_TIMEOUT))
+    log('  build_timeout : max seconds the whole build may take before its processes are killed, 0 for none. Current ' + str(BUILD_TIMEOUT))
+    log('  local_repo_keep : versions of each package kept in the local repo, 0 for all. Current ' + str(LOCAL_REPO_KEEP))
+    log(' nuget restore, the tools mirror and the local repo feed:')
+    log('  nuget_feed : url of a nuget feed restore and tool installs also look in, as in http://<host>:<port>/api/v2/ of serve-feed. Current ' + str(NUGET_FEED))
+    log('  feed_host : host/ip serve-feed listens on, 0.0.0.0 for all, who can then all download from it. Current ' + FEED_HOST)
+    log('  feed_port : port serve-feed listens on, 0 for any free one. Current ' + str(FEED_PORT))
+    log('  nuget_cache : machine wide cache of restored packages, hardlinked into packages/. Current ' + NUGET_CACHE)
+    log('  restore_force : restore every package, even if no packages.config has changed. Current ' + str(RESTORE_FORCE))
+    log('  restore_jobs : max number of packages restored at the same time. Current ' + str(RESTORE_JOBS))
+    log('  nuget_mirror : dir of tool packages to install from before trying nuget_src. Current ' + NUGET_MIRROR)
+    log('  mirror_seed : tarball of .nupkg files for task mirror-seed to add to the mirror. Current ' + str(MIRROR_SEED))
+    log('  offline : only install tools from the nuget mirror. Current ' + str(OFFLINE))
+    log(' clean:')
+    log('  trash_dir : where clean moves bin/, obj/ and packages/ to, to be deleted in the background. Current ' + TRASH_DIR)
+    log('  clean_wait : delete what clean removes before returning, rather than in the background. Current ' + str(CLEAN_WAIT))
+    log('  clean_jobs : max number of dirs deleted at the same time. Current ' + str(CLEAN_JOBS))
+    log(' tests, the test result cache, test shards and test workers:')
+    log('  test_force : rerun tests even if the same test assemblies have already passed. Current ' + str(TEST_FORCE))
+    log('  test_cache_max_mb : max size of the cache of passed test results. Current ' + str(TEST_CACHE_MAX_MB))
+    log('  test_results_dir : where the NUnit results of each test project are written. Current ' + TEST_RESULTS_DIR)
+    log('  coverage_report_dir : where test-coverage generates the coverage report. Current ' + COVERAGE_REPORT_DIR)
+    log('  test_shards : split each test project into this many shards, by fixture, run as local processes. Current ' + str(TEST_SHARDS))
+    log('  test_workers : comma separated host:port of test-worker agents to run the shards on. Current ' + str(TEST_WORKERS))
+    log('  test_batch_secs : secs of tests a shard runs per nunit run, the unit a slow shard is split again by. Current ' + str(TEST_BATCH_SECS))
+    log('  test_worker_host : host/ip test-worker listens on, 0.0.0.0 for all. Current ' + TEST_WORKER_HOST)
+    log('  test_worker_port : port test-worker listens on. Current ' + str(TEST_WORKER_PORT))
+    log('  test_worker_token : secret test-worker requires of its clients, which they send. test-worker won\'t start without one')
+    log(' remote cache of built outputs:')
+    log('  remote_cache : dir or cache-server url of built outputs shared between machines, used instead of building. Current ' + str(REMOTE_CACHE))
+    log('  remote_cache_readonly : use the remote cache, but never upload to it. Current ' + str(REMOTE_CACHE_READONLY))
+    log('  remote_cache_max_mb : max size of a dir remote cache, least recently used outputs evicted beyond it. Current ' + str(REMOTE_CACHE_MAX_MB))
+    log('  cache_server_dir : where cache-server keeps the outputs. Current ' + CACHE_SERVER_DIR)
+    log('  cache_server_host : host/ip cache-server listens on, 0.0.0.0 for all. Current ' + CACHE_SERVER_HOST)
+    log('  cache_server_port : port cache-server listens on. Current ' + str(CACHE_SERVER_PORT))
+    log('  cache_server_token : secret cache-server requires of uploads, sent by remote_cache builds. Read only without one')
+    log('  cache_server_max_upload_mb : max size of an upload cache-server accepts. Current ' + str(CACHE_SERVER_MAX_UPLOAD_MB))
+    log(' perf tests:')
+    log('  perf_project : test project with the performance tests to run. Current ' + PERF_PROJECT)
+    log('  perf_tests : comma separated performance tests to run. Passed to NUnit. Current ' + str(PERF_TESTS))
+    log('  perf_baseline : file of the metrics to compare performance runs against. Current ' + PERF_BASELINE)
+    log('  perf_threshold : % a throughput or latency can get worse by before failing. Current ' + str(PERF_THRESHOLD))
+    log('  perf_update_baseline : save this run as the new baseline. Current ' + str(PERF_UPDATE_BASELINE))
+    log('  perf_metrics : metrics file or store for perf-query. Defaults to the latest under ' + PERF_RESULTS_DIR)
+    log('  perf_interval : seconds per interval for the perf-query throughput. Current ' + str(PERF_INTERVAL))
+    log(' trace and task logs:')
+    log('  trace : write a timeline of the tasks and processes run to trace_file. Current ' + str(TRACE))
+    log('  trace_file : chrome/perfetto trace event file to write. Current ' + TRACE_FILE)
+    log('  trace_top : number of the slowest tasks and processes to list at the end. Current ' + str(TRACE_TOP))
+    log('  log_capture : write process output to compressed task logs, show only errors, warnings and progress. Current ' + str(LOG_CAPTURE))
+    log('  log_dir : where the task logs go. Current ' + LOG_DIR)
+    log('  log_compression : gzip, or zstd if the zstd module is available. Current ' + LOG_COMPRESSION)
+    log('  log_chunk_kb : size of the chunks logs are compressed in. Current ' + str(LOG_CHUNK_KB))
+    log('  log_tail_secs : secs between showing the latest line of a process. Current ' + str(LOG_TAIL_SECS))
+    log('  log_tail_lines : lines shown from the end of the output of a failed process. Current ' + str(LOG_TAIL_LINES))
+    log('  log_max_warnings : warnings shown per task, the rest are only logged. Current ' + str(LOG_MAX_WARNINGS))
+    log('  log_task : task whose log task logs shows, as in build:TestFirst.Net. Current ' + str(LOG_TASK))
+    log('  log_show : what task logs shows, errors, warnings (and errors) or all. Current ' + LOG_SHOW)
+    log('  log_context : lines shown around each error or warning by task logs. Current ' + str(LOG_CONTEXT))
+    log(' bench:')
+    log('  bench_baseline : results to compare bench with, written by bench with bench_save=true. Current ' + BENCH_BASELINE)
+    log('  bench_save : save the results of bench as the baseline. Current ' + str(BENCH_SAVE))
+    log('  bench_tolerance : fraction slower or bigger than the baseline a bench case fails at. Current ' + str(BENCH_TOLERANCE))
+    log('  bench_cases : bench cases to run, comma separated, default all. Current ' + str(BENCH_CASES))
+    log('  bench_repeat : times each bench case is run. Current ' + str(BENCH_REPEAT))
+    log('  bench_projects : projects in the synthetic solution. Current ' + str(BENCH_PROJECTS))
+    log('  bench_files : source files in each synthetic project. Current ' + str(BENCH_FILES))
+    log('  bench_doc_kb : size of the synthetic README.md and RELEASENOTES.md. Current ' + str(BENCH_DOC_KB))
+    log('  bench_output_mb : output written by each fake tool run. Current ' + str(BENCH_OUTPUT_MB))
+    log('  bench_tasks : no-op tasks the dispatch cases run. Current ' + str(BENCH_TASKS))
+    log('  bench_dir : where the synthetic solution and fake tools are written. Current ' + BENCH_DIR)
+    log(' watch and the build daemon:')
+    log('  watch_tasks : comma separated tasks run by watch. Current ' + WATCH_TASKS)
+    log('  watch_debounce : secs without changes to wait for before watch runs the tasks. Current ' + str(WATCH_DEBOUNCE))
+    log('  watch_poll : poll for changes every watch_poll_secs, rather than use inotify. Current ' + str(WATCH_POLL))
+    log('  watch_poll_secs : secs between each poll for changes. Current ' + str(WATCH_POLL_SECS))
+    log('  daemon : run the tasks in the build daemon, starting it if need be. Current ' + str(DAEMON))
+    log('  daemon_socket : unix socket the daemon listens on. Current ' + DAEMON_SOCKET)
+    log('  daemon_idle_secs : secs the daemon waits for another build before exiting, 0 for never. Current ' + str(DAEMON_IDLE_SECS))
     log('')
     log('To set script variables pass in <name>=<value> as in "build.py release version=1.2.3" (name is case insensitive)')
     log('Values with true/false will be converted to True/False (case insensitive)')
 
 
 def task_init():
-    global MSBUILD_EXE
-    global MONO_EXE
-    global OPENCOVER_EXE
-    global REPORTGEN_EXE
-    global OPENCOVER_EXE
-    global XBUILD_EXE
-    global NUNIT_CONSOLE_EXE
-    
-    if can_invoke('MsBuild'):
-        log('Using MSBuild on the path')
-        MSBUILD_EXE="MsBuild"
+    manifest=load_toolchain_manifest()
+    if manifest:
+        log('Using the toolchain found previously, as listed in ' + os.path.join(BUILD_CACHE_DIR,'toolchain.json'))
+        globals().update(manifest['tools'])
+        toolchain_versions.clear()
+        toolchain_versions.update(manifest['versions'])
     else:
-        #find latest MSBuild 
-        msbuilds=[]
-        if is_windows() and os.environ.get('SYSTEMROOT') != None:
-            dotnet_dir=os.environ.get('SYSTEMROOT') + '/Microsoft.NET/Framework'        
-            def onfile(path,name):
-                if name.endswith('MSBuild.exe'):
-                    msbuilds.append(path)
-            find_files(dotnet_dir,onfile)
-            msbuilds.sort(reverse=True) #get latest
-
-        if len(msbuilds) > 0:
-            MSBUILD_EXE=msbuilds[0]
-        if can_invoke(MSBUILD_EXE):
-            log('Using MSBuild at ' + MSBUILD_EXE)
-        elif can_invoke('xbuild'):
-            log('Using xbuild on the path')
-            XBUILD_EXE='xbuild'
-            MSBUILD_EXE=None
-        else:
-            raise BuildError('Could not find MsBuild or xbuild. Make one available on the path. Also tried looking under $SYSTEMROOT\\Microsoft.NET\\Framework')
-        
-    if can_invoke('mono'):
-        log('Using Mono on the path')
-        MONO_EXE='mono'
-    else:
-        MONO_EXE=None
-    
-    OPENCOVER_EXE=nuget_install_if_not_exists('OpenCover',OPENCOVER_VERSION,'OpenCover.Console.exe')
-    REPORTGEN_EXE=nuget_install_if_not_exists('ReportGenerator',REPORTGEN_VERSION,'ReportGenerator.exe')
-    NUNIT_CONSOLE_EXE=nuget_install_if_not_exists('NUnit.Runners',NUNIT_VERSION,'nunit-console.exe')
+        find_toolchain()
+        save_toolchain_manifest()
 
     log('Using NUnit ' + NUNIT_CONSOLE_EXE)
     log('Using OpenCover ' + OPENCOVER_EXE)
@@ -156,9 +425,10 @@ def task_version():
         log('Tagged git versions:')
         invoke('git',['tag'])
         
-        VERSION = input('[BUILD] Build as nuget version: ')
+        VERSION = prompt('[BUILD] Build as nuget version: ')
         if VERSION.startswith('v'):
             VERSION=VERSION[1:]
+   write_assembly_version(BUILD_ASSEMBLY,VERSION)
 
 def task_clean_all():
     log('task-clean-all')
@@ -175,15 +445,16 @@ def task_clean():
 
     for proj in (PROJECTS + TEST_PROJECTS):
         if include_proj(proj):
-            shutil.rmtree(proj + '/bin/',ignore_errors=True)
-            shutil.rmtree(proj + '/obj/',ignore_errors=True)
+            trash(proj + '/bin/')
+            trash(proj + '/obj/')
         
     #remove old NuGet pkgs and generated nuspec files    
+    #(packages/ isn't indexed, so is left alone)
     def onfile(path,name):       
-        if not unix_path(path).startswith('./packages') and name.endswith('.nupkg') or name.endswith('.nuspec'):
-            log('removed:' + path)            
-            os.remove(path)
-    find_files('.',onfile)
+        log('removed:' + path)            
+        os.remove(path)
+    find_files(SOLUTION_DIR,onfile,['.nupkg','.nuspec'])
+    empty_trash()
     
     #if [ $MSBUILD_EXE ]; then
     #    #msbuild complains about this
@@ -196,101 +467,368 @@ def task_clean():
     #    $XBUILD_EXE $SOLUTION /t:Clean  /p:Configuration=$CONFIG  /verbosity:quiet /nologo
 
 
-
 def task_clean_repo():
-    def onfile(path,name):
-        if name.endswith('.nupkg'):
-            os.remove(path)
-    find_files(LOCAL_REPO,onfile)
+    LocalRepo(LOCAL_REPO).clear()
+
+
+def task_repo_prune():
+    repo=LocalRepo(LOCAL_REPO)
+    repo.prune(int(LOCAL_REPO_KEEP))
+    repo.save()
+
+
+def task_repo_list():
+    log('packages in local repo {} are:'.format(LOCAL_REPO))
+    for name,entry in LocalRepo(LOCAL_REPO).packages():
+        log('\t{:<60} {:>10,} bytes  {}'.format(name,entry['size'],entry['sha'][:12]))
 
     
-def task_clean_packages():
-    log('removing files in packages/')
-    shutil.rmtree('packages/',ignore_errors=True)
+def task_serve_feed():
+    """Serve LOCAL_REPO as an unauthenticated nuget feed, for development. Only to this machine unless FEED_HOST
+    says otherwise"""
+    repo=LocalRepo(LOCAL_REPO)
+    if repo.add_metadata() or not os.path.isfile(repo.index_path):
+        repo.save()
+    server=http.server.ThreadingHTTPServer((FEED_HOST,int(FEED_PORT)),FeedRequestHandler)
+    server.daemon_threads=True
+    host=socket.getfqdn() if FEED_HOST in ('','0.0.0.0') else FEED_HOST
+    base_url='http://{}:{}'.format(host,server.server_address[1])
+    server.feed=NugetFeed(LOCAL_REPO,base_url)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    with live_output():
+        log('serving {} as a nuget feed, v2 at {}/api/v2/ and v3 at {}/v3/index.json'.format(LOCAL_REPO,base_url,base_url))
+        log('restore and install tools from it with nuget_feed={}/api/v2/'.format(base_url))
+        if FEED_HOST not in ('localhost','127.0.0.1','::1'):
+            log('the feed has no authentication, so every package in it can be downloaded by anyone who can reach {}'.format(host))
+        try:
+            #when run concurrently with other tasks, ctrl-c cancels the build rather than interrupting here
+            while not cancelled.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            server.server_close()
+        log('stopped serving the feed')
+
+
+def task_logs():
+    if LOG_SHOW not in ('errors','warnings','all'):
+        raise BuildError('log_show must be errors, warnings or all, not ' + str(LOG_SHOW))
+    readers=[]
+    for index_path in sorted(glob.glob(os.path.join(LOG_DIR,'*.idx')),key=os.path.getmtime):
+        try:
+            reader=LogReader(index_path)
+        except BuildError as e:
+            log('ignoring ' + e.msg)
+            continue
+        if not LOG_TASK or reader.task == LOG_TASK:
+            readers.append(reader)
+    if not readers:
+        log('no logs{} in {}'.format(' of task ' + LOG_TASK if LOG_TASK else '',LOG_DIR))
+        return
+    context=int(LOG_CONTEXT)
+    for reader in readers:
+        errors=sum(1 for line,kind,offset in reader.issues if kind == 'error')
+        log('{} at {} : {:,} lines, {} errors, {} warnings, {:,} bytes compressed to {:,} in {}'.format(reader.task,
+            datetime.datetime.fromtimestamp(reader.started).strftime('%Y-%m-%d %H:%M:%S'),reader.lines,errors,
+            len(reader.issues) - errors,reader.size,os.path.getsize(reader.path),reader.path))
+        if LOG_SHOW == 'all':
+            reader.write_all()
+            continue
+        for line,kind,offset in reader.issues:
+            if kind == 'error' or LOG_SHOW == 'warnings':
+                write_out(''.join('{} {:>8}: {}\n'.format('>' if number == line else ' ',number + 1,text)
+                    for number,text in reader.lines_around(line,context,context)) + '\n')
 
 
-def task_build():
-    depends('init','version')
+def task_bench():
+    """Time build.py's own overhead on a synthetic solution, each case in its own process running this build.py"""
+    if BENCH_CASE:
+        run_bench_case(BENCH_CASE)
+        return
+    names=[name.strip() for name in BENCH_CASES.split(',')] if BENCH_CASES else list(BENCH_CASE_FUNCS)
+    unknown=[name for name in names if name not in BENCH_CASE_FUNCS]
+    if unknown:
+        raise BuildError('no bench cases {}, they are: {}'.format(','.join(unknown),','.join(BENCH_CASE_FUNCS)))
+    tree=make_bench_tree()
+    baseline=load_bench_baseline()
+    results={}
+    with live_output():
+        for name in names:
+            results[name]=run_bench_process(tree,name)
+            if name in baseline and baseline[name].get('sizes') != results[name]['sizes']:
+                log('not comparing {} with the baseline, it was for other bench sizes {}'.format(name,baseline.pop(name).get('sizes')))
+            log(format_bench_result(name,results[name],baseline.get(name)))
+    slower=[name for name in names if bench_regressed(results[name],baseline.get(name))]
+    if BENCH_SAVE:
+        baseline.update(results)
+        ensure_dir_exists(BENCH_BASELINE)
+        with open(BENCH_BASELINE + '.tmp','w') as f:
+            json.dump(baseline,f,indent=2,sort_keys=True)
+        os.replace(BENCH_BASELINE + '.tmp',BENCH_BASELINE)
+        log('saved the results as the baseline in ' + BENCH_BASELINE)
+    elif not baseline:
+        log('no baseline to compare with, save one with bench_save=true')
+    elif slower:
+        raise BuildError('slower or bigger than the baseline by more than {:.0%}: {}'.format(float(BENCH_TOLERANCE),','.join(slower)))
+
+
+def task_cache_server():
+    server=http.server.ThreadingHTTPServer((CACHE_SERVER_HOST,int(CACHE_SERVER_PORT)),CacheRequestHandler)
+    server.daemon_threads=True
+    server.cache=DirOutputCache(CACHE_SERVER_DIR,float(REMOTE_CACHE_MAX_MB) * 1024 * 1024)
+    server.token=CACHE_SERVER_TOKEN
+    server.max_bytes=int(float(CACHE_SERVER_MAX_UPLOAD_MB) * 1024 * 1024)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    with live_output():
+        log('serving the outputs in {} at remote_cache=http://{}:{}/'.format(CACHE_SERVER_DIR,CACHE_SERVER_HOST,server.server_address[1]))
+        if not CACHE_SERVER_TOKEN:
+            log('read only, as there is no cache_server_token for uploads to be sent with')
+        try:
+            #when run concurrently with other tasks, ctrl-c cancels the build rather than interrupting here
+            while not cancelled.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            server.server_close()
+        log('stopped the cache server')
 
-    write_assembly_version(BUILD_ASSEMBLY,VERSION)
-	
-    if MSBUILD_EXE:
-        log('building using msbuild : ' + MSBUILD_EXE)
-        win_invoke(MSBUILD_EXE,[SOLUTION,'-t:Clean,Build','-p:Configuration=' + CONFIG, '/verbosity:' + VERBOSITY])
-    else:
-        log('building using xbuild : ' + XBUILD_EXE)
-        invoke(XBUILD_EXE,[SOLUTION,'/t:Build','/p:Configuration=' + CONFIG, '/verbosity:' + VERBOSITY])
+
+def task_clean_packages():
+    log('removing files in packages/')
+    trash(NUGET_PKG_DIR,packages=True)
+    empty_trash()
 
 
-def task_test():
+def task_reap_trash():
+    """Delete everything in TRASH_DIR, until nothing more is moved into it"""
+    failed=set()
+    while True:
+        entries=[os.path.join(TRASH_DIR,name) for name in sorted(os.listdir(TRASH_DIR))] if os.path.isdir(TRASH_DIR) else []
+        entries=[path for path in entries if path not in failed]
+        if not entries:
+            break
+        run_concurrently(remove_tree,entries,int(CLEAN_JOBS))
+        #what can't be deleted (say held open on windows) is left for the next reaper, rather than tried forever
+        failed.update(path for path in entries if os.path.lexists(path))
+    with contextlib.suppress(OSError):
+        os.rmdir(TRASH_DIR)
+
+
+@requires('init','version')
+@per_project(lambda: affected(build_order(load_projects())),after=lambda proj: load_projects()[proj].references)
+def task_build(proj):
+    project=load_projects()[proj]
+    with build_cache_lock:
+        cache=load_build_cache()
+        fingerprint=project_fingerprints(reference_closure(proj),cache['files'])[proj]
+        save_cache('build',cache)
+
+    if not BUILD_FORCE and cache['projects'].get(CONFIG,{}).get(proj) == fingerprint and os.path.isfile(project.output(CONFIG)):
+        log(proj + ' is up to date')
+        return
+    remote=remote_output_cache()
+    key=output_cache_key(proj,fingerprint)
+    try:
+        fetched=remote is not None and not BUILD_FORCE and fetch_outputs(remote,key,project,CONFIG)
+    except (OSError,ValueError) as e:
+        log("couldn't read the remote cache {} ({}), building {}".format(REMOTE_CACHE,e,proj))
+        fetched=False
+    if fetched:
+        log('{} outputs downloaded from the remote cache {}'.format(proj,REMOTE_CACHE))
+    else:
+        log('building ' + proj)
+        #the referenced projects are built by their own build:<project> tasks
+        msbuild(project.csproj,['Rebuild' if BUILD_FORCE else 'Build'],['BuildProjectReferences=false','SolutionDir=' + SOLUTION_DIR + os.sep])
+        if remote is not None and not REMOTE_CACHE_READONLY:
+            try:
+                store_outputs(remote,key,project,CONFIG)
+            except (OSError,BuildError) as e:
+                log("couldn't upload the outputs of {} to the remote cache {} ({})".format(proj,REMOTE_CACHE,getattr(e,'msg',e)))
+    with build_cache_lock:
+        cache=load_build_cache()
+        cache['projects'].setdefault(CONFIG,{})[proj]=fingerprint
+        save_cache('build',cache)
+
+
+@requires(lambda: [] if TEST_SKIP else ['init','build'])
+@per_project(lambda: [] if TEST_SKIP else affected(TEST_PROJECTS),summary=lambda projects: test_summary(projects))
+def task_test(proj):
+    #the summary says they were skipped
     if TEST_SKIP:
-       log('tests are set to skip')
        return
-    depends('init','build')
-    
+    run_tests(proj)
+
+
+@requires('init','build')
+@per_project(lambda: affected(TEST_PROJECTS),summary=lambda projects: coverage_summary(projects))
+def task_test_coverage(proj):
+    only_under_windows('opencover code coverage')
+    run_tests(proj,coverage=True)
+
+
+def run_tests(proj,coverage=False):
+    """Run the project's tests with NUnit, unless the same tests already passed. With 'coverage' run them under
+    OpenCover, so the one run gives both the test results and the coverage"""
 	#e.g. ./TestFirst.Net.Performance.Test/obj/Release/TestFirst.Net.Performance.Test.dll
-    for proj in TEST_PROJECTS:
-        if include_proj(proj):
-            log('executing tests in ' + proj)
-            with cd(proj + '/bin/' + CONFIG):
-                dll_name=proj
-                if TESTS:
-                    win_invoke(NUNIT_CONSOLE_EXE,['-nologo','-run:' + TESTS, dll_name + '.dll'])
-                else:
-                    win_invoke(NUNIT_CONSOLE_EXE,['-nologo',dll_name + '.dll'])
+    log('executing tests in ' + proj + (' for coverage' if coverage else ''))
+    result_file=os.path.join(TEST_RESULTS_DIR,proj + '.TestResult.xml')
+    coverage_file=os.path.join(TEST_RESULTS_DIR,proj + '.coverage.xml') if coverage else None
+    ensure_dir_exists(result_file)
+    for path in (result_file,coverage_file):
+        if path and os.path.isfile(path):
+            os.remove(path)
 
-def task_test_coverage():
-    only_under_windows('opencover code coverage only runs under windows')
-    depends('init','build','test')
+    args=['-nologo','-result:' + result_file]
+    if TESTS:
+        args.append('-run:' + TESTS)
+
+    run=TestRun(proj)
+    test_runs[proj]=run
+    cache_key=test_cache_key(proj)
+    if not TEST_FORCE and restore_test_result(cache_key,result_file,coverage_file):
+        run.cached=True
+        run.finished=time.time()
+        read_test_results(run,result_file)
+        log(run.describe())
+        return
 
-    log('generating code test coverage')
-    
-    for proj in TEST_PROJECTS:
-        if include_proj(proj):
-            log('Executing tests in {} for coverage'.format(proj))
-            with cd(proj + '/bin/' + CONFIG):
-                test_dll_name=proj
-                proj_dll_name=(test_dll_name if not test_dll_name.endswith('.Test') else test_dll_name[:-5])
-                
-                log('Generating code coverage for {}'.format(proj))
-                win_invoke(OPENCOVER_EXE,[
-                    '-log:All',
-                    '-target:{}'.format(NUNIT_CONSOLE_EXE),
-                    '-targetargs:"/nologo {}.dll /noshadow /trace=Error"'.format(test_dll_name),
-                    '-filter:"+[' + proj_dll_name + ']*"',
-                    '-excludebyattribute:"System.CodeDom.Compiler.GeneratedCodeAttribute"',
-                    '-register:user',
-                    '-output:_CodeCoverageResult.xml'])
-
-                log('Generating report from code coverage for {}'.format(proj))
-                win_invoke(REPORTGEN_EXE,[
-                    '-reports:_CodeCoverageResult.xml',
-                    '-targetdir:_CodeCoverageReport',
-                    '-reporttypes:Html' ])
-                  
-            log('finished running code coverage ' + proj) 
+    try:
+        if coverage:
+            covered=proj[:-5] if proj.endswith('.Test') else proj
+            win_invoke(OPENCOVER_EXE,[
+                '-log:All',
+                '-target:{}'.format(NUNIT_CONSOLE_EXE),
+                '-targetargs:"{}"'.format(' '.join(args + [proj + '.dll','-noshadow','-trace=Error'])),
+                '-filter:"+[' + covered + ']*"',
+                '-excludebyattribute:"System.CodeDom.Compiler.GeneratedCodeAttribute"',
+                '-register:user',
+                '-returntargetcode',
+                '-output:' + coverage_file],cwd=proj + '/bin/' + CONFIG)
+        elif not (TEST_SHARDS or TEST_WORKERS) or TESTS or not run_sharded_tests(proj,run,result_file):
+            win_invoke(NUNIT_CONSOLE_EXE,args + [proj + '.dll'],cwd=proj + '/bin/' + CONFIG)
+    except BuildError as e:
+        #a cancelled build stops here, otherwise carry on and report the failure in the summary
+        if cancelled.is_set():
+            raise
+        run.error=e.msg
+    finally:
+        run.finished=time.time()
+    read_test_results(run,result_file)
+    #what a shard plan needs, from a run of every test
+    if not TESTS:
+        record_fixture_durations(proj,result_file)
+    if run.passed():
+        store_test_result(cache_key,result_file,coverage_file)
+    log(run.describe())
+
+
+@requires('init')
+def task_test_worker():
+    if not TEST_WORKER_TOKEN:
+        raise BuildError('test-worker runs the tests its clients send, so needs a test_worker_token=<secret> for them to send too')
+    server=socket.create_server((TEST_WORKER_HOST,int(TEST_WORKER_PORT)))
+    server.settimeout(1.0)
+    with live_output():
+        log('test worker listening on {}:{}, running the tests built in {}'.format(TEST_WORKER_HOST,server.getsockname()[1],SOLUTION_DIR))
+        try:
+            #when run concurrently with other tasks, ctrl-c cancels the build rather than interrupting here
+            while not cancelled.is_set():
+                try:
+                    conn,_=server.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                threading.Thread(target=serve_test_shard,args=(conn,),daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        log('stopped the test worker')
+
+
+@requires('init','build')
+def task_perf():
+    bin_dir=os.path.join(SOLUTION_DIR,PERF_PROJECT,'bin',CONFIG)
+    ensure_dir_exists(TEST_RESULTS_DIR + os.sep)
+    args=['-nologo','-result:' + os.path.join(TEST_RESULTS_DIR,PERF_PROJECT + '.perf.TestResult.xml')]
+    if PERF_TESTS:
+        args.append('-run:' + PERF_TESTS)
+
+    log('running performance tests in ' + PERF_PROJECT)
+    started=time.time()
+    win_invoke(NUNIT_CONSOLE_EXE,args + [PERF_PROJECT + '.dll'],cwd=bin_dir)
+
+    #PerformanceMetricsWriter writes to perf-metrics/ under the working dir by default
+    metrics_files=collect_perf_metrics(os.path.join(bin_dir,'perf-metrics'),started)
+    if not metrics_files:
+        raise BuildError('no performance metrics were written to ' + os.path.join(bin_dir,'perf-metrics'))
+    stats=perf_stats(metrics_files)
+    print_perf_stats(stats)
+
+    baseline=load_perf_baseline()
+    if PERF_UPDATE_BASELINE or not baseline:
+        log('saving performance baseline ' + PERF_BASELINE)
+        with open(PERF_BASELINE,'w') as f:
+            json.dump(stats,f,indent=1,sort_keys=True)
+        return
+
+    regressions=perf_regressions(stats,baseline,float(PERF_THRESHOLD))
+    for regression in regressions:
+        error('regressed : ' + regression)
+    if regressions:
+        raise BuildError('{} performance metrics regressed by more than {}% against {}'.format(len(regressions),PERF_THRESHOLD,PERF_BASELINE))
+    log('no performance regressions against ' + PERF_BASELINE)
+
+
+def task_perf_query():
+    source=PERF_METRICS or latest_perf_metrics()
+    if not source:
+        raise BuildError('no perf metrics found under {}. Run task perf, or set perf_metrics'.format(PERF_RESULTS_DIR))
+    store=open_perf_store(source)
+    log('{} metrics from {}'.format(store.count,store.source))
+    if not store.count:
+        return
+
+    interval=float(PERF_INTERVAL)
+    log('successful calls per {}s interval:'.format(interval))
+    log('\t{:<40} {:>10} {:>10} {:>10} {:>10}'.format('metric','intervals','min','mean','max'))
+    for name,counts in sorted(store.interval_throughput(interval).items()):
+        log('\t{:<40} {:>10} {:>10} {:>10.1f} {:>10}'.format(name,len(counts),int(counts.min()),counts.mean(),int(counts.max())))
+
+    pcts=[50,90,95,99,99.9]
+    log('value percentiles:')
+    log('\t{:<40} '.format('metric') + ' '.join('{:>10}'.format('p' + str(pct)) for pct in pcts))
+    for name,values in sorted(store.percentiles(pcts).items()):
+        log('\t{:<40} '.format(name) + ' '.join('{:>10.2f}'.format(values[pct]) for pct in pcts))
+
+    log('per thread:')
+    log('\t{:<40} {:>10} {:>10} {:>10}'.format('machine/agent/thread','calls','errors','mean'))
+    for test,(calls,errors,mean) in sorted(store.thread_breakdown().items()):
+        log('\t{:<40} {:>10} {:>10} {:>10.2f}'.format(test,calls,errors,mean))
 
 
 def task_release():
     log('This will build and package TestFirst.Net and then tag git')
     log('This will place a copy of the built packages into {} for testing'.format(LOCAL_REPO))
 
-    task_release_build()
-    task_tag_git()
+    depends('release-build','tag-git')
 
 
+@requires('build','test','nuget-pack')
 def task_release_build():
-    depends('build','test','nuget-pack')
     copy_pkgs_to_local_repo()
 
 
+@requires('build','test','version')
 def task_tag_git():
-    depends('build','test', 'version')
-
     log('tagging git')
 
     while True:
-        yn = input('tag git with version v{}? yn :'.format(VERSION)).lower()
+        yn = prompt('tag git with version v{}? yn :'.format(VERSION)).lower()
         if yn == 'y':
             invoke('git',['tag','-a','v' + VERSION, '-m', '"Release version ' + VERSION + '"'])
             log('tagged git with v' + VERSION)
@@ -302,19 +840,18 @@ def task_tag_git():
             print('Please answer y or n.')
 
 
+@requires('version')
 def task_release_push():
-    depends('version')
-
     log('publishing nuget packages to the nuget gallery')
 
     while True:
-        yn = input('publish version {}? yn :'.format(VERSION)).lower()
+        yn = prompt('publish version {}? yn :'.format(VERSION)).lower()
         if yn == 'y':
             for proj in PROJECTS:
                 pkg=proj + '.' + VERSION + '.nupkg'
                 log('pushing nuget pkg ' + proj + '/' + pkg)
-                with cd(proj):    
-                    nuget_invoke(['Push', pkg],include_optons=False)
+                #in the project dir by cwd rather than cd, as other tasks may be running on other threads
+                nuget_invoke(['Push', pkg],include_optons=False,cwd=os.path.join(SOLUTION_DIR,proj))
             break
         elif yn == 'n':
             log('aborted, not publishing')
@@ -323,36 +860,959 @@ def task_release_push():
             print('Please answer y or n.')
 
 
-def task_nuget_pack():
-    depends('build')
-
-    log('packing all projects')
-    for proj in PROJECTS:
-        if include_proj(proj):
-            nuget_pack(proj)
+@requires('build','version')
+@per_project(lambda: PROJECTS)
+def task_nuget_pack(proj):
+    nuget_pack(proj)
 
 
 def task_nuget_restore():
-    nuget_invoke(['restore',SOLUTION,'-PackagesDirectory'])
+    configs=[os.path.join(project.dir,'packages.config') for name,project in sorted(load_projects().items())]
+    configs=[path for path in configs if os.path.isfile(path)]
+    cache=load_cache('restore')
+    file_hashes=cache.setdefault('files',{})
+    fingerprint=hashlib.sha1(json.dumps([[os.path.relpath(path,SOLUTION_DIR),file_hash(path,file_hashes)]
+        for path in configs + [NUGET_CONFIG] if os.path.isfile(path)]).encode('utf-8')).hexdigest()
+    packages=sorted({pkg for path in configs for pkg in read_packages_config(path)})
+    #intact if each package's dir still has its .nupkg, which nuget (and restore_package) add last
+    missing=[pkg for pkg in packages if RESTORE_FORCE or not os.path.isfile(os.path.join(NUGET_PKG_DIR,'.'.join(pkg),'.'.join(pkg) + '.nupkg'))]
+    if cache.get('fingerprint') == fingerprint and not missing:
+        log('all {} packages already restored to {}'.format(len(packages),NUGET_PKG_DIR))
+        return
+
+    log('restoring {} of {} packages to {}'.format(len(missing),len(packages),NUGET_PKG_DIR))
+    run_concurrently(restore_package,missing,int(RESTORE_JOBS))
+    cache['fingerprint']=fingerprint
+    save_cache('restore',cache)
+
+
+def task_mirror_seed():
+    log('seeding the nuget mirror ' + NUGET_MIRROR)
+    ensure_dir_exists(NUGET_MIRROR)
+
+    for name,entry in LocalRepo(LOCAL_REPO).packages():
+        add_to_mirror(os.path.join(LOCAL_REPO,name))
+    #packages previously installed by nuget keep a copy of their .nupkg
+    if os.path.isdir(NUGET_PKG_DIR):
+        for pkg_dir in os.listdir(NUGET_PKG_DIR):
+            add_to_mirror(os.path.join(NUGET_PKG_DIR,pkg_dir,pkg_dir + '.nupkg'))
+
+    if MIRROR_SEED:
+        log('extracting packages from ' + MIRROR_SEED)
+        with tarfile.open(MIRROR_SEED) as tar:
+            for member in tar.getmembers():
+                name=os.path.basename(member.name)
+                if member.isfile() and name.endswith('.nupkg') and not os.path.isfile(os.path.join(NUGET_MIRROR,name)):
+                    log('adding {} to mirror {}'.format(name,NUGET_MIRROR))
+                    with tar.extractfile(member) as src, open(os.path.join(NUGET_MIRROR,name),'wb') as dest:
+                        shutil.copyfileobj(src,dest)
+
+
+def task_daemon():
+    """Serve daemon=true builds, one at a time, until stopped or idle for DAEMON_IDLE_SECS"""
+    if daemon_connect():
+        raise BuildError('a build daemon is already listening on ' + DAEMON_SOCKET)
+    #each build starts from the variables the daemon was started with
+    variables={name:val for name,val in globals().items() if name.isupper()}
+    script_stamp=scripts_stamp()
+    ensure_dir_exists(DAEMON_SOCKET)
+    with contextlib.suppress(OSError):
+        os.remove(DAEMON_SOCKET)
+    server=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    server.bind(DAEMON_SOCKET)
+    socket_ino=os.stat(DAEMON_SOCKET).st_ino
+    server.listen(8)
+    server.settimeout(float(DAEMON_IDLE_SECS) or None)
+    log('build daemon {} listening on {}'.format(os.getpid(),DAEMON_SOCKET))
+    try:
+        serving=True
+        while serving:
+            try:
+                conn,_=server.accept()
+            except socket.timeout:
+                log('no builds for {}s, stopping'.format(DAEMON_IDLE_SECS))
+                break
+            conn.settimeout(None)
+            with conn:
+                #a fresh thread per build, so no task state is left over from the last one
+                with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+                    serving=pool.submit(serve_build,conn,variables,script_stamp).result()
+    finally:
+        server.close()
+        #a restarted daemon may already have replaced the socket
+        if file_stamp(DAEMON_SOCKET) and os.stat(DAEMON_SOCKET).st_ino == socket_ino:
+            os.remove(DAEMON_SOCKET)
+
+
+def task_daemon_stop():
+    conn=daemon_connect()
+    if not conn:
+        log('no build daemon is running on ' + DAEMON_SOCKET)
+        return
+    daemon_request(conn,{'stop':True})
+
+
+def task_watch():
+    global watch_projects
+    watcher=file_watcher(SOLUTION_DIR)
+    tasks=[name.strip() for name in WATCH_TASKS.split(',') if name.strip()]
+    with live_output():
+        try:
+            #the first run is of everything, after that only of the projects affected by what changed
+            projects=None
+            while True:
+                new_build()
+                watch_projects=projects
+                try:
+                    run_tasks(tasks)
+                except BuildError as e:
+                    error(e.msg)
+                finally:
+                    watch_projects=None
+                log('watching {} for changes ({})'.format(SOLUTION_DIR,watcher.kind))
+                cancelled.clear()
+
+                #changes outside the projects, as in the build's own results, are ignored
+                projects=set()
+                while not projects:
+                    #when run concurrently with other tasks, ctrl-c cancels the build rather than interrupting here
+                    changed=watcher.changes(1.0)
+                    if cancelled.is_set():
+                        raise KeyboardInterrupt()
+                    if not changed:
+                        continue
+                    #wait for the burst of changes (as in a save all) to finish
+                    while True:
+                        more=watcher.changes(float(WATCH_DEBOUNCE))
+                        if not more:
+                            break
+                        changed|=more
+                    projects=projects_changed(changed)
+                log('changed: ' + ', '.join(os.path.relpath(path,SOLUTION_DIR) for path in sorted(changed)[:5])
+                    + (' and {} more'.format(len(changed) - 5) if len(changed) > 5 else ''))
+                log('affected projects: ' + ', '.join(sorted(projects)))
+        except KeyboardInterrupt:
+            log('stopped watching')
+        finally:
+            watcher.close()
+
+
+def task_affected():
+    if not AFFECTED:
+        raise BuildError('no git ref to compare against given, as in "build.py affected affected=origin/master"')
+    log('projects to build: ' + ', '.join(affected(build_order(load_projects()))))
+    log('test projects to run: ' + ', '.join(affected(TEST_PROJECTS)))
 
 
 def task_tasks():
     log('available tasks:')        
     for task_name in sorted(all_tasks):
-        log('\t' + task_name)
+        if hasattr(all_tasks[task_name],'projects'):
+            log('\t' + task_name + '[:<project>]')
+        else:
+            log('\t' + task_name)
 
 
 # ----------------- helper functions ---------------------------
 
+def find_toolchain():
+    global MSBUILD_EXE
+    global MONO_EXE
+    global OPENCOVER_EXE
+    global REPORTGEN_EXE
+    global OPENCOVER_EXE
+    global XBUILD_EXE
+    global NUNIT_CONSOLE_EXE
+    
+    if can_invoke('MsBuild'):
+        log('Using MSBuild on the path')
+        MSBUILD_EXE="MsBuild"
+    else:
+        #find latest MSBuild 
+        msbuilds=[]
+        if is_windows() and os.environ.get('SYSTEMROOT') != None:
+            dotnet_dir=os.environ.get('SYSTEMROOT') + '/Microsoft.NET/Framework'        
+            def onfile(path,name):
+                if name.endswith('MSBuild.exe'):
+                    msbuilds.append(path)
+            find_files(dotnet_dir,onfile,['.exe'])
+            msbuilds.sort(reverse=True) #get latest
+
+        if len(msbuilds) > 0:
+            MSBUILD_EXE=msbuilds[0]
+        if can_invoke(MSBUILD_EXE):
+            log('Using MSBuild at ' + MSBUILD_EXE)
+        elif can_invoke('xbuild'):
+            log('Using xbuild on the path')
+            XBUILD_EXE='xbuild'
+            MSBUILD_EXE=None
+        else:
+            raise BuildError('Could not find MsBuild or xbuild. Make one available on the path. Also tried looking under $SYSTEMROOT\\Microsoft.NET\\Framework')
+        
+    if can_invoke('mono'):
+        log('Using Mono on the path')
+        MONO_EXE='mono'
+    else:
+        MONO_EXE=None
+    
+    OPENCOVER_EXE,REPORTGEN_EXE,NUNIT_CONSOLE_EXE=run_concurrently(lambda tool: nuget_install_if_not_exists(*tool),[
+        ('OpenCover',OPENCOVER_VERSION,'OpenCover.Console.exe'),
+        ('ReportGenerator',REPORTGEN_VERSION,'ReportGenerator.exe'),
+        ('NUnit.Runners',NUNIT_VERSION,'nunit-console.exe')])
+
+
+#the build variables set by find_toolchain
+TOOLCHAIN_VARS=['MSBUILD_EXE','XBUILD_EXE','MONO_EXE','OPENCOVER_EXE','REPORTGEN_EXE','NUNIT_CONSOLE_EXE']
+toolchain_versions={}
+
+def toolchain_key():
+    """What, other than the tool files themselves, decides which tools find_toolchain finds"""
+    return {
+        'solution_dir':SOLUTION_DIR,
+        'path':os.environ.get('PATH'),
+        'systemroot':os.environ.get('SYSTEMROOT'),
+        'nunit':NUNIT_VERSION,
+        'opencover':OPENCOVER_VERSION,
+        'reportgen':REPORTGEN_VERSION }
+
+
+def save_toolchain_manifest():
+    """Record the tools found, along with their versions and file mtimes so they can be cheaply checked next time"""
+    tools={name:globals()[name] for name in TOOLCHAIN_VARS}
+    files={}
+    for exe in tools.values():
+        if exe:
+            path=resolve_exe(exe)
+            try:
+                stat=os.stat(path)
+                files[path]=[stat.st_mtime_ns,stat.st_size]
+            except OSError:
+                pass
+
+    toolchain_versions.clear()
+    for name,version_args in [('MSBUILD_EXE',['/version','/nologo']),('XBUILD_EXE',['/version']),('MONO_EXE',['--version'])]:
+        if tools[name]:
+            toolchain_versions[name]=probed_version(tools[name],version_args)
+            log('{} version {}'.format(tools[name],toolchain_versions[name]))
+
+    save_cache('toolchain',{'key':toolchain_key(),'tools':tools,'files':files,'versions':toolchain_versions})
+
+
+def load_toolchain_manifest():
+    """Return the toolchain recorded by a previous init, or None if anything has changed since"""
+    if TOOLCHAIN_REFRESH:
+        return None
+    manifest=load_cache('toolchain')
+    if not manifest or manifest.get('key') != toolchain_key():
+        return None
+    for path,(mtime,size) in manifest['files'].items():
+        try:
+            stat=os.stat(path)
+        except OSError:
+            log(path + ' has gone, finding the toolchain again')
+            return None
+        if stat.st_mtime_ns != mtime or stat.st_size != size:
+            log(path + ' has changed, finding the toolchain again')
+            return None
+    return manifest
+
+
+def resolve_exe(exe):
+    return os.path.realpath(shutil.which(exe) or exe)
+
+
+#versions of the tools by resolved path, along with the [mtime,size] they were found at, so a daemon only asks a tool
+#its version again once the tool has changed
+probed_versions={}
+
+def probed_version(exe,args):
+    path=resolve_exe(exe)
+    stamp=file_stamp(path)
+    cached=probed_versions.get(path)
+    if stamp and cached and cached[0] == stamp:
+        return cached[1]
+    version=tool_version(exe,args)
+    if stamp:
+        probed_versions[path]=(stamp,version)
+    return version
+
+
+def tool_version(exe,args):
+    try:
+        proc=subprocess.run([exe] + args,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,timeout=60)
+    except (OSError,subprocess.SubprocessError):
+        return 'unknown'
+    match=re.search(r'\d+(\.\d+)+',proc.stdout.decode(errors='replace'))
+    return match.group(0) if match else 'unknown'
+
+
+def msbuild(target_file,targets,props=None):
+    args=[os_path(target_file),'/t:' + ';'.join(targets),'/p:Configuration=' + CONFIG,'/verbosity:' + VERBOSITY]
+    for prop in (props or []):
+        args.append('/p:' + prop)
+    if MSBUILD_EXE:
+        win_invoke(MSBUILD_EXE,args)
+    else:
+        invoke(XBUILD_EXE,args)
+
+
+build_cache_lock=threading.Lock()
+
+def load_build_cache():
+    """Load the fingerprints of the last successful project builds, dropping them if the toolchain has changed"""
+    cache=load_cache('build')
+    toolchain=toolchain_id()
+    if cache.get('toolchain') != toolchain:
+        if cache:
+            log('toolchain changed, ignoring previous builds')
+        cache={'toolchain':toolchain,'projects':{},'files':{}}
+    return cache
+
+
+def toolchain_id():
+    """Identify the compiler toolchain in use, so that a change of compiler invalidates previous builds"""
+    parts=[]
+    for name in ('MSBUILD_EXE' if MSBUILD_EXE else 'XBUILD_EXE','MONO_EXE'):
+        exe=globals()[name]
+        if exe:
+            path=resolve_exe(exe)
+            version=toolchain_versions.get(name,'unknown')
+            try:
+                stat=os.stat(path)
+                parts.append('{}:{}:{}:{}'.format(path,version,stat.st_size,stat.st_mtime_ns))
+            except OSError:
+                parts.append(path + ':' + version)
+    return ';'.join(parts)
+
+
+def load_cache(name):
+    path=os.path.join(BUILD_CACHE_DIR,name + '.json')
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+
+def save_cache(name,data):
+    ensure_dir_exists(BUILD_CACHE_DIR + os.sep)
+    path=os.path.join(BUILD_CACHE_DIR,name + '.json')
+    #write then rename, so a killed build never leaves a half written cache
+    tmp_path=path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path,'w') as f:
+        json.dump(data,f,indent=1,sort_keys=True)
+    os.replace(tmp_path,path)
+
+
+def project_fingerprints(projects,file_hashes):
+    """Hash the inputs of each project, along with the fingerprints of the projects it references and CONFIG
+
+    'file_hashes' caches the file hashes by path, mtime and size, so unchanged files aren't re-read
+    """
+    fingerprints={}
+
+    def fingerprint(proj):
+        if proj.name not in fingerprints:
+            h=hashlib.sha1(CONFIG.encode())
+            for path in proj.inputs():
+                h.update(unix_path(os.path.relpath(path,SOLUTION_DIR)).encode())
+                h.update(file_hash(path,file_hashes).encode())
+            for ref in proj.references:
+                h.update(fingerprint(projects[ref]).encode())
+            fingerprints[proj.name]=h.hexdigest()
+        return fingerprints[proj.name]
+
+    for proj in projects.values():
+        fingerprint(proj)
+    return fingerprints
+
+
+def file_hash(path,file_hashes):
+    key=unix_path(os.path.relpath(path,SOLUTION_DIR))
+    stat=os.stat(path)
+    cached=file_hashes.get(key)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    file_hashes[key]=[stat.st_mtime_ns,stat.st_size,hash_file(path)]
+    return file_hashes[key][2]
+
+
+MSBUILD_NS='{http://schemas.microsoft.com/developer/msbuild/2003}'
+
+class Project:
+    """A project in the solution, as read from its .csproj"""
+
+    def __init__(self, name, csproj):
+        self.name = name
+        self.csproj = csproj
+        self.dir = os.path.dirname(csproj)
+
+        root=ElementTree.parse(csproj).getroot()
+        def includes(item):
+            return [os.path.normpath(os.path.join(self.dir,os_path(e.get('Include')))) for e in root.iter(MSBUILD_NS + item)]
+
+        self.references = [os.path.splitext(os.path.basename(path))[0] for path in includes('ProjectReference')]
+        #compiled files from outside the project dir, as in ../BuildVersionAssemblyInfo.cs
+        self.linked_sources = [path for path in includes('Compile') if not path.startswith(self.dir + os.sep)]
+        output_type=root.findtext('.//' + MSBUILD_NS + 'OutputType')
+        self.assembly = (root.findtext('.//' + MSBUILD_NS + 'AssemblyName') or name) + ('.exe' if output_type in ('Exe','WinExe') else '.dll')
+
+    def output(self, config):
+        return os.path.join(self.dir,'bin',config,self.assembly)
+
+    def inputs(self):
+        """All the files which go into building this project"""
+        paths=[self.csproj] + [path for path in self.linked_sources if os.path.isfile(path)]
+        packages_config=os.path.join(self.dir,'packages.config')
+        if os.path.isfile(packages_config):
+            paths.append(packages_config)
+        bin_dir=os.path.join(self.dir,'bin') + os.sep
+        for path,name in file_index(SOLUTION_DIR).find('.cs'):
+            if path.startswith(self.dir + os.sep) and not path.startswith(bin_dir):
+                paths.append(path)
+        return sorted(paths)
+
+
+solution_projects={}
+#mtime and size of the .sln and .csproj files the projects were read from, as the daemon outlives any one build
+solution_stamps={}
+
+
+def load_projects():
+    """Return the projects in the solution by name, in the order the solution lists them.
+
+    Read again if the solution or any project file has changed since last read
+    """
+    with tasks_lock:
+        if not solution_stamps or any(file_stamp(path) != stamp for path,stamp in solution_stamps.items()):
+            solution_projects.clear()
+            solution_stamps.clear()
+            sln=os.path.join(SOLUTION_DIR,SOLUTION)
+            solution_stamps[sln]=file_stamp(sln)
+            text=open(sln).read()
+            for name,path in re.findall(r'Project\("\{[^}]+\}"\)\s*=\s*"([^"]+)",\s*"([^"]+\.csproj)"',text):
+                project=Project(name,os.path.join(SOLUTION_DIR,os_path(path)))
+                solution_stamps[project.csproj]=file_stamp(project.csproj)
+                solution_projects[name]=project
+    return solution_projects
+
+
+def build_order(projects):
+    """Return the project names ordered so each project comes after the projects it references"""
+    order=[]
+    def visit(name):
+        if name not in order:
+            for ref in projects[name].references:
+                visit(ref)
+            order.append(name)
+    for name in projects:
+        visit(name)
+    return order
+
+
+def reference_closure(name):
+    """Return the project and all the projects it references, directly or not, by name"""
+    projects=load_projects()
+    closure={}
+    def visit(name):
+        if name not in closure:
+            closure[name]=projects[name]
+            for ref in projects[name].references:
+                visit(ref)
+    visit(name)
+    return closure
+
+
+#the projects affected by the changes since each git ref, for this build
+affected_by_ref={}
+#the projects affected by the files changed, as seen by task watch, for this build
+watch_projects=None
+
+def affected(names):
+    """Return the names of the projects affected by the changes since the git ref AFFECTED, or all if it isn't set"""
+    if watch_projects is not None:
+        hit=watch_projects
+    elif AFFECTED:
+        hit=affected_projects(AFFECTED)
+    else:
+        return list(names)
+    return [name for name in names if name in hit]
+
+
+def affected_projects(base):
+    """Return the names of the projects with files changed since the git ref 'base', and all those which depend on them.
+
+    Changes are taken from where HEAD branched from 'base', and include uncommitted and untracked files.
+    A change to the solution or NuGet.Config affects every project
+    """
+    with tasks_lock:
+        if base not in affected_by_ref:
+            paths=[os.path.join(SOLUTION_DIR,os_path(path)) for path in changed_files(base)]
+            hit=projects_changed(paths)
+            log('projects affected by changes since {}: {}'.format(base,', '.join(sorted(hit)) or 'none'))
+            affected_by_ref[base]=hit
+        return affected_by_ref[base]
+
+
+def projects_changed(paths):
+    """Return the names of the projects the changed files are part of, and all those which depend on them.
+
+    A change to the solution or NuGet.Config affects every project
+    """
+    projects=load_projects()
+    solution_wide={os.path.join(SOLUTION_DIR,SOLUTION),os.path.normpath(NUGET_CONFIG)}
+    hit=set()
+    for path in paths:
+        path=os.path.normpath(path)
+        for proj in projects.values():
+            #the built output isn't a change to the project
+            if path.startswith((os.path.join(proj.dir,'bin') + os.sep,os.path.join(proj.dir,'obj') + os.sep)):
+                continue
+            if path in solution_wide or path.startswith(proj.dir + os.sep) or path in proj.linked_sources:
+                hit.add(proj.name)
+    #each project comes after its references, so one pass finds all the dependents
+    for name in build_order(projects):
+        if any(ref in hit for ref in projects[name].references):
+            hit.add(name)
+    return hit
+
+
+def changed_files(base):
+    """Return the paths, relative to the solution dir, of the files changed since HEAD branched from the git ref 'base'"""
+    def git(*args):
+        proc=subprocess.run(['git'] + list(args),cwd=SOLUTION_DIR,stdout=subprocess.PIPE,stderr=subprocess.PIPE,universal_newlines=True)
+        if proc.returncode != 0:
+            raise BuildError('git {} failed: {}'.format(' '.join(args),proc.stderr.strip()))
+        return proc.stdout.splitlines()
+    merge_base=git('merge-base',base,'HEAD')[0]
+    return git('diff','--name-only','--relative',merge_base) + git('ls-files','--others','--exclude-standard')
+
+
+test_runs={}
+
+
+def test_fixtures(proj):
+    """Return the full names of the project's test fixtures, as read from its sources. Raises BuildError if some
+    can't be found by reading them"""
+    return source_fixtures(load_projects()[proj].inputs())
+
+
+def record_fixture_durations(proj,result_file):
+    durations=fixture_durations(result_file)
+    if durations:
+        with tasks_lock:
+            cache=load_cache('test-durations')
+            #replaced rather than added to, so fixtures since removed drop out
+            cache[proj]=durations
+            save_cache('test-durations',cache)
+
+
+class LocalTestWorker:
+    """Runs shards of tests as nunit-console processes on this machine"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def run(self, proj, fixtures, result_file):
+        """Run the fixtures, writing their results to 'result_file'. Return False if the worker couldn't be used"""
+        win_invoke(NUNIT_CONSOLE_EXE,['-nologo','-result:' + result_file,'-run:' + ','.join(fixtures),proj + '.dll'],
+            cwd=os.path.join(SOLUTION_DIR,proj,'bin',CONFIG))
+        return True
+
+
+class RemoteTestWorker:
+    """Runs shards of tests on a test-worker agent, over a connection carrying a line of json each way: the request,
+    then the agent's output, exit code and NUnit results"""
+
+    def __init__(self, address):
+        self.name = address
+        host,_,port = address.rpartition(':')
+        self.address = (host or 'localhost',int(port))
+
+    def run(self, proj, fixtures, result_file):
+        try:
+            conn=socket.create_connection(self.address,timeout=10)
+        except OSError as e:
+            log("couldn't reach test worker {} : {}".format(self.name,e.strerror or e))
+            return False
+        with conn:
+            conn.sendall((json.dumps({'token':TEST_WORKER_TOKEN or '','proj':proj,'config':CONFIG,'key':test_cache_key(proj),
+                'fixtures':fixtures}) + '\n').encode('utf-8'))
+            #wait a sec at a time, so a cancelled build doesn't wait for the shard to finish
+            conn.settimeout(None)
+            while not select.select([conn],[],[],1.0)[0]:
+                if cancelled.is_set():
+                    raise BuildError('build cancelled, left test worker {} running'.format(self.name))
+            reply=conn.makefile('r',encoding='utf-8').readline()
+        if not reply:
+            log('lost the connection to test worker ' + self.name)
+            return False
+        reply=json.loads(reply)
+        write_out(reply.get('out',''))
+        if reply.get('result'):
+            with open(result_file,'w',encoding='utf-8') as f:
+                f.write(reply['result'])
+        if reply['exit']:
+            raise BuildError('on test worker {} : {}'.format(self.name,reply['error']))
+        return True
+
+
+def serve_test_shard(conn):
+    """Run the fixtures a test_workers client has sent, and send back the output and NUnit results. Nothing is run
+    for a client which hasn't sent TEST_WORKER_TOKEN"""
+    with conn:
+        request=conn.makefile('r',encoding='utf-8').readline()
+        if not request:
+            return
+        try:
+            request=json.loads(request)
+        except ValueError:
+            return
+        proj=str(request.get('proj'))
+        refused=None
+        if not TEST_WORKER_TOKEN or not hmac.compare_digest(str(request.get('token') or '').encode('utf-8'),TEST_WORKER_TOKEN.encode('utf-8')):
+            refused='not sent the test_worker_token'
+        elif proj not in TEST_PROJECTS:
+            refused='{} is not a test project'.format(proj)
+        if refused:
+            log('refused a shard of tests, ' + refused)
+            with contextlib.suppress(OSError):
+                conn.sendall((json.dumps({'out':'','exit':1,'error':'refused, ' + refused,'result':None}) + '\n').encode('utf-8'))
+            return
+        result_file=os.path.join(TEST_RESULTS_DIR,'worker','{}.{}.{}.xml'.format(proj,threading.get_ident(),time.time_ns()))
+        ensure_dir_exists(result_file)
+        task_output.buffer=[]
+        error=None
+        try:
+            if request['config'] != CONFIG or request['key'] != test_cache_key(proj):
+                raise BuildError('{} here is not built the same as the client\'s ({})'.format(proj,CONFIG))
+            log('running {} fixtures of {}'.format(len(request['fixtures']),proj))
+            LocalTestWorker('').run(proj,request['fixtures'],result_file)
+        except BuildError as e:
+            error=e.msg
+        finally:
+            output=''.join(task_output.buffer)
+            task_output.buffer=None
+        result=None
+        if os.path.isfile(result_file):
+            with open(result_file,encoding='utf-8') as f:
+                result=f.read()
+            os.remove(result_file)
+        write_out(output)
+        with contextlib.suppress(OSError):
+            conn.sendall((json.dumps({'out':output,'exit':1 if error else 0,'error':error,'result':result}) + '\n').encode('utf-8'))
+
+
+def test_workers():
+    if TEST_WORKERS:
+        return [RemoteTestWorker(address.strip()) for address in TEST_WORKERS.split(',') if address.strip()]
+    return [LocalTestWorker('local-' + str(i + 1)) for i in range(int(TEST_SHARDS))]
+
+
+def run_sharded_tests(proj,run,result_file):
+    """Run the project's test fixtures split across the test workers, and merge their results into 'result_file'.
+    Return False if there's nothing to split them by, as before the project's tests have ever been run, or if its
+    fixtures can't all be found in its sources.
+
+    Fixtures are packed into a shard per worker by how long each took last time. A worker runs its shard as
+    nunit runs of about TEST_BATCH_SECS, and once it's finished takes over the later half of what's left of the
+    shard with the most left to run, so a shard running long is split again among the workers which are free
+    """
+    with tasks_lock:
+        durations=load_cache('test-durations').get(proj,{})
+    if not durations:
+        return False
+    #the sources are read for the fixtures new since last time, which are guessed at taking the average. When they
+    #can't all be found there, shards could leave some out, so the tests are run in one go instead
+    try:
+        fixtures=test_fixtures(proj)
+    except BuildError as e:
+        log("running the tests of {} in one go, its fixtures can't be sharded by name: {}".format(proj,e.msg))
+        return False
+    if not fixtures:
+        log('running the tests of {} in one go, no test fixtures were found in its sources'.format(proj))
+        return False
+    fixtures=set(fixtures) | set(durations)
+    average=sum(durations.values()) / len(durations)
+    weights={fixture:durations.get(fixture,average) for fixture in fixtures}
+    workers=test_workers()
+    queues=pack_shards(weights,len(workers))
+    shards_dir=os.path.join(TEST_RESULTS_DIR,proj + '.shards')
+    shutil.rmtree(shards_dir,ignore_errors=True)
+    os.makedirs(shards_dir)
+    log('running {} fixtures of {} in {} shards of {}'.format(len(fixtures),proj,len(queues),
+        ', '.join('{:.1f}s'.format(sum(weights[fixture] for fixture in queue)) for queue in queues)))
+
+    lock=threading.Lock()
+    result_files=[]
+    errors=[]
+
+    def work(i):
+        worker=workers[i]
+        while True:
+            with lock:
+                if not queues[i]:
+                    longest=max(range(len(queues)),key=lambda j: sum(weights[fixture] for fixture in queues[j]))
+                    left=queues[longest]
+                    if not left:
+                        return
+                    #the later, shorter, fixtures adding up to half its time
+                    split,taken,total=len(left),0.0,sum(weights[fixture] for fixture in left)
+                    while split > 0 and taken < total / 2:
+                        split-=1
+                        taken+=weights[left[split]]
+                    queues[i]=left[split:]
+                    del left[split:]
+                    log('{} takes over {} fixtures ({:.1f}s) from the shard of {}'.format(worker.name,len(queues[i]),
+                        sum(weights[fixture] for fixture in queues[i]),workers[longest].name))
+                batch=[queues[i].pop(0)]
+                while queues[i] and sum(weights[fixture] for fixture in batch + queues[i][:1]) <= float(TEST_BATCH_SECS):
+                    batch.append(queues[i].pop(0))
+                batch_file=os.path.join(shards_dir,'{}.{}.xml'.format(len(result_files),re.sub(r'\W','_',worker.name)))
+                result_files.append(batch_file)
+            log('{} running {} fixtures ({:.1f}s)'.format(worker.name,len(batch),sum(weights[fixture] for fixture in batch)))
+            try:
+                ran=worker.run(proj,batch,batch_file)
+            except BuildError as e:
+                #a cancelled build stops here, otherwise carry on and report the failure in the summary
+                if cancelled.is_set():
+                    raise
+                ran=True
+                errors.append(e.msg)
+            if not ran:
+                #leave what this worker had for the others to take over
+                with lock:
+                    queues[i][:0]=batch
+                return
+
+    run_concurrently(work,range(len(workers)))
+    unrun=[fixture for queue in queues for fixture in queue]
+    if unrun:
+        errors.append('no test workers left to run {} fixtures'.format(len(unrun)))
+    if errors:
+        run.error='; '.join(errors)
+    merge_test_results(result_files,result_file)
+    return True
+
+
+def test_cache_key(proj):
+    """Hash the test assembly and everything alongside it it may load, along with what affects which tests are run"""
+    bin_dir=os.path.join(SOLUTION_DIR,proj,'bin',CONFIG)
+    h=hashlib.sha1('|'.join([proj,CONFIG,str(TESTS or ''),NUNIT_VERSION]).encode())
+    with tasks_lock:
+        cache=load_cache('tests')
+        file_hashes=cache.setdefault('files',{})
+        for name in sorted(os.listdir(bin_dir)) if os.path.isdir(bin_dir) else []:
+            if name.endswith(('.dll','.exe','.config')):
+                h.update(name.encode())
+                h.update(file_hash(os.path.join(bin_dir,name),file_hashes).encode())
+        save_cache('tests',cache)
+    return h.hexdigest()
+
+
+def restore_test_result(cache_key,result_file,coverage_file=None):
+    """Copy the results of a previous passing run of the same tests to 'result_file', and its coverage to
+    'coverage_file' if given. Return whether there was one"""
+    with tasks_lock:
+        cache=load_cache('tests')
+        entry=cache.get('results',{}).get(cache_key)
+        cached_file=os.path.join(BUILD_CACHE_DIR,'test-results',cache_key + '.xml')
+        cached_coverage=os.path.join(BUILD_CACHE_DIR,'test-results',cache_key + '.coverage.xml')
+        if not entry or not os.path.isfile(cached_file):
+            return False
+        if coverage_file and (entry.get('coverage') != OPENCOVER_VERSION or not os.path.isfile(cached_coverage)):
+            return False
+        shutil.copyfile(cached_file,result_file)
+        if coverage_file:
+            shutil.copyfile(cached_coverage,coverage_file)
+        entry['used']=time.time()
+        save_cache('tests',cache)
+        return True
+
+
+def store_test_result(cache_key,result_file,coverage_file=None):
+    """Keep the results, and any coverage, of a passing run, evicting the least recently used results to stay
+    under TEST_CACHE_MAX_MB"""
+    with tasks_lock:
+        cache=load_cache('tests')
+        results=cache.setdefault('results',{})
+        cache_dir=os.path.join(BUILD_CACHE_DIR,'test-results')
+        ensure_dir_exists(cache_dir + os.sep)
+        shutil.copyfile(result_file,os.path.join(cache_dir,cache_key + '.xml'))
+        cached_coverage=os.path.join(cache_dir,cache_key + '.coverage.xml')
+        #a run without coverage keeps the coverage of an earlier run of the same tests
+        coverage=results.get(cache_key,{}).get('coverage') if os.path.isfile(cached_coverage) else None
+        if coverage_file:
+            shutil.copyfile(coverage_file,cached_coverage)
+            coverage=OPENCOVER_VERSION
+        size=os.path.getsize(result_file) + (os.path.getsize(cached_coverage) if coverage else 0)
+        results[cache_key]={'size':size,'used':time.time(),'coverage':coverage}
+
+        max_bytes=float(TEST_CACHE_MAX_MB) * 1024 * 1024
+        total=sum(entry['size'] for entry in results.values())
+        for key in sorted(results,key=lambda k: results[k]['used']):
+            if total <= max_bytes or key == cache_key:
+                break
+            total-=results.pop(key)['size']
+            for name in (key + '.xml',key + '.coverage.xml'):
+                try:
+                    os.remove(os.path.join(cache_dir,name))
+                except OSError:
+                    pass
+        save_cache('tests',cache)
+
+
+def test_summary(projects):
+    if TEST_SKIP:
+       log('tests are set to skip')
+       return
+    runs=[test_runs[proj] for proj in projects if proj in test_runs]
+    if not runs:
+        return
+
+    log('test summary:')
+    for run in runs:
+        log('\t' + run.describe())
+    if len(runs) > 1:
+        wall_time=max(run.finished for run in runs) - min(run.started for run in runs)
+        serial_time=sum(run.seconds() for run in runs)
+        log('{} test runs took {:.1f}s, vs {:.1f}s run one after another (saved {:.1f}s)'.format(len(runs),wall_time,serial_time,max(0.0,serial_time - wall_time)))
+        
+    failed=[run.proj for run in runs if not run.passed()]
+    if failed:
+        raise BuildError('tests failed in ' + ','.join(failed))
+
+
+def coverage_summary(projects):
+    """Merge the coverage of all the test projects and generate the one report from it, then summarise the tests"""
+    coverage_files=[path for path in (os.path.join(TEST_RESULTS_DIR,proj + '.coverage.xml') for proj in projects) if os.path.isfile(path)]
+    if coverage_files:
+        merged_file=os.path.join(TEST_RESULTS_DIR,'coverage.xml')
+        log('merging coverage of {} test projects into {}'.format(len(coverage_files),merged_file))
+        merge_coverage(coverage_files,merged_file)
+        log('generating coverage report in ' + COVERAGE_REPORT_DIR)
+        win_invoke(REPORTGEN_EXE,[
+            '-reports:' + merged_file,
+            '-targetdir:' + COVERAGE_REPORT_DIR,
+            '-reporttypes:Html' ])
+    test_summary(projects)
+
+
+def collect_perf_metrics(metrics_dir,since):
+    """Copy the metrics files written since the given time into a new dir under PERF_RESULTS_DIR, returning their paths"""
+    if not os.path.isdir(metrics_dir):
+        return []
+    run_dir=os.path.join(PERF_RESULTS_DIR,time.strftime('%Y%m%d-%H%M%S',time.localtime(since)))
+    collected=[]
+    for name in sorted(os.listdir(metrics_dir)):
+        path=os.path.join(metrics_dir,name)
+        if name.endswith('.csv') and os.path.getmtime(path) >= since - 1:
+            ensure_dir_exists(run_dir + os.sep)
+            shutil.copy(path,run_dir)
+            collected.append(os.path.join(run_dir,name))
+            log('collected metrics ' + collected[-1])
+    return collected
+
+
+def load_perf_baseline():
+    try:
+        with open(PERF_BASELINE) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+
+def latest_perf_metrics():
+    found=[]
+    find_files(PERF_RESULTS_DIR,lambda path,name: found.append(path),['.csv'])
+    return max(found,key=os.path.getmtime) if found else None
+
+
+def nuget_sources(src=None):
+    """The -Source args for nuget, NUGET_FEED first when given. Without either nuget uses those in its config"""
+    sources=[NUGET_FEED] if NUGET_FEED else []
+    if src or NUGET_FEED:
+        #the feed only has the local repo's packages, so not the only source
+        sources.append(src or NUGET_SRC)
+    return [arg for source in sources for arg in ('-Source',source)]
+
+
+def read_packages_config(path):
+    """Return the (id,version) of each package in a packages.config"""
+    return [(pkg.get('id'),pkg.get('version')) for pkg in ElementTree.parse(path).getroot().iter('package')]
+
+
+def restore_package(pkg):
+    """Hardlink the package into packages/ from NUGET_CACHE, adding it to the cache from the mirror or nuget first if need be"""
+    pkg_id,version=pkg
+    name=pkg_id + '.' + version
+    cached=os.path.join(NUGET_CACHE,name)
+    if not os.path.isfile(os.path.join(cached,name + '.nupkg')):
+        mirrored=find_in_mirror(pkg_id,version)
+        if mirrored:
+            log('caching {} from {}'.format(name,mirrored))
+            extract_nupkg(mirrored,cached)
+        elif OFFLINE:
+            raise BuildError("couldn't restore nuget pkg " + name + ". Offline, and it's not in the mirror " + NUGET_MIRROR)
+        else:
+            log('downloading ' + name)
+            download_package(pkg_id,version,cached)
+        #named as in the packages.config, as nuget restore does, whatever the case of the package's own id
+        for file_name in os.listdir(cached):
+            if file_name.lower() == name.lower() + '.nupkg':
+                os.replace(os.path.join(cached,file_name),os.path.join(cached,name + '.nupkg'))
+    log('restored ' + name)
+    link_tree(cached,os.path.join(NUGET_PKG_DIR,name))
+
+
+def download_package(pkg_id,version,dest,src=None):
+    """nuget install the package as dir 'dest', adding it to the mirror"""
+    name=pkg_id + '.' + version
+    #each to its own dir, as concurrent installs into the one dir trip over each other
+    download_dir='{}.{}.{}.download'.format(dest,os.getpid(),threading.get_ident())
+    shutil.rmtree(download_dir,ignore_errors=True)
+    config=['-ConfigFile',os_path(NUGET_CONFIG)] if os.path.isfile(NUGET_CONFIG) else []
+    nuget_invoke(['install',pkg_id,'-Version',version,'-Prerelease','-NonInteractive','-OutputDirectory',download_dir]
+        + config + nuget_sources(src),include_optons=False)
+    installed=[dir_name for dir_name in os.listdir(download_dir) if dir_name.lower() == name.lower()]
+    if not installed:
+        raise BuildError("couldn't install nuget pkg " + name + ', nuget installed ' + ', '.join(os.listdir(download_dir)))
+    add_to_mirror(os.path.join(download_dir,installed[0],installed[0] + '.nupkg'))
+    shutil.rmtree(dest,ignore_errors=True)
+    os.replace(os.path.join(download_dir,installed[0]),dest)
+    shutil.rmtree(download_dir,ignore_errors=True)
+
+
+def link_tree(src,dest):
+    """Recreate dir 'src' as 'dest', each file hardlinked (or where it can't be, copied)"""
+    tmp_dir='{}.{}.{}.tmp'.format(dest,os.getpid(),threading.get_ident())
+    shutil.rmtree(tmp_dir,ignore_errors=True)
+    for root,dirs,files in os.walk(src):
+        target_dir=os.path.join(tmp_dir,os.path.relpath(root,src))
+        os.makedirs(target_dir,exist_ok=True)
+        for name in files:
+            link_or_copy(os.path.join(root,name),os.path.join(target_dir,name))
+    shutil.rmtree(dest,ignore_errors=True)
+    os.replace(tmp_dir,dest)
+
+
 def nuget_install_if_not_exists(pkg,version,exe_name,fix_permission=True):
     exe=os_path('{base}/packages/{pkg}.{ver}/tools/{name}'.format(base=SOLUTION_DIR,ver=version,pkg=pkg,name=exe_name))
 
     if not os.path.isfile(exe):
-        log("downloading " + pkg + "-" + version)
-        nuget_invoke(['install',pkg,'-Source',NUGET_SRC,'-Version',version, '-Prerelease'])
+        mirrored=find_in_mirror(pkg,version)
+        if mirrored:
+            log("installing " + pkg + "-" + version + " from " + mirrored)
+            extract_nupkg(mirrored,os.path.join(NUGET_PKG_DIR,pkg + '.' + version))
+        elif OFFLINE:
+            raise BuildError("couldn't install nuget pkg " + pkg + ", version " + version + ". Offline, and it's not in the mirror " + NUGET_MIRROR + ". Run task 'mirror-seed' to add it")
+        else:
+            log("downloading " + pkg + "-" + version)
+            #find_toolchain installs the tools concurrently, so each is downloaded to its own dir first
+            download_package(pkg,version,os.path.join(NUGET_PKG_DIR,pkg + '.' + version),NUGET_SRC)
     
     if not os.path.isfile(exe):
-        raise BuildError("couldn't install nuget pkg " + pkg + ", version " + version + ". Looking for " + exe + ". Tried to install from " + NUGET_SRC)   
+        raise BuildError("couldn't install nuget pkg " + pkg + ", version " + version + ". Looking for " + exe + ". Tried to install from " + (NUGET_MIRROR if OFFLINE else NUGET_SRC))   
 
     # fix issue where if not specified the exe will be run with dotnet 3.5 why does not like running apps from shares
     if is_windows() and fix_permission:
@@ -369,25 +1829,76 @@ def nuget_install_if_not_exists(pkg,version,exe_name,fix_permission=True):
     return exe
 
 
-def nuget_pack(projName):
-    depends('build', 'version')
+def find_in_mirror(pkg,version):
+    """Return the path of the package's .nupkg in NUGET_MIRROR, or None"""
+    wanted=(pkg + '.' + version + '.nupkg').lower()
+    if os.path.isdir(NUGET_MIRROR):
+        for name in os.listdir(NUGET_MIRROR):
+            if name.lower() == wanted:
+                return os.path.join(NUGET_MIRROR,name)
+    return None
+
+
+def add_to_mirror(nupkg):
+    if os.path.isfile(nupkg):
+        ensure_dir_exists(NUGET_MIRROR)
+        target=os.path.join(NUGET_MIRROR,os.path.basename(nupkg))
+        if not os.path.isfile(target):
+            log('adding {} to mirror {}'.format(os.path.basename(nupkg),NUGET_MIRROR))
+            shutil.copyfile(nupkg,target + '.tmp')
+            os.replace(target + '.tmp',target)
+
 
+def nuget_pack(projName):
+    """Write the project's main and symbols packages, as 'nuget pack' and 'nuget pack -Symbols' would, in one pass
+    over the files its nuspec lists. The same files and version always give byte for byte the same packages"""
     log('packing ' + projName)
+    proj_dir=os.path.join(SOLUTION_DIR,projName)
+    #the replacement tokens nuget pack fills in from -Version and -Prop Configuration=
+    text=filter_template(os.path.join(proj_dir,projName + '.nuspec.template')) \
+        .replace('$version$',VERSION) \
+        .replace('$configuration$',CONFIG)
+    manifest=ElementTree.fromstring(text)
+    #some templates give the nuspec namespace and some don't
+    for elem in manifest.iter():
+        elem.tag=elem.tag.rpartition('}')[2]
+    metadata=manifest.find('metadata')
+    metadata.find('version').text=VERSION
+    files=nuspec_files(proj_dir,manifest.find('files'))
+    if manifest.find('files') is not None:
+        manifest.remove(manifest.find('files'))
+
+    name='{}.{}'.format(metadata.findtext('id'),VERSION)
+    with NupkgWriter(os.path.join(proj_dir,name + '.nupkg'),manifest) as main, \
+            NupkgWriter(os.path.join(proj_dir,name + '.symbols.nupkg'),manifest) as symbols:
+        for target,path in files:
+            with open(path,'rb') as f:
+                data=f.read()
+            symbols.add(target,data)
+            #as with 'nuget pack -Symbols', the main package leaves out the debug symbols and sources
+            if not (target.lower().endswith('.pdb') or target.lower().startswith('src/')):
+                main.add(target,data)
+    log('packed {} and {}'.format(main.path,symbols.path))
+
+
+def nuget_invoke(args=None,include_optons=True,cwd=None):
+    global NUGET_EXE
+    with tasks_lock:
+        find_nuget()
 
-    with cd(projName):
-        filter_template(projName + '.nuspec.template', projName + '.nuspec')
-        log('building main nuget package')
-        nuget_invoke(['pack', projName + '.nuspec', '-Prop', 'Configuration=' + CONFIG,'-Version',VERSION],include_optons=False)
-  
-        log('building symbols nuget package')
-        nuget_invoke(['pack', projName + '.nuspec', '-Symbols', '-Prop', 'Configuration=' + CONFIG,'-Version',VERSION],include_optons=False)  
+    nu_args=[]
+    if args:
+        nu_args+=args
+    if include_optons:
+        nu_args+=['-OutputDir',os_path(NUGET_PKG_DIR),'-NonInteractive']    
+        if os.path.isfile(NUGET_CONFIG):
+            nu_args+=['-ConfigFile', os_path(NUGET_CONFIG)]
 
-        os.remove(projName + '.nuspec')
- 
-        #todo: gitlink
+    log('running nuget:' + NUGET_EXE)
+    win_invoke(NUGET_EXE, nu_args, cwd=cwd)
 
 
-def nuget_invoke(args=None,include_optons=True):
+def find_nuget():
     global NUGET_EXE
     if not NUGET_EXE:
         if os.path.isfile(SOLUTION_DIR + '/.nuget/NuGet.exe'):
@@ -402,33 +1913,97 @@ def nuget_invoke(args=None,include_optons=True):
         else:
             raise BuildError('Could not find any installed nuget')
 
-    nu_args=[]
-    if args:
-        nu_args+=args
-    if include_optons:
-        nu_args+=['-OutputDir',os_path(NUGET_PKG_DIR),'-NonInteractive']    
-        if os.path.isfile(NUGET_CONFIG):
-            nu_args+=['-ConfigFile', os_path(NUGET_CONFIG)]
-
-    log('running nuget:' + NUGET_EXE)
-    win_invoke(NUGET_EXE, nu_args)
-
 
 def copy_pkgs_to_local_repo():
     log('copying nuget packages to local test repo ' + LOCAL_REPO)
-    ensure_dir_exists(LOCAL_REPO)
+    repo=LocalRepo(LOCAL_REPO)
+    cache=load_cache('local-repo')
+    file_hashes=cache.setdefault('files',{})
 
     def onfile(path,name):
-        if name.endswith('.nupkg') and name.startswith('TestFirst.Net.'):
-            log("\tcopying : " + name)
-            shutil.copy(str(path),LOCAL_REPO)
-    find_files(SOLUTION_DIR,onfile)
+        if name.startswith('TestFirst.Net.'):
+            if repo.add(path,file_hash(path,file_hashes)):
+                log("\tadded : " + name)
+            else:
+                log("\tunchanged : " + name)
+    find_files(SOLUTION_DIR,onfile,['.nupkg'])
+    if int(LOCAL_REPO_KEEP) > 0:
+        repo.prune(int(LOCAL_REPO_KEEP))
+    repo.save()
+    save_cache('local-repo',cache)
 
     log('packages in local repo are:')
-    def print_name(path,name):
-        if name.endswith('.nupkg'):
-            log('\t' + name)
-    find_files(LOCAL_REPO,print_name)
+    for name,entry in repo.packages():
+        log('\t' + name)
+
+
+def output_cache_key(proj,fingerprint):
+    """What the project's built outputs depend on: its inputs (as its fingerprint hashes them, along with CONFIG and
+    the projects it references) and the compiler versions. Unlike toolchain_id(), not where the tools are installed,
+    so the key is the same on every machine"""
+    compilers=[name for name in ('MSBUILD_EXE' if MSBUILD_EXE else 'XBUILD_EXE','MONO_EXE') if globals()[name]]
+    return hashlib.sha256('|'.join([proj,fingerprint,CONFIG] + ['{}={}'.format(name,toolchain_versions.get(name,'unknown'))
+        for name in compilers]).encode('utf-8')).hexdigest()
+
+
+def remote_output_cache():
+    """The cache at REMOTE_CACHE: a dir, or the url of a cache-server. None if there isn't one"""
+    if not REMOTE_CACHE:
+        return None
+    if REMOTE_CACHE.startswith(('http://','https://')):
+        return HttpOutputCache(REMOTE_CACHE,CACHE_SERVER_TOKEN)
+    return DirOutputCache(REMOTE_CACHE,float(REMOTE_CACHE_MAX_MB) * 1024 * 1024)
+
+
+def trash(path,packages=False):
+    """Move the file or dir out of the way into TRASH_DIR, to be deleted later by empty_trash().
+
+    Only what's under the solution dir is moved, and never the nuget packages dir (unless 'packages') or the local repo
+    """
+    path=os.path.abspath(path)
+    if not os.path.lexists(path):
+        return
+    solution_dir=os.path.abspath(SOLUTION_DIR)
+    protected=[os.path.abspath(TRASH_DIR),os.path.abspath(LOCAL_REPO),os.path.abspath(BUILD_CACHE_DIR)]
+    if not packages:
+        protected.append(os.path.abspath(NUGET_PKG_DIR))
+    if not path.startswith(solution_dir + os.sep) or any(path == other or path.startswith(other + os.sep) or other.startswith(path + os.sep)
+            for other in protected):
+        raise BuildError("won't remove {}, it's outside the solution dir or holds the packages, local repo or build cache".format(path))
+    ensure_dir_exists(TRASH_DIR + os.sep)
+    #unique, as the same dir is trashed again by each clean, maybe before the last is deleted
+    target=os.path.join(TRASH_DIR,'{}.{}.{}'.format(os.path.relpath(path,solution_dir).replace(os.sep,'_'),os.getpid(),time.time_ns()))
+    try:
+        os.rename(path,target)
+    except OSError as e:
+        #across drives, or locked (on windows), so just delete it now
+        log("couldn't move {} into the trash ({}), deleting it".format(path,e.strerror))
+        remove_tree(path)
+
+
+def empty_trash():
+    """Delete what's in the trash, in a background reaper process unless CLEAN_WAIT"""
+    if not os.path.isdir(TRASH_DIR) or not os.listdir(TRASH_DIR):
+        return
+    if CLEAN_WAIT:
+        task_reap_trash()
+        return
+    reaper_log=os.path.join(BUILD_CACHE_DIR,'reaper.log')
+    ensure_dir_exists(reaper_log)
+    with open(reaper_log,'w') as out:
+        reaper=subprocess.Popen([sys.executable,os.path.realpath(__file__),'reap-trash','trash_dir=' + TRASH_DIR,'clean_jobs=' + str(CLEAN_JOBS),
+            #its trace would replace the build's own
+            'trace=false'],
+            cwd=SOLUTION_DIR,stdin=subprocess.DEVNULL,stdout=out,stderr=subprocess.STDOUT,start_new_session=True)
+    log('deleting {} in the background (pid {})'.format(TRASH_DIR,reaper.pid))
+
+
+def remove_tree(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path,ignore_errors=True)
+    else:
+        with contextlib.suppress(OSError):
+            os.remove(path)
 
 
 def only_under_windows(msg):
@@ -436,36 +2011,66 @@ def only_under_windows(msg):
         raise BuildError(msg + ' only works correctly under windows')
 
 
-def find_files(path,callback):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            full=os.path.join(root, file)
-            callback(full,file)
+def find_files(path,callback,suffixes=None):
+    """Call callback(path,name) for each file under 'path', or only those ending with one of the 'suffixes'"""
+    for full,name in file_index(path).find(*(suffixes or [])):
+        callback(full,name)
+
+
+file_indexes={}
 
+def file_index(path):
+    """Return the FileIndex for the dir, built on first use and kept for the rest of the run"""
+    root=os.path.abspath(path)
+    with tasks_lock:
+        if root not in file_indexes:
+            file_indexes[root]=FileIndex(root,INDEX_PRUNE_DIRS)
+        return file_indexes[root]
 
-#filter a template (replace tokens)
-def filter_template(fromPath,toPath):
-    log("filtering template {} to {}".format(fromPath,toPath))
 
-    #convert html entities into something the nuspec parser can handle
+def file_watcher(root):
+    """Return a watcher of the files under the dir, using inotify where it can and polling otherwise.
+
+    The dirs the build writes its own results to are left out
+    """
+    ignore=[os.path.abspath(path) for path in (BUILD_CACHE_DIR,TEST_RESULTS_DIR,PERF_RESULTS_DIR,TRASH_DIR)]
+    if not WATCH_POLL:
+        try:
+            return InotifyWatcher(root,INDEX_PRUNE_DIRS + ['bin'],ignore,os.path.join(SOLUTION_DIR,SOLUTION))
+        except OSError as e:
+            log('inotify not available ({}), polling for changes instead'.format(e))
+    return PollWatcher(file_index(root),ignore,float(WATCH_POLL_SECS))
+
+
+#filter a template (replace tokens), returning the text rather than writing it out, as nuget_pack packs it in memory.
+#[/] becomes / on every os, as the nuspec's paths are package (zip) paths and urls, not paths on this machine
+def filter_template(fromPath):
+    #convert html entities into something the nuspec parser can handle. & too, which would otherwise start an entity
     def filter_html(html):
-        return html.replace('<','&#8249;').replace('>','&#8250;')
+        return html.replace('&','&amp;').replace('<','&#8249;').replace('>','&#8250;')
 
-    readMeText=filter_html(open("../README.md").read())
-    releaseNotesText=filter_html(open("../RELEASENOTES.md").read())
+    readMeText=read_filtered(os.path.join(SOLUTION_DIR,'README.md'),filter_html)
+    releaseNotesText=read_filtered(os.path.join(SOLUTION_DIR,'RELEASENOTES.md'),filter_html)
 
-    text=open(fromPath) \
-        .read() \
+    return read_filtered(fromPath) \
         .replace('[MAIN_DESCRIPTON]',readMeText) \
         .replace('[MAIN_RELEASENOTES]',releaseNotesText) \
-        .replace('[/]',os.sep)
+        .replace('[/]','/')
+
 
-    ensure_dir_exists(toPath)
+#the text of files read by read_filtered, by path, along with the mtime and size it was read at
+filtered_texts={}
 
-    f=open(toPath, 'w')
-    f.write(text)
-    f.flush()
-    f.close()
+def read_filtered(path,filter=None):
+    """Return the file's text, passed through the filter. Read and filtered again only if the file has changed"""
+    stamp=file_stamp(path)
+    with tasks_lock:
+        cached=filtered_texts.get(path)
+        if not cached or cached[0] != stamp:
+            with open(path,encoding='utf-8-sig') as f:
+                text=f.read()
+            cached=filtered_texts[path]=(stamp,filter(text) if filter else text)
+        return cached[1]
 
 def write_assembly_version(file,version):
     log("setting build version in " + file)
@@ -504,69 +2109,246 @@ def can_invoke(prog, args=None):
     return shutil.which(prog)
 
 
-def win_invoke(prog, args=None):
+def win_invoke(prog, args=None, cwd=None, timeout=None):
     if not args:
         args=[]
 
     if MONO_EXE:
-        invoke(MONO_EXE,[prog] + args)
+        invoke(MONO_EXE,[prog] + args,cwd=cwd,timeout=timeout)
     else:
-        invoke(prog,args)
+        invoke(prog,args,cwd=cwd,timeout=timeout)
 
         
-def invoke(prog, args=None):
+def invoke(prog, args=None, cwd=None, timeout=None):
     if not args:
         args=[]
     
 
     args=[prog] + args
-    try:
-        if os.name.endswith('nt'):    
-            cmd=' '.join(args)
-            proc=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-        else:
-            proc=subprocess.Popen(args,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-    except Exception as e:
-        raise Exception('Error running "' + ' '.join(args) + '"') from e
-
-    #log("invoked: {}".format(proc.args))
-
-    for line in proc.stdout: 
-        print(line.decode(), end='')
-
-    if proc.returncode:
-        raise BuildError("call returned a non zero exit code: " + str(proc.returncode))
-
-
-def log(msg):
-    print("[BUILD] " + str(msg))
-
-
-def error(msg):
-    print("[BUILD] [ERROR!] " + str(msg))
+    if cancelled.is_set():
+        raise BuildError('build cancelled, not running "' + ' '.join(args) + '"')
+
+    task_name=getattr(current_task,'name',None)
+    prefix='[' + task_name + '] ' if task_name else ''
+    #name the process after what mono is running, rather than mono
+    exe_name=os.path.basename(args[1] if prog == MONO_EXE and len(args) > 1 else prog)
+    with tracer.span(exe_name,'process',{'command':' '.join(args),'cwd':cwd or '.'}) as trace_args:
+        usage=children_usage()
+        capture=ProcessOutput(open_task_log(task_name or 'build'),' '.join(args),output_sink(),prefix,float(LOG_TAIL_SECS),
+            int(LOG_TAIL_LINES)) if LOG_CAPTURE else None
+        try:
+            returncode,seconds,timed_out=process_runner.run(args,cwd,invoke_timeout(timeout),output_sink(),prefix,capture)
+        except OSError as e:
+            raise Exception('Error running "' + ' '.join(args) + '"') from e
+        trace_args['exit_code']=returncode
+        trace_args.update(children_usage(usage))
+    if capture:
+        capture.close(failed=bool(returncode) or timed_out)
+
+    if cancelled.is_set():
+        raise BuildError('build cancelled, killed "' + ' '.join(args) + '"')
+    if timed_out:
+        raise BuildError('timed out after {:.1f}s, killed "{}"'.format(seconds,' '.join(args)))
+    if returncode:
+        raise BuildError("call returned a non zero exit code: {} after {:.1f}s from \"{}\"".format(returncode,seconds,' '.join(args)))
+    log('{} finished in {:.1f}s'.format(os.path.basename(prog),seconds))
+
+
+def children_usage(before=None):
+    """Return the cpu secs used by finished child processes (since 'before') and the peak RSS of the largest one.
+
+    The cpu time is exact for processes which don't overlap others, otherwise it includes whatever else finished meanwhile
+    """
+    if not resource:
+        return {}
+    usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+    #ru_maxrss is in KB on linux, bytes on mac
+    peak_kb=usage.ru_maxrss / 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    found={'user_cpu_secs':usage.ru_utime,'sys_cpu_secs':usage.ru_stime,'children_peak_rss_kb':peak_kb}
+    if before:
+        found['user_cpu_secs']-=before['user_cpu_secs']
+        found['sys_cpu_secs']-=before['sys_cpu_secs']
+    return found
+
+
+class Tracer:
+    """Records spans of time, such as tasks and processes, as Chrome trace events (chrome://tracing, ui.perfetto.dev)
+
+    Spans are kept in memory and written once at the end, so tracing can be left on. Nested spans on the same
+    thread, such as tasks run via depends(), show nested in the timeline
+    """
 
+    def __init__(self):
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, category, args=None):
+        """Record the time spent in the 'with' block. The yielded args can be added to, to attach them to the span"""
+        args=dict(args or {})
+        started=time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name,category,started,time.perf_counter(),args)
+
+    def add(self, name, category, started, finished, args):
+        thread=threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads[thread.ident]=len(self.threads) + 1
+                self.events.append({'name':'thread_name','ph':'M','pid':os.getpid(),'tid':self.threads[thread.ident],'args':{'name':thread.name}})
+            self.events.append({
+                'name':name,
+                'cat':category,
+                'ph':'X',
+                'ts':round((started - self.origin) * 1e6),
+                'dur':round((finished - started) * 1e6),
+                'pid':os.getpid(),
+                'tid':self.threads[thread.ident],
+                'args':args })
+
+    def spans(self):
+        with self.lock:
+            return [event for event in self.events if event['ph'] == 'X']
+
+    def save(self, path):
+        ensure_dir_exists(path)
+        with self.lock:
+            with open(path,'w') as f:
+                json.dump({'traceEvents':self.events,'displayTimeUnit':'ms'},f)
+
+
+tracer=Tracer()
+
+
+def save_trace():
+    spans=tracer.spans()
+    if not TRACE or not spans:
+        return
+    tracer.save(TRACE_FILE)
+    if any(span['cat'] == 'process' for span in spans):
+        log('slowest tasks and processes:')
+        for span in sorted(spans,key=lambda span: -span['dur'])[:int(TRACE_TOP)]:
+            log('\t{:>8.1f}s {:<8} {}'.format(span['dur'] / 1e6,span['cat'],span['name']))
+        log('timeline written to {}, open with chrome://tracing or https://ui.perfetto.dev'.format(TRACE_FILE))
+
+
+def invoke_timeout(timeout=None):
+    """Return the seconds a process may run for, within any given timeout, TASK_TIMEOUT and BUILD_TIMEOUT. None for no limit"""
+    now=time.time()
+    limits=[]
+    if timeout:
+        limits.append(float(timeout))
+    task_started=getattr(current_task,'started',None)
+    if float(TASK_TIMEOUT or 0) > 0 and task_started:
+        limits.append(task_started + float(TASK_TIMEOUT) - now)
+    if float(BUILD_TIMEOUT or 0) > 0:
+        limits.append(build_started + float(BUILD_TIMEOUT) - now)
+    if not limits:
+        return None
+    return max(0.0,min(limits))
+
+
+open_task_logs={}
+
+def open_task_log(task):
+    with tasks_lock:
+        if task not in open_task_logs:
+            open_task_logs[task]=TaskLog(task,LOG_DIR,LOG_COMPRESSION,int(LOG_CHUNK_KB) * 1024,int(LOG_MAX_WARNINGS))
+        return open_task_logs[task]
+
+
+def close_task_log(task):
+    with tasks_lock:
+        task_log=open_task_logs.pop(task,None)
+    if task_log:
+        task_log.close()
+
+
+class ProcessRunner:
+    """Runs child processes on a background asyncio loop, so any number of tasks can have processes running at once
+
+    Output is read in chunks and written a line at a time to the caller's output, prefixed with the task name, or
+    passed whole to a ProcessOutput. On timeout the whole process tree is killed
+    """
 
-def ensure_dir_exists(path):
+    def __init__(self):
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def run(self, args, cwd, timeout, out, prefix, capture=None):
+        """Run the command and block until done, returning (returncode,seconds,timed_out)"""
+        with self.lock:
+            if not self.loop:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever,name='process-runner',daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(self.execute(args,cwd,timeout,out,prefix,capture),self.loop).result()
+
+    async def execute(self, args, cwd, timeout, out, prefix, capture):
+        started=time.time()
+        if is_windows():
+            proc=await asyncio.create_subprocess_shell(' '.join(args),stdout=subprocess.PIPE,stderr=subprocess.STDOUT,cwd=cwd,limit=PIPE_READ_SIZE)
+        else:
+            #own session, so the process and all it starts can be killed together
+            proc=await asyncio.create_subprocess_exec(*args,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,cwd=cwd,start_new_session=True,
+                limit=PIPE_READ_SIZE)
+
+        running_procs.add(proc)
+        timed_out=False
+        try:
+            await asyncio.wait_for(self.pipe_output(proc,out,prefix,capture),timeout)
+        except asyncio.TimeoutError:
+            timed_out=True
+            kill_process_tree(proc)
+            await proc.wait()
+        finally:
+            running_procs.discard(proc)
+        return proc.returncode,time.time() - started,timed_out
+
+    async def pipe_output(self, proc, out, prefix, capture):
+        partial=b''
+        writing=None
+        while True:
+            chunk=await proc.stdout.read(PIPE_READ_SIZE)
+            if not chunk:
+                break
+            if capture:
+                #compressed off the loop, so it doesn't hold up other processes' output, while the next chunk is read
+                if writing:
+                    await writing
+                writing=asyncio.get_running_loop().run_in_executor(None,capture.write,chunk)
+                continue
+            lines=(partial + chunk).split(b'\n')
+            partial=lines.pop()
+            out(''.join(prefix + line.decode(errors='replace') + '\n' for line in lines))
+        if writing:
+            await writing
+        if partial:
+            out(prefix + partial.decode(errors='replace') + '\n')
+        await proc.wait()
+
+
+PIPE_READ_SIZE=1024 * 1024
+process_runner=ProcessRunner()
+
+
+def kill_process_tree(proc):
     try:
-       if unix_path(path).endswith("/"):
-           os.makedirs(path)
-       else:
-          dir_path=os.path.dirname(os.path.abspath(path))
-          os.makedirs(dir_path)
-    except OSError as exception:
-        if exception.errno != errno.EEXIST:
-            error("couldn't create dir '{}'".format(dirPath))
-            raise
+        if is_windows():
+            subprocess.call(['taskkill','/F','/T','/PID',str(proc.pid)],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(proc.pid,signal.SIGKILL)
+    except OSError:
+        pass
+
 
 def include_proj(proj_name):
     return not PROJECT or proj_name.lower() == PROJECT.lower()
 
-class BuildError(Exception):
-
-    def __init__(self, msg):
-        self.msg = msg
 
-        
 class cd:
     """Context manager for changing the current working directory and setting back to original when complete
 
@@ -586,10 +2368,287 @@ class cd:
         os.chdir(self.savedPath)
 
    
+# ----------------- benchmarks ---------------------------
+#
+# Task bench times the python side of the build against a synthetic solution in BENCH_DIR, with fake msbuild,
+# nunit-console and nuget scripts writing BENCH_OUTPUT_MB of output each. Each case runs in its own process, a copy of
+# this build.py and its modules in the synthetic solution dir so that's its SOLUTION_DIR, as 'bench bench_case=<case>',
+# which writes the min and median secs of BENCH_REPEAT runs, and from one more run under tracemalloc its peak memory and
+# the memory blocks it left allocated, to BENCH_RESULT
+
+BENCH_CASE_FUNCS={}
+
+def bench_case(name,setup=None):
+    """Register a bench case. 'setup' is run once before it's timed, and what it returns is passed to each run"""
+    def register(func):
+        BENCH_CASE_FUNCS[name]=(setup,func)
+        return func
+    return register
+
+
+@bench_case('register-tasks')
+def bench_register_tasks(_):
+    for _ in range(100):
+        register_tasks(sys.modules[__name__])
+
+
+def noop_tasks():
+    """BENCH_TASKS tasks which do nothing, in layers of 10 each requiring all of the layer before"""
+    names=['bench-noop-{}'.format(i) for i in range(int(BENCH_TASKS))]
+    for i,name in enumerate(names):
+        def noop():
+            pass
+        layer=i // 10 * 10
+        noop.requires=names[max(0,layer - 10):layer]
+        all_tasks[name]=noop
+    return names
+
+
+def run_noop_tasks(names,jobs):
+    global JOBS
+    JOBS=jobs
+    for name in names:
+        tasks_run.pop(name,None)
+    run_tasks(names[(len(names) - 1) // 10 * 10:])
+
+
+@bench_case('dispatch',noop_tasks)
+def bench_dispatch(names):
+    run_noop_tasks(names,1)
+
+
+@bench_case('dispatch-jobs',noop_tasks)
+def bench_dispatch_jobs(names):
+    run_noop_tasks(names,8)
+
+
+@bench_case('find-files-cold')
+def bench_find_files_cold(_):
+    file_indexes.clear()
+    bench_find_files(None)
+
+
+@bench_case('find-files-warm',lambda: file_index(SOLUTION_DIR))
+def bench_find_files(_):
+    found=[]
+    find_files(SOLUTION_DIR,lambda path,name: found.append(path),['.cs','.csproj'])
+    for project in load_projects().values():
+        project.inputs()
+
+
+def nuspec_template():
+    return os.path.join(SOLUTION_DIR,'Bench0','Bench0.nuspec.template')
+
+
+@bench_case('filter-template-cold')
+def bench_filter_template_cold(_):
+    filtered_texts.clear()
+    filter_template(nuspec_template())
+
+
+@bench_case('filter-template-warm',lambda: filter_template(nuspec_template()))
+def bench_filter_template_warm(_):
+    filter_template(nuspec_template())
+
+
+def invoke_fake(tool,capture):
+    global LOG_CAPTURE
+    LOG_CAPTURE=capture
+    current_task.name='bench'
+    #held back, as when tasks run concurrently, rather than timing writing it out
+    task_output.buffer=[]
+    try:
+        invoke(sys.executable,[os.path.join(SOLUTION_DIR,'..','bin',tool + '.py'),str(BENCH_OUTPUT_MB)])
+    finally:
+        task_output.buffer=None
+        close_task_log('bench')
+
+
+@bench_case('invoke-msbuild')
+def bench_invoke_msbuild(_):
+    invoke_fake('msbuild',True)
+
+
+@bench_case('invoke-msbuild-uncaptured')
+def bench_invoke_msbuild_uncaptured(_):
+    invoke_fake('msbuild',False)
+
+
+@bench_case('invoke-nunit-console')
+def bench_invoke_nunit(_):
+    invoke_fake('nunit-console',True)
+
+
+@bench_case('invoke-nuget')
+def bench_invoke_nuget(_):
+    invoke_fake('nuget',True)
+
+
+def run_bench_case(name):
+    setup,func=BENCH_CASE_FUNCS[name]
+    arg=setup() if setup else None
+    #once first, so what's only done on the first call isn't timed
+    func(arg)
+    times=[]
+    for _ in range(int(BENCH_REPEAT)):
+        started=time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    before=tracemalloc.take_snapshot()
+    func(arg)
+    after=tracemalloc.take_snapshot()
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times.sort()
+    result={'secs':times[0],'median_secs':times[len(times) // 2],'peak_kb':peak // 1024,
+        'blocks':sum(stat.count_diff for stat in after.compare_to(before,'filename'))}
+    with open(BENCH_RESULT,'w') as f:
+        json.dump(result,f)
+
+
+def run_bench_process(tree,name):
+    result_path=os.path.join(BENCH_DIR,name + '.json')
+    output_path=os.path.join(BENCH_DIR,name + '.out')
+    with contextlib.suppress(OSError):
+        os.remove(result_path)
+    args=[sys.executable,os.path.join(tree,'build.py'),'bench','bench_case=' + name,'bench_result=' + result_path,
+        'bench_repeat=' + str(BENCH_REPEAT),'bench_tasks=' + str(BENCH_TASKS),'bench_output_mb=' + str(BENCH_OUTPUT_MB),'trace=false']
+    with open(output_path,'wb') as out:
+        returncode=subprocess.call(args,stdout=out,stderr=subprocess.STDOUT,cwd=tree)
+    if returncode or not os.path.isfile(result_path):
+        with open(output_path,errors='replace') as f:
+            write_out(''.join(f.readlines()[-20:]))
+        raise BuildError('bench case {} failed, its output is in {}'.format(name,output_path))
+    with open(result_path) as f:
+        result=json.load(f)
+    result['sizes']=bench_sizes()
+    return result
+
+
+def bench_sizes():
+    return {'projects':int(BENCH_PROJECTS),'files':int(BENCH_FILES),'doc_kb':int(BENCH_DOC_KB),
+        'output_mb':float(BENCH_OUTPUT_MB),'tasks':int(BENCH_TASKS),'repeat':int(BENCH_REPEAT)}
+
+
+def format_bench_result(name,result,baseline):
+    text='{:<26} {:>9.4f}s (median {:.4f}s) peak {:>8,}KB {:>+8,} blocks'.format(name,result['secs'],result['median_secs'],
+        result['peak_kb'],result['blocks'])
+    if baseline:
+        text+='  vs baseline {:>+6.1%} time {:>+6.1%} memory'.format(result['secs'] / baseline['secs'] - 1,
+            (result['peak_kb'] + 1) / (baseline['peak_kb'] + 1) - 1)
+    return text
+
+
+def bench_regressed(result,baseline):
+    if not baseline:
+        return False
+    limit=1 + float(BENCH_TOLERANCE)
+    #under a ms or a MB, the differences are noise
+    return result['secs'] > max(baseline['secs'] * limit,baseline['secs'] + 0.001) \
+        or result['peak_kb'] > max(baseline['peak_kb'] * limit,baseline['peak_kb'] + 1024)
+
+
+def load_bench_baseline():
+    try:
+        with open(BENCH_BASELINE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def make_bench_tree():
+    """Write the synthetic solution and fake tools into BENCH_DIR, unless already there for the same sizes, along with
+    a copy of this build.py and its modules to time. Returns the solution dir"""
+    tree=os.path.join(BENCH_DIR,'tree')
+    bin_dir=os.path.join(BENCH_DIR,'bin')
+    sizes={name:value for name,value in bench_sizes().items() if name in ('projects','files','doc_kb')}
+    sizes_path=os.path.join(BENCH_DIR,'tree.json')
+    try:
+        with open(sizes_path) as f:
+            made=json.load(f) == sizes
+    except (OSError,ValueError):
+        made=False
+    if not made:
+        log('writing a synthetic solution of {projects} projects of {files} files each to {}'.format(tree,**sizes))
+        if os.path.isdir(tree):
+            shutil.rmtree(tree)
+        write_bench_tree(tree,sizes)
+        ensure_dir_exists(sizes_path)
+        with open(sizes_path,'w') as f:
+            json.dump(sizes,f)
+    for tool,style in BENCH_TOOL_LINES.items():
+        path=os.path.join(bin_dir,tool + '.py')
+        ensure_dir_exists(path)
+        with open(path,'w') as f:
+            f.write(BENCH_TOOL_SCRIPT.format(lines=repr(style)))
+    for path in script_files():
+        shutil.copy2(path,os.path.join(tree,os.path.basename(path)))
+    return tree
+
+
+def write_bench_tree(tree,sizes):
+    projects=['Bench{}'.format(i) for i in range(sizes['projects'])]
+    sln=['Microsoft Visual Studio Solution File, Format Version 12.00']
+    for i,name in enumerate(projects):
+        proj_dir=os.path.join(tree,name)
+        #a few references each, to earlier projects
+        references=''.join('    <ProjectReference Include="..\\{0}\\{0}.csproj" />\n'.format(projects[ref]) for ref in range(max(0,i - 3),i))
+        compiles=[]
+        for j in range(sizes['files']):
+            rel='Area{}/Sub{}/Class{}.cs'.format(j % 10,j % 7,j)
+            compiles.append('    <Compile Include="{}" />\n'.format(rel.replace('/','\\')))
+            path=os.path.join(proj_dir,os_path(rel))
+            ensure_dir_exists(path)
+            with open(path,'w') as f:
+                f.write('namespace {0}.Area{1}\n{{\n    public class Class{2}\n    {{\n        public int Value() {{ return {2}; }}\n    }}\n}}\n'.format(name,j % 10,j))
+        with open(os.path.join(proj_dir,name + '.csproj'),'w') as f:
+            f.write('<?xml version="1.0" encoding="utf-8"?>\n<Project ToolsVersion="12.0" xmlns="http://schemas.microsoft.com/developer/msbuild/2003">\n'
+                '  <PropertyGroup>\n    <OutputType>Library</OutputType>\n    <AssemblyName>{}</AssemblyName>\n  </PropertyGroup>\n'
+                '  <ItemGroup>\n{}  </ItemGroup>\n  <ItemGroup>\n{}  </ItemGroup>\n</Project>\n'.format(name,''.join(compiles),references))
+        sln.append('Project("{{FAE04EC0-301F-11D3-BF4B-00C04F79EFBC}}") = "{0}", "{0}\\{0}.csproj", "{{00000000-0000-0000-0000-{1:012d}}}"\nEndProject'.format(name,i))
+    with open(os.path.join(tree,SOLUTION),'w') as f:
+        f.write('\n'.join(sln) + '\n')
+    with open(os.path.join(tree,projects[0],projects[0] + '.nuspec.template'),'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<package>\n  <metadata>\n    <id>Bench0</id>\n    <version>$version$</version>\n'
+            '    <description>[MAIN_DESCRIPTON]</description>\n    <releaseNotes>[MAIN_RELEASENOTES]</releaseNotes>\n'
+            '    <projectUrl>https:[/][/]example.com[/]</projectUrl>\n  </metadata>\n</package>\n')
+    paragraph='Some <b>markdown</b> & text, as in the [README](http://example.com?a=1&b=2), with a `code` span.\n\n'
+    for doc in ('README.md','RELEASENOTES.md'):
+        with open(os.path.join(tree,doc),'w') as f:
+            f.write(paragraph * (sizes['doc_kb'] * 1024 // len(paragraph) + 1))
+
+
+#lines the fake tools write, over and over. Every 1000th is a warning, to be picked out of the output
+BENCH_TOOL_LINES={
+    'msbuild':['  Task "Csc" (TaskId:42)','    Output Item(s): FileWrites=obj/Release/Bench.dll (TaskId:42)',
+        '  Done executing task "Copy". (TaskId:43)','Area1/Class1.cs(10,17): warning CS0168: The variable \'e\' is declared but never used'],
+    'nunit-console':['***** Bench0.Area1.Class1Test.TestValue','Tests run: 1, Errors: 0, Failures: 0, Inconclusive: 0, Time: 0.01 seconds',
+        '  Not run: 0, Invalid: 0, Ignored: 0, Skipped: 0','Warning: no tests found in Bench0.Area1.EmptyTest'],
+    'nuget':['Restoring NuGet package Bench.Dependency.1.0.0.','Adding package \'Bench.Dependency.1.0.0\' to folder \'packages\'',
+        'Added package \'Bench.Dependency.1.0.0\' to folder \'packages\'','WARNING: Bench.Dependency.1.0.0 has no license'],
+}
+
+BENCH_TOOL_SCRIPT='''#a fake tool for build.py bench, writing the given MB of output
+import sys
+lines={lines}
+block=''.join(lines[i % 3] + '\\n' for i in range(999)) + lines[3] + '\\n'
+block=block.encode()
+for _ in range(int(float(sys.argv[1]) * 1024 * 1024 // len(block))):
+    sys.stdout.buffer.write(block)
+'''
+
+
 # ----------------- task management ---------------------------
 
 all_tasks={}
+#TaskRun of each task claimed to run, by name
 tasks_run={}
+tasks_lock=threading.RLock()
+build_started=time.time()
+#set on the first task failure, to stop anything else being run
+cancelled=threading.Event()
+running_procs=set()
 
 def register_tasks(mod):    
     all_functions = inspect.getmembers(mod, inspect.isfunction)
@@ -603,33 +2662,231 @@ def register_tasks(mod):
 register_tasks(sys.modules[__name__])
 
 
-def depends(*taskNames):
-    for taskName in taskNames:
-        run_task(taskName)
+class TaskNode:
+    """A task to run in the build plan, along with the names of the tasks it waits on"""
+    def __init__(self, name, action, deps):
+        self.name = name
+        self.action = action
+        self.deps = deps
 
 
-def run_task(taskName,once_only=True):
-    task = all_tasks.get(taskName, None)
+class TaskRun:
+    """A task claimed by a thread to run, which others needing it done wait on until it finishes"""
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.finished = threading.Event()
+        self.error = None
+
+    def wait(self, name):
+        self.finished.wait()
+        if self.error:
+            raise BuildError("task '{}' failed".format(name))
+
+
+def tasks_done():
+    """Names of the tasks finished, or being run by this thread, which is what depends on them"""
+    with tasks_lock:
+        return {name for name,run in tasks_run.items() if run.finished.is_set() or run.thread == threading.get_ident()}
+
+
+def lookup_task(taskName,target=False):
+    """Return the (dependencies,action) for the task. 'action' is None for tasks which only group others.
+
+    A per project task run directly as a 'target' also runs its summary
+    """
+    base_name,sep,proj=taskName.partition(':')
+    task = all_tasks.get(base_name, None)
     if not task:
         s=''
         for task_name in sorted(all_tasks):
             s+='\n\t' + task_name
         raise BuildError("No build task '{}'. For help run task 'help'. Available tasks:{}".format(taskName,s))
-    
-    # Execute the task        
-    if once_only and taskName in tasks_run:
+
+    deps=[]
+    for required in getattr(task,'requires',()):
+        deps+=required() if callable(required) else [required]
+    if not hasattr(task,'projects'):
+        if sep:
+            raise BuildError("Task '{}' can't be run per project".format(base_name))
+        return deps,task
+    if sep:
+        if task.after:
+            deps+=[base_name + ':' + p for p in task.after(proj)]
+        if target and task.summary:
+            def run_and_summarise():
+                task(proj)
+                task.summary([proj])
+            return deps,run_and_summarise
+        return deps,lambda: task(proj)
+    projects=[p for p in task.projects() if include_proj(p)]
+    summarise=(lambda: task.summary(projects)) if task.summary else None
+    return [base_name + ':' + p for p in projects],summarise
+
+
+def plan_tasks(taskNames):
+    """Resolve the tasks and all they depend on into a list of TaskNodes in a stable dependency order.
+
+    Tasks are kept in the order given, so everything the 2nd task pulls in waits on the 1st task and so on,
+    as in 'clean build'
+    """
+    nodes={}
+    plan=[]
+
+    def visit(name,path,after):
+        if name in path:
+            raise BuildError('Task dependency cycle: ' + ' -> '.join(path[path.index(name):] + [name]))
+        if name in nodes:
+            return
+        deps,action=lookup_task(name,target=not path)
+        for dep in deps:
+            visit(dep,path + [name],after)
+        if after and after not in deps:
+            deps=deps + [after]
+        nodes[name]=TaskNode(name,action,deps)
+        plan.append(nodes[name])
+
+    after=None
+    for name in taskNames:
+        visit(name,[],after)
+        after=name
+    return plan
+
+
+def depends(*taskNames):
+    run_tasks(taskNames)
+
+
+def run_task(taskName,once_only=True):
+    if not once_only:
+        tasks_run.pop(taskName,None)
+    run_tasks([taskName])
+
+
+def run_tasks(taskNames):
+    """Run the tasks and their dependencies, running up to JOBS independent tasks at the same time.
+
+    When running concurrently each task's output is held back and printed in plan order, so the log reads
+    the same however the tasks were scheduled. On the first failure no more tasks are started, running
+    processes are killed, and the error is raised once the running tasks finish
+    """
+    #tasks still running on another thread are kept in the plan, to be waited on
+    done=tasks_done()
+    plan=[node for node in plan_tasks(taskNames) if node.name not in done]
+    jobs=int(JOBS) if JOBS else 1
+    if jobs <= 1:
+        try:
+            for node in plan:
+                run_node(node)
+        except KeyboardInterrupt:
+            #processes run in their own session so don't get the ctrl-c, kill them rather than leave them running
+            cancel_build()
+            raise
         return
 
-    log('--------- task:' + taskName + ' ---------')
-    tasks_run[taskName]=True
-    task()
-    log('-------- /task:' + taskName + ' ---------')
+    waiting=list(plan)
+    running={}
+    outputs={}
+    printed=0
+    failure=None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            if not failure:
+                for node in [n for n in waiting if all(dep in done for dep in n.deps)]:
+                    waiting.remove(node)
+                    running[pool.submit(run_node_buffered,node)]=node
+            if not running:
+                break
+            try:
+                finished,_=concurrent.futures.wait(running,return_when=concurrent.futures.FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                #stop the running tasks, rather than wait on them
+                cancel_build()
+                raise
+            for future in finished:
+                node=running.pop(future)
+                outputs[node.name],e=future.result()
+                if e:
+                    if not failure:
+                        failure=e
+                        cancel_build()
+                else:
+                    done.add(node.name)
+            while printed < len(plan) and plan[printed].name in outputs:
+                write_out(''.join(outputs.pop(plan[printed].name)))
+                printed+=1
+
+    for node in plan[printed:]:
+        if node.name in outputs:
+            write_out(''.join(outputs.pop(node.name)))
+    if failure:
+        if waiting:
+            error('tasks not run: ' + ','.join(node.name for node in waiting))
+        raise failure
+
+
+def run_node_buffered(node):
+    task_output.buffer=[]
+    try:
+        run_node(node)
+        return task_output.buffer,None
+    except BaseException as e:
+        error('task:' + node.name + ' failed : ' + str(getattr(e,'msg',e)))
+        return task_output.buffer,e
+    finally:
+        task_output.buffer=None
+
+
+def run_node(node):
+    with tasks_lock:
+        run=tasks_run.get(node.name)
+        claimed=run is None
+        if claimed:
+            run=tasks_run[node.name]=TaskRun()
+    if not claimed:
+        #by this thread it's already run, or is what depends on it
+        if run.thread != threading.get_ident():
+            run.wait(node.name)
+        return
 
-def run_cmdline_tasks():
-    has_task=False
+    outer=(getattr(current_task,'name',None),getattr(current_task,'started',None))
+    current_task.name=node.name
+    current_task.started=time.time()
+    try:
+        log('--------- task:' + node.name + ' ---------')
+        with tracer.span(node.name,'task'):
+            if node.action:
+                node.action()
+        log('-------- /task:' + node.name + ' ---------')
+    except BaseException as e:
+        run.error=e
+        raise
+    finally:
+        run.finished.set()
+        close_task_log(node.name)
+        current_task.name,current_task.started=outer
+
+
+def cancel_build():
+    cancelled.set()
+    for proc in list(running_procs):
+        kill_process_tree(proc)
+
+def run_cmdline_tasks(args=None):
+    global JOBS
+    task_names=[]
+    if args is None:
+        args=sys.argv[1:]
     #extract variable assignment. Expect VAR=VAL on command line
-    for arg in sys.argv[1:]:  
-        if arg.find('=') != -1:
+    for i,arg in enumerate(args):
+        if arg.startswith('-j'):
+            if arg[2:]:
+                JOBS=arg[2:]
+            elif i + 1 < len(args) and args[i + 1].isdigit():
+                JOBS=args[i + 1]
+            else:
+                JOBS=os.cpu_count() or 1
+            log('set JOBS ==> {}'.format(JOBS))
+        elif arg.find('=') != -1:
             pair=str.split(arg,'=',1)
             name=pair[0].upper()
             val=pair[1]
@@ -637,30 +2894,219 @@ def run_cmdline_tasks():
                 val=True
             elif val.lower() == 'false':
                 val=False
-            log('set {} ==> {}'.format(name, val))
+            #secrets aren't shown, as build logs are
+            log('set {} ==> {}'.format(name, '***' if name.endswith('_TOKEN') else val))
             globals()[name]=val
+    if isinstance(JOBS,bool) or not str(JOBS).strip().isdigit() or int(JOBS) < 1:
+        raise BuildError('jobs must be a positive integer')
+    JOBS=int(JOBS)
 
-    for arg in sys.argv[1:]:
-        #skip variable assignment
-        if arg.find('=') != -1:
+    for i,arg in enumerate(args):
+        #skip variable assignment and jobs
+        if arg.find('=') != -1 or arg.startswith('-j') or (i > 0 and args[i - 1] == '-j' and arg.isdigit()):
             continue
-        
-        run_task(arg.lower())
 
-        has_task=True
+        base_name,sep,proj=arg.partition(':')
+        task_names.append(base_name.lower() + sep + proj)
     
-    if not has_task:
+    if not task_names:
         raise BuildError("no build task provided. For help run task 'help'")
-    
 
-
-# ----------------- start the actual build ---------------------------
-
-log('-------- TestFirst.Net Build -----')
-
-#ensure we run from a known location
-with cd(SOLUTION_DIR):
+    if DAEMON and not {'daemon','daemon-stop'} & set(task_names):
+        sys.exit(run_daemon_build(args))
+    run_tasks(task_names)
+
+
+# ----------------- build daemon ---------------------------
+#
+# With daemon=true the script only passes the command line to a long lived 'build.py daemon', over a unix
+# socket, and prints the output sent back. The daemon keeps the parsed projects, the file indexes (and so the
+# project fingerprints' inputs), the process runner and the imported script between builds. Messages both ways
+# are json, one per line
+
+class DaemonConsole(Console):
+    """Sends the output and prompts of a build to the daemon client it's for"""
+
+    def __init__(self, conn):
+        self.reader = conn.makefile('r',encoding='utf-8')
+        self.writer = conn.makefile('w',encoding='utf-8')
+        self.lock = threading.Lock()
+        self.gone = False
+
+    def send(self, **msg):
+        with self.lock:
+            if self.gone:
+                return
+            try:
+                self.writer.write(json.dumps(msg) + '\n')
+                self.writer.flush()
+            except OSError:
+                #client has gone (ctrl-c), so stop its build
+                self.gone = True
+                cancel_build()
+
+    def receive(self):
+        line=self.reader.readline()
+        return json.loads(line) if line else None
+
+    def write(self, text):
+        self.send(out=text)
+
+    def flush(self):
+        pass
+
+    def ask(self, msg):
+        self.send(prompt=msg)
+        reply=self.receive()
+        if reply is None:
+            raise BuildError('daemon client has gone')
+        return reply['input']
+
+
+def daemon_connect():
+    """Return a connection to the running daemon, or None if there isn't one"""
+    if not hasattr(socket,'AF_UNIX'):
+        raise BuildError('the build daemon needs unix domain sockets, which this python does not support')
+    conn=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        conn.connect(DAEMON_SOCKET)
+        return conn
+    except OSError:
+        conn.close()
+        return None
+
+
+def script_files():
+    """This build.py and the build_*.py modules next to it"""
+    script=os.path.realpath(__file__)
+    return [script] + sorted(glob.glob(os.path.join(os.path.dirname(script),'build_*.py')))
+
+
+def scripts_stamp():
+    """The mtime and size of the script files, for the daemon to restart when any have changed"""
+    return [[path,file_stamp(path)] for path in script_files()]
+
+
+def start_daemon():
+    daemon_log=os.path.join(os.path.dirname(DAEMON_SOCKET),'daemon.log')
+    log('starting the build daemon, its own output is in ' + daemon_log)
+    ensure_dir_exists(DAEMON_SOCKET)
+    with open(daemon_log,'a') as out:
+        args=['daemon','daemon_socket=' + DAEMON_SOCKET,'daemon_idle_secs=' + str(DAEMON_IDLE_SECS)]
+        subprocess.Popen([sys.executable,os.path.realpath(__file__)] + args,cwd=SOLUTION_DIR,
+            stdin=subprocess.DEVNULL,stdout=out,stderr=subprocess.STDOUT,start_new_session=True)
+    deadline=time.time() + 30
+    while time.time() < deadline:
+        conn=daemon_connect()
+        if conn:
+            return conn
+        time.sleep(0.05)
+    raise BuildError('the build daemon did not start, see ' + daemon_log)
+
+
+def daemon_request(conn,request):
+    """Send the request to the daemon, print the output sent back and answer any prompts. Return the final reply"""
+    with conn:
+        client=DaemonConsole(conn)
+        client.send(**request)
+        if client.gone:
+            raise BuildError('lost the connection to the build daemon')
+        while True:
+            msg=client.receive()
+            if msg is None:
+                raise BuildError('lost the connection to the build daemon')
+            if 'out' in msg:
+                sys.stdout.write(msg['out'])
+                sys.stdout.flush()
+            if 'prompt' in msg:
+                client.send(input=input(msg['prompt']))
+            if 'exit' in msg or 'restart' in msg:
+                return msg
+
+
+def run_daemon_build(args):
+    """Run the command line's tasks in the daemon, starting it if need be. Return the build's exit code"""
+    args=[arg for arg in args if arg.partition('=')[0].lower() != 'daemon']
+    request={'args':args,'env':dict(os.environ)}
+    reply=daemon_request(daemon_connect() or start_daemon(),request)
+    if 'restart' in reply:
+        log('build.py or its modules have changed since the daemon started, restarting it')
+        reply=daemon_request(start_daemon(),request)
+    return reply.get('exit',1)
+
+
+def reset_build_state(variables,env):
+    """Start a daemon build afresh, apart from what's kept between builds"""
+    globals().update(variables)
+    os.environ.clear()
+    os.environ.update(env)
+    new_build()
+
+
+def new_build():
+    """Forget the tasks run and what they found, so they can all be run again in the same process"""
+    global tracer,build_started
+    tasks_run.clear()
+    test_runs.clear()
+    affected_by_ref.clear()
+    cancelled.clear()
+    tracer=Tracer()
+    build_started=time.time()
+
+
+def serve_build(conn,variables,script_stamp):
+    """Run the build a client has asked for. Return False if the daemon should stop"""
+    client=DaemonConsole(conn)
+    request=client.receive()
+    if request is None:
+        return True
+    if request.get('stop'):
+        client.send(out='[BUILD] build daemon {} stopping\n'.format(os.getpid()),exit=0)
+        return False
+    if scripts_stamp() != script_stamp:
+        client.send(restart=True)
+        return False
+
+    reset_build_state(variables,request['env'])
+    code=0
+    build_core.console=client
     try:
-        run_cmdline_tasks()
+        run_cmdline_tasks(request['args'])
     except BuildError as e:
         error(e.msg)
+        code=1
+    except Exception:
+        error(traceback.format_exc())
+        code=1
+    finally:
+        try:
+            close_task_log('build')
+            save_trace()
+        finally:
+            build_core.console=Console()
+    client.send(exit=code)
+    return True
+
+
+# ----------------- start the actual build ---------------------------
+
+if __name__ == '__main__':
+    log('-------- TestFirst.Net Build -----')
+
+    #ensure we run from a known location
+    with cd(SOLUTION_DIR):
+        #non zero on failure, so CI fails the build on a failed task, test run or perf/bench regression
+        exit_code=0
+        try:
+            run_cmdline_tasks()
+        except BuildError as e:
+            error(e.msg)
+            exit_code=1
+        except KeyboardInterrupt:
+            cancel_build()
+            error('interrupted')
+            exit_code=1
+        finally:
+            close_task_log('build')
+            save_trace()
+    sys.exit(exit_code)
@@ -0,0 +1,288 @@
+# ----------------- remote cache of built outputs, for build.py ---------------------------
+
+import os
+import re
+import io
+import json
+import shutil
+import hashlib
+import hmac
+import threading
+import contextlib
+import zipfile
+import http.server
+import urllib.request
+import urllib.error
+
+from build_core import BuildError, log, os_path, unix_path, ensure_dir_exists
+from build_nuget import NUPKG_DATE_TIME
+
+
+def pack_outputs(project,config):
+    """Zip the project's bin/<config>, and its own assembly in obj/<config> (which nuget-pack packs), with paths
+    relative to the project dir"""
+    paths=[]
+    bin_dir=os.path.join(project.dir,'bin',config)
+    for root,dirs,files in os.walk(bin_dir):
+        dirs.sort()
+        paths+=[os.path.join(root,name) for name in sorted(files)]
+    obj_dir=os.path.join(project.dir,'obj',config)
+    stem=os.path.splitext(project.assembly)[0]
+    if os.path.isdir(obj_dir):
+        paths+=[os.path.join(obj_dir,name) for name in sorted(os.listdir(obj_dir))
+            if os.path.splitext(name)[0] == stem and os.path.isfile(os.path.join(obj_dir,name))]
+    out=io.BytesIO()
+    with zipfile.ZipFile(out,'w',zipfile.ZIP_DEFLATED) as archive:
+        for path in paths:
+            info=zipfile.ZipInfo(unix_path(os.path.relpath(path,project.dir)),NUPKG_DATE_TIME)
+            info.compress_type=zipfile.ZIP_DEFLATED
+            info.external_attr=(os.stat(path).st_mode & 0o777) << 16
+            with open(path,'rb') as f:
+                archive.writestr(info,f.read())
+    return out.getvalue()
+
+
+def unpack_outputs(project,data,config):
+    """Write the outputs zipped by pack_outputs() into the project. Raises BuildError if they're corrupt"""
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            bad=archive.testzip()
+            if bad:
+                raise BuildError('corrupt outputs, bad crc for ' + bad)
+            prefixes=('bin/' + config + '/','obj/' + config + '/')
+            for info in archive.infolist():
+                if not info.filename.startswith(prefixes) or '..' in info.filename.split('/'):
+                    raise BuildError('unexpected file in the outputs: ' + info.filename)
+            for info in archive.infolist():
+                target=os.path.join(project.dir,os_path(info.filename))
+                ensure_dir_exists(target)
+                with archive.open(info) as src, open(target + '.tmp','wb') as dest:
+                    shutil.copyfileobj(src,dest)
+                os.chmod(target + '.tmp',(info.external_attr >> 16) or 0o644)
+                os.replace(target + '.tmp',target)
+    except zipfile.BadZipFile as e:
+        raise BuildError('corrupt outputs, ' + str(e))
+
+
+def fetch_outputs(cache,key,project,config):
+    """Put the project's outputs from the cache in place. Return False if the cache doesn't have them, or if what it
+    has fails the integrity checks"""
+    entry=cache.get_action(key)
+    if not entry:
+        return False
+    data=cache.get_blob(entry['digest'])
+    if data is None:
+        return False
+    if hashlib.sha256(data).hexdigest() != entry['digest']:
+        log('ignoring the cached outputs of {}, their content does not match their sha256 {}'.format(project.name,entry['digest']))
+        return False
+    try:
+        unpack_outputs(project,data,config)
+    except BuildError as e:
+        log('ignoring the cached outputs of {}, {}'.format(project.name,e.msg))
+        return False
+    return True
+
+
+def store_outputs(cache,key,project,config):
+    data=pack_outputs(project,config)
+    digest=hashlib.sha256(data).hexdigest()
+    #the blob first, so an action is never found without its blob
+    cache.put_blob(digest,data)
+    cache.put_action(key,{'digest':digest,'size':len(data),'project':project.name,'config':config})
+    log('uploaded the outputs of {} ({:,} bytes) to the remote cache'.format(project.name,len(data)))
+
+
+CACHE_KEY_RE=re.compile(r'^[0-9a-f]{64}$')
+
+
+class DirOutputCache:
+    """Built project outputs in a dir any machine sharing it can use. ac/ holds, for each output cache key, the sha256
+    of the zip of the outputs, which is held in cas/ under that sha256. Each use touches the zip, and when the zips
+    add up to more than 'max_bytes' the least recently used are deleted"""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def path(self, kind, name):
+        if not CACHE_KEY_RE.match(name):
+            raise BuildError('not a sha256: ' + name)
+        return os.path.join(self.root,kind,name[:2],name + ('.json' if kind == 'ac' else '.zip'))
+
+    def read(self, path):
+        try:
+            with open(path,'rb') as f:
+                data=f.read()
+        except OSError:
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return data
+
+    def write(self, path, data):
+        ensure_dir_exists(path)
+        tmp_path='{}.{}.{}.tmp'.format(path,os.getpid(),threading.get_ident())
+        with open(tmp_path,'wb') as f:
+            f.write(data)
+        os.replace(tmp_path,path)
+
+    def get_action(self, key):
+        data=self.read(self.path('ac',key))
+        return json.loads(data.decode('utf-8')) if data else None
+
+    def put_action(self, key, entry):
+        self.write(self.path('ac',key),json.dumps(entry).encode('utf-8'))
+
+    def get_blob(self, digest):
+        return self.read(self.path('cas',digest))
+
+    def put_blob(self, digest, data):
+        self.put_blob_from(digest,io.BytesIO(data),len(data))
+
+    def put_blob_from(self, digest, stream, size):
+        """Store the 'size' bytes read from 'stream', a MB at a time, if their sha256 is 'digest'"""
+        path=self.path('cas',digest)
+        ensure_dir_exists(path)
+        tmp_path='{}.{}.{}.tmp'.format(path,os.getpid(),threading.get_ident())
+        h=hashlib.sha256()
+        try:
+            with open(tmp_path,'wb') as f:
+                left=size
+                while left > 0:
+                    data=stream.read(min(left,1024 * 1024))
+                    if not data:
+                        raise BuildError('blob {} cut short, {:,} of its {:,} bytes missing'.format(digest,left,size))
+                    h.update(data)
+                    f.write(data)
+                    left-=len(data)
+            if h.hexdigest() != digest:
+                raise BuildError("blob doesn't match its sha256 " + digest)
+            os.replace(tmp_path,path)
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            blobs=[]
+            for root,dirs,files in os.walk(os.path.join(self.root,'cas')):
+                for name in files:
+                    with contextlib.suppress(OSError):
+                        stat=os.stat(os.path.join(root,name))
+                        blobs.append((stat.st_mtime,stat.st_size,os.path.join(root,name)))
+            total=sum(size for mtime,size,path in blobs)
+            #the actions of evicted blobs are left, to miss when their blob isn't found
+            for mtime,size,path in sorted(blobs):
+                if total <= self.max_bytes:
+                    break
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+                    total-=size
+
+
+class HttpOutputCache:
+    """Built project outputs held by a cache-server, at <url>/ac/<key> and <url>/cas/<sha256> as in DirOutputCache.
+    Uploads are sent with 'token', the secret the server requires of them"""
+
+    def __init__(self, url, token):
+        self.url = url.rstrip('/')
+        self.token = token
+
+    def request(self, method, path, data=None):
+        req=urllib.request.Request(self.url + path,data=data,method=method)
+        if self.token:
+            req.add_header('Authorization','Bearer ' + self.token)
+        try:
+            with urllib.request.urlopen(req,timeout=60) as resp:
+                return resp.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def get_action(self, key):
+        data=self.request('GET','/ac/' + key)
+        return json.loads(data.decode('utf-8')) if data else None
+
+    def put_action(self, key, entry):
+        self.request('PUT','/ac/' + key,json.dumps(entry).encode('utf-8'))
+
+    def get_blob(self, digest):
+        return self.request('GET','/cas/' + digest)
+
+    def put_blob(self, digest, data):
+        self.request('PUT','/cas/' + digest,data)
+
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a DirOutputCache (server.cache) to HttpOutputCache clients. Anyone can download, but uploads need the
+    secret server.token, and are refused beyond server.max_bytes. Without a token the cache is read only"""
+
+    protocol_version='HTTP/1.1'
+
+    def target(self):
+        match=re.match(r'^/(ac|cas)/([0-9a-f]{64})$',self.path)
+        return match.groups() if match else (None,None)
+
+    def do_GET(self):
+        kind,name=self.target()
+        data=None
+        if kind == 'ac':
+            entry=self.server.cache.get_action(name)
+            data=json.dumps(entry).encode('utf-8') if entry else None
+        elif kind == 'cas':
+            data=self.server.cache.get_blob(name)
+        if data is None:
+            self.reply(404,b'not found')
+        else:
+            self.reply(200,data)
+
+    def do_PUT(self):
+        kind,name=self.target()
+        token=self.headers.get('Authorization') or ''
+        try:
+            size=int(self.headers.get('Content-Length'))
+        except (TypeError,ValueError):
+            size=-1
+        #refused before the body is read, so the connection can't be used for another request
+        if kind is None:
+            self.refuse(404,'not found')
+        elif not self.server.token or not hmac.compare_digest(token.encode('utf-8'),('Bearer ' + self.server.token).encode('utf-8')):
+            self.refuse(403,'uploads need the cache_server_token')
+        elif size < 0:
+            self.refuse(411,'no Content-Length')
+        elif size > self.server.max_bytes:
+            self.refuse(413,'{:,} bytes is more than the {:,} allowed'.format(size,self.server.max_bytes))
+        else:
+            try:
+                if kind == 'ac':
+                    entry=json.loads(self.rfile.read(size).decode('utf-8'))
+                    if not isinstance(entry,dict) or not CACHE_KEY_RE.match(str(entry.get('digest'))):
+                        raise BuildError('not an action of outputs: ' + json.dumps(entry)[:200])
+                    self.server.cache.put_action(name,entry)
+                else:
+                    self.server.cache.put_blob_from(name,self.rfile,size)
+            except (BuildError,ValueError) as e:
+                self.refuse(400,getattr(e,'msg',str(e)))
+                return
+            self.reply(200,b'')
+
+    def refuse(self, status, reason):
+        self.close_connection=True
+        self.reply(status,reason.encode('utf-8'))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type','application/octet-stream')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+    def log_error(self, format, *args):
+        log('cache server: ' + format % args)
@@ -0,0 +1,180 @@
+# ----------------- output and helpers shared by build.py and its build_*.py modules ---------------------------
+#
+# The modules next to build.py each hold one part of the build (nuget packages, the feed, the output cache, test
+# results, perf metrics, task logs, file watching), taking what build.py's variables set as arguments, so each can be
+# used and tested without running a build. build.py keeps the variables and the tasks.
+
+import sys
+import os
+import os.path
+import errno
+import hashlib
+import shutil
+import threading
+import contextlib
+import concurrent.futures
+
+
+def os_path(path):
+    if is_windows():     
+        return path.replace('/','\\')
+    else:
+        return path.replace('\\','/')
+
+
+def unix_path(path):
+    return path.replace('\\','/')
+
+
+def is_windows():
+    return os.name == 'nt'
+
+
+class BuildError(Exception):
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+#per thread buffer of the output of the task being run, if it's being held back
+task_output=threading.local()
+#per thread name and start time of the task being run
+current_task=threading.local()
+console_lock=threading.RLock()
+
+class Console:
+    """Where the build output goes and prompts are answered. The daemon swaps in the connection of the client it's building for"""
+
+    def write(self, text):
+        sys.stdout.write(text)
+
+    def flush(self):
+        sys.stdout.flush()
+
+    def ask(self, msg):
+        return input(msg)
+
+
+#swapped by the build daemon for the connection of the client it's building for
+console=Console()
+
+
+def log(msg):
+    write_out("[BUILD] " + str(msg) + '\n')
+
+
+def error(msg):
+    write_out("[BUILD] [ERROR!] " + str(msg) + '\n')
+
+
+def write_out(text):
+    """Write to the console, or to the running task's buffer when its output is being held back"""
+    buffer=getattr(task_output,'buffer',None)
+    if buffer is not None:
+        buffer.append(text)
+    else:
+        with console_lock:
+            console.write(text)
+            console.flush()
+
+
+def output_sink():
+    """Return a function which writes to wherever the calling task's output goes, callable from any thread"""
+    buffer=getattr(task_output,'buffer',None)
+    if buffer is None:
+        return write_out
+    return buffer.append
+
+
+def prompt(msg):
+    """Ask the user for input. Any output the task has buffered so far is printed first"""
+    with console_lock:
+        buffer=getattr(task_output,'buffer',None)
+        if buffer:
+            console.write(''.join(buffer))
+            del buffer[:]
+        return console.ask(msg)
+
+
+@contextlib.contextmanager
+def live_output():
+    """Write the running task's output straight to the console, rather than hold it back, for long running tasks like watch"""
+    buffer=getattr(task_output,'buffer',None)
+    with console_lock:
+        if buffer:
+            console.write(''.join(buffer))
+            del buffer[:]
+    task_output.buffer=None
+    try:
+        yield
+    finally:
+        task_output.buffer=buffer
+
+
+def run_concurrently(func,items,jobs=None):
+    """Call func(item) for each of the items, each on its own thread, and return the results in order.
+
+    Each call's output is held back and then written in item order as part of the calling task's output.
+    If any call fails, the first failure is raised once they have all finished
+    """
+    items=list(items)
+    if not items:
+        return []
+    parent=(getattr(current_task,'name',None),getattr(current_task,'started',None))
+
+    def call(item):
+        task_output.buffer=[]
+        current_task.name,current_task.started=parent
+        try:
+            return func(item),task_output.buffer,None
+        except BaseException as e:
+            return None,task_output.buffer,e
+        finally:
+            task_output.buffer=None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or len(items)) as pool:
+        outcomes=list(pool.map(call,items))
+    failure=None
+    for result,buffer,e in outcomes:
+        write_out(''.join(buffer))
+        failure=failure or e
+    if failure:
+        raise failure
+    return [result for result,buffer,e in outcomes]
+
+
+def ensure_dir_exists(path):
+    try:
+       if unix_path(path).endswith("/"):
+           os.makedirs(path)
+       else:
+          dir_path=os.path.dirname(os.path.abspath(path))
+          os.makedirs(dir_path)
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            error("couldn't create dir '{}'".format(path))
+            raise
+
+
+def file_stamp(path):
+    try:
+        stat=os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns,stat.st_size]
+
+
+def hash_file(path):
+    h=hashlib.sha1()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024),b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def link_or_copy(src,dest):
+    try:
+        os.link(src,dest)
+    except OSError:
+        #across file systems, or where hardlinks aren't supported
+        shutil.copyfile(src,dest)
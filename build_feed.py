@@ -0,0 +1,326 @@
+# ----------------- nuget feed of the local repo, for build.py ---------------------------
+#
+# For development only: the feed has no authentication, and lists and serves every package in the repo to whoever
+# can connect, so serve-feed listens on localhost unless told otherwise
+
+import os
+import re
+import json
+import shutil
+import datetime
+import threading
+import traceback
+import zipfile
+import http.server
+import urllib.parse
+from xml.sax.saxutils import escape as xml_escape
+
+from build_core import log, error, file_stamp
+from build_nuget import LocalRepo, nupkg_metadata, normalize_version, version_key
+
+
+#what a nuget v2 client asks the feed it supports, just the V2FeedPackage properties and functions task serve-feed answers
+NUGET_V2_METADATA='<?xml version="1.0" encoding="utf-8"?>' \
+    '<edmx:Edmx Version="1.0" xmlns:edmx="http://schemas.microsoft.com/ado/2007/06/edmx">' \
+    '<edmx:DataServices m:DataServiceVersion="2.0" xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata">' \
+    '<Schema Namespace="NuGetGallery" xmlns="http://schemas.microsoft.com/ado/2006/04/edm">' \
+    '<EntityType Name="V2FeedPackage" m:HasStream="true"><Key><PropertyRef Name="Id" /><PropertyRef Name="Version" /></Key>' + \
+    ''.join('<Property Name="{}" Type="Edm.String" Nullable="{}" />'.format(name,'false' if name in ('Id','Version') else 'true')
+        for name in ('Id','Version','NormalizedVersion','Title','Authors','Owners','Description','Summary','ReleaseNotes',
+            'Copyright','Tags','ProjectUrl','LicenseUrl','IconUrl','Dependencies','PackageHash','PackageHashAlgorithm')) + \
+    ''.join('<Property Name="{}" Type="{}" Nullable="false" />'.format(name,kind)
+        for name,kind in (('PackageSize','Edm.Int64'),('DownloadCount','Edm.Int32'),('VersionDownloadCount','Edm.Int32'),
+            ('IsLatestVersion','Edm.Boolean'),('IsAbsoluteLatestVersion','Edm.Boolean'),('IsPrerelease','Edm.Boolean'),
+            ('Listed','Edm.Boolean'),('RequireLicenseAcceptance','Edm.Boolean'),('Published','Edm.DateTime'),
+            ('Created','Edm.DateTime'),('LastUpdated','Edm.DateTime'))) + \
+    '</EntityType><EntityContainer Name="FeedContext_x0060_1" m:IsDefaultEntityContainer="true">' \
+    '<EntitySet Name="Packages" EntityType="NuGetGallery.V2FeedPackage" />' \
+    '<FunctionImport Name="Search" EntitySet="Packages" ReturnType="Collection(NuGetGallery.V2FeedPackage)" m:HttpMethod="GET">' \
+    '<Parameter Name="searchTerm" Type="Edm.String" /><Parameter Name="targetFramework" Type="Edm.String" />' \
+    '<Parameter Name="includePrerelease" Type="Edm.Boolean" /></FunctionImport>' \
+    '<FunctionImport Name="FindPackagesById" EntitySet="Packages" ReturnType="Collection(NuGetGallery.V2FeedPackage)" m:HttpMethod="GET">' \
+    '<Parameter Name="id" Type="Edm.String" /></FunctionImport>' \
+    '<FunctionImport Name="GetUpdates" EntitySet="Packages" ReturnType="Collection(NuGetGallery.V2FeedPackage)" m:HttpMethod="GET">' \
+    '<Parameter Name="packageIds" Type="Edm.String" /><Parameter Name="versions" Type="Edm.String" />' \
+    '<Parameter Name="includePrerelease" Type="Edm.Boolean" /><Parameter Name="includeAllVersions" Type="Edm.Boolean" />' \
+    '<Parameter Name="targetFrameworks" Type="Edm.String" /><Parameter Name="versionConstraints" Type="Edm.String" />' \
+    '</FunctionImport></EntityContainer></Schema></edmx:DataServices></edmx:Edmx>'
+
+
+class NugetFeed:
+    """The (non symbols) packages of a LocalRepo as a nuget v2 (OData) and v3 feed, answered from the repo's index.
+
+    The index is reloaded when a build changes the repo, and what's rendered from it is kept until it next changes.
+    Packages are only opened for those indexed by an older build, without their metadata
+    """
+
+    V2_NS='xmlns="http://www.w3.org/2005/Atom" xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices" ' \
+        'xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata"'
+
+    def __init__(self, root, base_url):
+        self.root=root
+        self.base_url=base_url.rstrip('/')
+        self.lock=threading.Lock()
+        self.stamp=None
+        #{lower id: [package..]}, each id's packages sorted by version
+        self.by_id={}
+        #the metadata of packages indexed without it, by sha
+        self.metadata={}
+        self.rendered={}
+
+    def refresh(self):
+        stamp=file_stamp(os.path.join(self.root,'.index.json'))
+        if stamp == self.stamp:
+            return
+        repo=LocalRepo(self.root)
+        by_id={}
+        for name,entry in repo.packages():
+            if entry['symbols'] or not os.path.isfile(repo.blob(entry['sha'])):
+                continue
+            meta=entry.get('metadata') or self.metadata.get(entry['sha'])
+            if not meta:
+                meta=self.metadata[entry['sha']]=nupkg_metadata(repo.blob(entry['sha']))
+            published=datetime.datetime.fromtimestamp(os.path.getmtime(repo.blob(entry['sha'])),datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            by_id.setdefault(meta['id'].lower(),[]).append(dict(meta,path=repo.blob(entry['sha']),size=entry['size'],
+                published=published,normalized=normalize_version(meta['version']),prerelease='-' in meta['version']))
+        for packages in by_id.values():
+            packages.sort(key=lambda pkg: version_key(pkg['version']))
+            releases=[pkg for pkg in packages if not pkg['prerelease']]
+            for pkg in packages:
+                pkg['latest']=bool(releases) and pkg is releases[-1]
+                pkg['absoluteLatest']=pkg is packages[-1]
+        self.by_id=by_id
+        self.rendered={}
+        self.stamp=stamp
+
+    def find(self, pkg_id, version=None):
+        packages=self.by_id.get(pkg_id.lower(),[])
+        if version is None:
+            return packages
+        return [pkg for pkg in packages if pkg['normalized'] == normalize_version(version)]
+
+    def get(self, url):
+        """Return the (status,content type,body) for the url. The body is the path of the file when sending a package"""
+        with self.lock:
+            self.refresh()
+            if url not in self.rendered:
+                if len(self.rendered) >= 1000:
+                    self.rendered.clear()
+                self.rendered[url]=self.route(url)
+            return self.rendered[url]
+
+    def route(self, url):
+        parts=urllib.parse.urlsplit(url)
+        path=urllib.parse.unquote(parts.path).strip('/')
+        query={name:values[-1].strip("'") for name,values in urllib.parse.parse_qs(parts.query).items()}
+        if path.lower().startswith('api/v2'):
+            return self.route_v2(path[len('api/v2'):].strip('/'),query)
+        if path.lower().startswith('v3/'):
+            return self.route_v3(path[len('v3/'):].lower(),query)
+        return 404,'text/plain','not found'
+
+    def route_v3(self, path, query):
+        segments=path.split('/')
+        if path == 'index.json':
+            resources=[('flatcontainer/','PackageBaseAddress/3.0.0'),('registration/','RegistrationsBaseUrl'),
+                ('registration/','RegistrationsBaseUrl/3.0.0-beta'),('query','SearchQueryService'),('query','SearchQueryService/3.0.0-beta')]
+            return self.json({'version':'3.0.0','resources':[{'@id':self.v3_url(url),'@type':kind} for url,kind in resources]})
+        if segments[0] == 'query':
+            found=self.search(query.get('q',''),query.get('prerelease','false').lower() == 'true')
+            skip,take=int(query.get('skip',0)),int(query.get('take',20))
+            return self.json({'totalHits':len(found),'data':[{
+                'id':packages[-1]['id'],'version':packages[-1]['normalized'],'description':packages[-1]['description'],
+                'authors':packages[-1]['authors'],'registration':self.v3_url('registration/{}/index.json'.format(pkg_id)),
+                'versions':[{'version':pkg['normalized'],'downloads':0,'@id':self.v3_url('registration/{}/{}.json'.format(pkg_id,pkg['normalized']))}
+                    for pkg in packages]} for pkg_id,packages in found[skip:skip + take]]})
+        if segments[0] == 'flatcontainer' and len(segments) == 3 and segments[2] == 'index.json':
+            packages=self.find(segments[1])
+            if not packages:
+                return 404,'text/plain','not found'
+            return self.json({'versions':[pkg['normalized'] for pkg in packages]})
+        if segments[0] == 'flatcontainer' and len(segments) == 4:
+            found=self.find(segments[1],segments[2])
+            if found and segments[3] == '{}.{}.nupkg'.format(segments[1],found[0]['normalized']):
+                return 200,'application/octet-stream',found[0]['path']
+            if found and segments[3] == segments[1] + '.nuspec':
+                with zipfile.ZipFile(found[0]['path']) as archive:
+                    nuspec=next(name for name in archive.namelist() if name.endswith('.nuspec') and '/' not in name)
+                    return 200,'application/xml',archive.read(nuspec)
+        if segments[0] == 'registration' and len(segments) == 3:
+            packages=self.find(segments[1])
+            if segments[2] == 'index.json' and packages:
+                index_url=self.v3_url('registration/{}/index.json'.format(segments[1]))
+                return self.json({'@id':index_url,'count':1,'items':[{'@id':index_url + '#page','count':len(packages),
+                    'lower':packages[0]['normalized'],'upper':packages[-1]['normalized'],
+                    'items':[self.registration_leaf(pkg) for pkg in packages]}]})
+            found=[pkg for pkg in packages if pkg['normalized'] + '.json' == segments[2]]
+            if found:
+                return self.json(self.registration_leaf(found[0]))
+        return 404,'text/plain','not found'
+
+    def registration_leaf(self, pkg):
+        pkg_id=pkg['id'].lower()
+        content_url=self.v3_url('flatcontainer/{id}/{ver}/{id}.{ver}.nupkg'.format(id=pkg_id,ver=pkg['normalized']))
+        leaf_url=self.v3_url('registration/{}/{}.json'.format(pkg_id,pkg['normalized']))
+        groups={}
+        for dep_id,dep_range,framework in pkg['dependencies']:
+            groups.setdefault(framework,[]).append({'id':dep_id,'range':dep_range})
+        return {'@id':leaf_url,'packageContent':content_url,'catalogEntry':{
+            '@id':leaf_url,'id':pkg['id'],'version':pkg['normalized'],'authors':pkg['authors'],
+            'description':pkg['description'],'summary':pkg['summary'],'title':pkg['title'],'tags':pkg['tags'].split(),
+            'projectUrl':pkg['projectUrl'],'licenseUrl':pkg['licenseUrl'],'iconUrl':pkg['iconUrl'],
+            'requireLicenseAcceptance':pkg['requireLicenseAcceptance'],'listed':True,'published':pkg['published'],
+            'packageContent':content_url,
+            'dependencyGroups':[dict({'dependencies':deps},**({'targetFramework':framework} if framework else {}))
+                for framework,deps in sorted(groups.items())]}}
+
+    def route_v2(self, path, query):
+        function,_,rest=path.partition('(')
+        function=function.lower()
+        if path == '':
+            return 200,'application/xml','<?xml version="1.0" encoding="utf-8"?>' \
+                '<service xml:base="{}" xmlns="http://www.w3.org/2007/app" xmlns:atom="http://www.w3.org/2005/Atom">' \
+                '<workspace><atom:title>Default</atom:title><collection href="Packages"><atom:title>Packages</atom:title>' \
+                '</collection></workspace></service>'.format(self.v2_url(''))
+        if path == '$metadata':
+            return 200,'application/xml',NUGET_V2_METADATA
+        if function.startswith('package/'):
+            segments=path.split('/')
+            found=self.find(segments[1],segments[2]) if len(segments) == 3 else []
+            if found:
+                return 200,'application/octet-stream',found[0]['path']
+            return 404,'text/plain','not found'
+        match=re.match(r"^Packages\(Id='([^']*)',Version='([^']*)'\)$",path,re.IGNORECASE)
+        if match:
+            found=self.find(match.group(1),match.group(2))
+            if not found:
+                return 404,'text/plain','not found'
+            return 200,'application/atom+xml;type=entry;charset=utf-8', \
+                '<?xml version="1.0" encoding="utf-8"?>' + self.v2_entry(found[0],True)
+
+        if function == 'findpackagesbyid':
+            found=self.find(query.get('id',''))
+        elif function == 'packages':
+            found=self.filter(query.get('$filter',''))
+        elif function == 'search':
+            found=[pkg for pkg_id,packages in self.search(query.get('searchTerm',''),query.get('includePrerelease','false').lower() == 'true')
+                for pkg in packages]
+            #the latest of each, unless asked for all versions
+            if 'islatestversion' in query.get('$filter','').lower() or 'isabsolutelatestversion' in query.get('$filter','').lower():
+                found=[pkg for pkg in found if pkg['latest' if query.get('includePrerelease','false').lower() != 'true' else 'absoluteLatest']]
+        elif function == 'getupdates':
+            found=self.updates(query.get('packageIds','').split('|'),query.get('versions','').split('|'),
+                query.get('includePrerelease','false').lower() == 'true')
+        else:
+            return 404,'text/plain','not found'
+        if rest.endswith('/$count'):
+            return 200,'text/plain',str(len(found))
+        skip,top=int(query.get('$skip',0)),query.get('$top')
+        found=found[skip:skip + int(top) if top else None]
+        return 200,'application/atom+xml;type=feed;charset=utf-8','<?xml version="1.0" encoding="utf-8"?>' \
+            '<feed xml:base="{base}" {ns}><id>{base}{function}</id><title type="text">{function}</title><updated>{now}</updated>' \
+            '<link rel="self" title="{function}" href="{function}" />{entries}</feed>'.format(base=self.v2_url(''),ns=self.V2_NS,
+                function=path.partition('(')[0],now=datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                entries=''.join(self.v2_entry(pkg) for pkg in found))
+
+    def filter(self, odata_filter):
+        """The packages matching the common $filter clauses nuget sends, 'tolower(Id) eq 'x'' and '(Is)LatestVersion'"""
+        odata_filter=odata_filter.lower()
+        match=re.search(r"id\)? eq '([^']*)'",odata_filter)
+        found=[pkg for pkg_id,packages in sorted(self.by_id.items()) if not match or pkg_id == match.group(1) for pkg in packages]
+        if 'isabsolutelatestversion' in odata_filter:
+            found=[pkg for pkg in found if pkg['absoluteLatest']]
+        elif 'islatestversion' in odata_filter:
+            found=[pkg for pkg in found if pkg['latest']]
+        return found
+
+    def search(self, term, prerelease):
+        """Return [(lower id,packages)] for the ids or descriptions containing the term"""
+        term=term.lower()
+        found=[]
+        for pkg_id,packages in sorted(self.by_id.items()):
+            packages=[pkg for pkg in packages if prerelease or not pkg['prerelease']]
+            if packages and (term in pkg_id or term in packages[-1]['description'].lower()):
+                found.append((pkg_id,packages))
+        return found
+
+    def updates(self, pkg_ids, versions, prerelease):
+        found=[]
+        for pkg_id,version in zip(pkg_ids,versions):
+            packages=[pkg for pkg in self.find(pkg_id) if prerelease or not pkg['prerelease']]
+            if packages and version_key(packages[-1]['version']) > version_key(version):
+                found.append(packages[-1])
+        return found
+
+    def v2_entry(self, pkg, standalone=False):
+        entry_id="Packages(Id='{}',Version='{}')".format(pkg['id'],pkg['version'])
+        props=[('Id',pkg['id']),('Version',pkg['version']),('NormalizedVersion',pkg['normalized']),('Title',pkg['title']),
+            ('Authors',pkg['authors']),('Owners',pkg['owners']),('Description',pkg['description']),('Summary',pkg['summary']),
+            ('ReleaseNotes',pkg['releaseNotes']),('Copyright',pkg['copyright']),('Tags',pkg['tags']),
+            ('ProjectUrl',pkg['projectUrl']),('LicenseUrl',pkg['licenseUrl']),('IconUrl',pkg['iconUrl']),
+            ('Dependencies','|'.join(':'.join(dep) for dep in pkg['dependencies'])),
+            ('PackageHash',pkg['sha512']),('PackageHashAlgorithm','SHA512')]
+        typed=[('PackageSize','Edm.Int64',pkg['size']),('DownloadCount','Edm.Int32',0),('VersionDownloadCount','Edm.Int32',0),
+            ('IsLatestVersion','Edm.Boolean',pkg['latest']),('IsAbsoluteLatestVersion','Edm.Boolean',pkg['absoluteLatest']),
+            ('IsPrerelease','Edm.Boolean',pkg['prerelease']),('Listed','Edm.Boolean',True),
+            ('RequireLicenseAcceptance','Edm.Boolean',pkg['requireLicenseAcceptance']),
+            ('Published','Edm.DateTime',pkg['published']),('Created','Edm.DateTime',pkg['published']),
+            ('LastUpdated','Edm.DateTime',pkg['published'])]
+        return '<entry{ns}><id>{base}{entry_id}</id>' \
+            '<category term="NuGetGallery.V2FeedPackage" scheme="http://schemas.microsoft.com/ado/2007/08/dataservices/scheme" />' \
+            '<link rel="edit" title="V2FeedPackage" href="{entry_id}" /><title type="text">{id}</title>' \
+            '<summary type="text">{summary}</summary><updated>{published}</updated><author><name>{authors}</name></author>' \
+            '<content type="application/zip" src="{base}package/{id}/{version}" /><m:properties>{props}</m:properties></entry>'.format(
+                ns=' xml:base="{}" {}'.format(self.v2_url(''),self.V2_NS) if standalone else '',base=self.v2_url(''),
+                entry_id=xml_escape(entry_id),id=xml_escape(pkg['id']),version=xml_escape(pkg['version']),
+                summary=xml_escape(pkg['summary']),published=pkg['published'],authors=xml_escape(pkg['authors']),
+                props=''.join('<d:{0}>{1}</d:{0}>'.format(name,xml_escape(value)) for name,value in props) +
+                    ''.join('<d:{0} m:type="{1}">{2}</d:{0}>'.format(name,kind,str(value).lower() if kind == 'Edm.Boolean' else value)
+                        for name,kind,value in typed))
+
+    def v2_url(self, path):
+        return self.base_url + '/api/v2/' + path
+
+    def v3_url(self, path):
+        return self.base_url + '/v3/' + path
+
+    def json(self, data):
+        return 200,'application/json',json.dumps(data)
+
+
+class FeedRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, send_body):
+        try:
+            status,content_type,body=self.server.feed.get(self.path)
+        except Exception:
+            error('serving {} : {}'.format(self.path,traceback.format_exc()))
+            status,content_type,body=500,'text/plain','internal error'
+        send_file=status == 200 and content_type == 'application/octet-stream'
+        if isinstance(body,str) and not send_file:
+            body=body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type',content_type)
+        self.send_header('Content-Length',str(os.path.getsize(body) if send_file else len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        if send_file:
+            with open(body,'rb') as f:
+                shutil.copyfileobj(f,self.wfile)
+        else:
+            self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        #a restore asks every source for every package, so not found is usual
+        pass
+
+    def log_error(self, format, *args):
+        log('feed: ' + format % args)
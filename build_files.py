@@ -0,0 +1,210 @@
+# ----------------- file index and watchers, for build.py ---------------------------
+
+import sys
+import os
+import errno
+import time
+import struct
+import select
+import ctypes
+import threading
+
+from build_core import file_stamp
+
+
+class FileIndex:
+    """All the files under a dir, found with a single scandir pass and looked up by suffix.
+
+    Dirs named in 'prune' are skipped. Each dir's mtime is recorded, so on each lookup only the dirs
+    which have had files added or removed since are rescanned, rather than walking the whole tree again
+    """
+
+    def __init__(self, root, prune):
+        self.root = root
+        self.prune = set(prune)
+        self.dirs = {}
+        self.by_suffix = {}
+        self.lock = threading.Lock()
+        self.scan(root)
+
+    def find(self, *suffixes):
+        """Return a sorted list of (path,name) of the files with any of the suffixes, or all files if none given"""
+        with self.lock:
+            self.refresh()
+            keys=[suffix.lower() for suffix in suffixes] if suffixes else list(self.by_suffix)
+            found=[]
+            for key in keys:
+                found+=[(path,name) for path,name in self.by_suffix.get(key,{}).items() if name.lower().endswith(key)]
+            return sorted(found)
+
+    def refresh(self):
+        for path in list(self.dirs):
+            if path not in self.dirs:
+                continue
+            try:
+                mtime=os.stat(path).st_mtime_ns
+            except OSError:
+                self.forget_tree(path)
+                continue
+            if mtime != self.dirs[path][0]:
+                old_subdirs=self.dirs[path][2]
+                self.scan(path)
+                for subdir in old_subdirs:
+                    if path not in self.dirs or subdir not in self.dirs[path][2]:
+                        self.forget_tree(subdir)
+
+    def scan(self, path):
+        """Index the files directly in the dir, and everything under any subdirs not yet indexed"""
+        self.forget(path)
+        try:
+            #stat before listing, so a change made while listing is picked up on the next refresh
+            mtime=os.stat(path).st_mtime_ns
+            entries=list(os.scandir(path))
+        except OSError:
+            return
+        files=[]
+        subdirs=[]
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in self.prune:
+                    subdirs.append(entry.path)
+            else:
+                files.append(entry.name)
+                self.by_suffix.setdefault(file_suffix(entry.name),{})[entry.path]=entry.name
+        self.dirs[path]=(mtime,files,subdirs)
+        for subdir in subdirs:
+            if subdir not in self.dirs:
+                self.scan(subdir)
+
+    def forget(self, path):
+        old=self.dirs.pop(path,None)
+        if old:
+            for name in old[1]:
+                self.by_suffix.get(file_suffix(name),{}).pop(os.path.join(path,name),None)
+
+    def forget_tree(self, path):
+        for dir_path in [d for d in self.dirs if d == path or d.startswith(path + os.sep)]:
+            self.forget(dir_path)
+
+
+def file_suffix(name):
+    return os.path.splitext(name)[1].lower()
+
+
+class InotifyWatcher:
+    """Watches every dir under the root for changed files using linux inotify, except dirs named in 'prune' or in 'ignore'"""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    kind = 'inotify'
+
+    def __init__(self, root, prune, ignore, overflowed):
+        self.root = root
+        #the path reported changed when inotify loses track of the changes
+        self.overflowed = overflowed
+        self.prune = set(prune)
+        self.ignore = set(ignore)
+        self.dirs = {}
+        libc=ctypes.CDLL(None,use_errno=True)
+        if not hasattr(libc,'inotify_init1'):
+            raise OSError(errno.ENOSYS,'no inotify on ' + sys.platform)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(),os.strerror(ctypes.get_errno()))
+        try:
+            self.watch_tree(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def watch_tree(self, path):
+        """Watch the dir and all those under it, returning the files already in them"""
+        found=set()
+        for dirpath,dirnames,filenames in os.walk(path):
+            dirnames[:]=[name for name in dirnames if name not in self.prune and os.path.join(dirpath,name) not in self.ignore]
+            wd=self.libc.inotify_add_watch(self.fd,os.fsencode(dirpath),self.MASK)
+            if wd < 0:
+                err=ctypes.get_errno()
+                if err == errno.ENOENT:
+                    continue
+                #most likely ENOSPC, out of fs.inotify.max_user_watches
+                raise OSError(err,'watching {}: {}'.format(dirpath,os.strerror(err)))
+            self.dirs[wd]=dirpath
+            found.update(os.path.join(dirpath,name) for name in filenames)
+        return found
+
+    def changes(self, timeout):
+        """Return the paths of the files changed, waiting up to 'timeout' secs (None for ever) for the first"""
+        changed=set()
+        ready,_,_=select.select([self.fd],[],[],timeout)
+        if not ready:
+            return changed
+        data=os.read(self.fd,64 * 1024)
+        offset=0
+        while offset < len(data):
+            wd,mask,cookie,length=struct.unpack_from('iIII',data,offset)
+            name=os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset+=16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                #lost track of what changed, so treat it as a change to the whole solution
+                changed.add(self.overflowed)
+                continue
+            if wd not in self.dirs or not name:
+                continue
+            path=os.path.join(self.dirs[wd],name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and name not in self.prune and path not in self.ignore:
+                    changed|=self.watch_tree(path)
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollWatcher:
+    """Finds changed files under the FileIndex's root by checking the mtime and size of each indexed file every 'poll_secs'"""
+
+    kind = 'polling'
+
+    def __init__(self, index, ignore, poll_secs):
+        self.index = index
+        self.root = index.root
+        self.ignore = tuple(path + os.sep for path in ignore)
+        self.poll_secs = poll_secs
+        self.files = self.stat_all()
+
+    def stat_all(self):
+        files={}
+        for path,name in self.index.find():
+            if path.startswith(self.ignore):
+                continue
+            stamp=file_stamp(path)
+            if stamp:
+                files[path]=stamp
+        return files
+
+    def changes(self, timeout):
+        deadline=None if timeout is None else time.time() + timeout
+        while True:
+            files=self.stat_all()
+            changed={path for path in set(files) | set(self.files) if files.get(path) != self.files.get(path)}
+            self.files=files
+            if changed:
+                return changed
+            if deadline is not None and time.time() >= deadline:
+                return changed
+            wait=self.poll_secs
+            time.sleep(wait if deadline is None else max(0.0,min(wait,deadline - time.time())))
+
+    def close(self):
+        pass
@@ -0,0 +1,245 @@
+# ----------------- task logs of the processes run, for build.py ---------------------------
+
+import os
+import re
+import json
+import time
+import gzip
+import bisect
+import threading
+import contextlib
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        #logs are gzipped instead
+        zstd=None
+
+from build_core import BuildError, log, write_out, ensure_dir_exists
+
+
+#errors and warnings as msbuild, xbuild, csc and nuget report them, in lower cased output
+LOG_ISSUE_RE=re.compile(rb'(?:^[ \t]*|:[ \t]*)(?:fatal[ \t]+)?(error|warning)\b',re.M)
+
+
+def find_issues(block):
+    """The (kind,offset of the line) of the errors and warnings in whole lines of output. Only the lines with the
+    words in are matched against LOG_ISSUE_RE, as trying it at every offset of MBs of output is slow"""
+    lowered=block.lower()
+    found={}
+    for word in (b'error',b'warning'):
+        position=lowered.find(word)
+        while position >= 0:
+            start=lowered.rfind(b'\n',0,position) + 1
+            end=lowered.find(b'\n',position)
+            end=len(lowered) if end < 0 else end
+            match=LOG_ISSUE_RE.search(lowered,start,end)
+            if match and start not in found:
+                found[start]=match.group(1).decode()
+            position=lowered.find(word,end)
+    return [(found[start],start) for start in sorted(found)]
+
+
+LOG_CODECS={
+    'gzip':('.log.gz',lambda data: gzip.compress(data,compresslevel=1,mtime=0),gzip.decompress),
+    'zstd':('.log.zst',lambda data: zstd.compress(data),lambda data: zstd.decompress(data)),
+}
+
+
+class TaskLog:
+    """The process output of a task, compressed a chunk at a time to <log_dir>/<task>.log.gz (or .zst), each chunk a
+    complete gzip member (or zstd frame) so the whole file still decompresses with zcat. <task>.idx, written as the
+    chunks are, has a json line for each: its offset and size in the file, its offset and size in the output, its
+    first line and line count, and the line and output offset of each error and warning in it. So the errors in a log of any size
+    can be found, and read along with the lines around them, without decompressing the rest"""
+
+    def __init__(self, task, log_dir, codec, chunk_bytes, max_warnings):
+        if codec not in LOG_CODECS or (codec == 'zstd' and not zstd):
+            raise BuildError('log_compression must be gzip, or zstd if the zstd module is available, not ' + str(codec))
+        name=re.sub(r'[^\w.-]','-',task)
+        extension,self.compress,_=LOG_CODECS[codec]
+        for old in [os.path.join(log_dir,name + ext) for ext,_,_ in LOG_CODECS.values()]:
+            with contextlib.suppress(OSError):
+                os.remove(old)
+        self.chunk_bytes = chunk_bytes
+        self.max_warnings = max_warnings
+        self.path = os.path.join(log_dir,name + extension)
+        self.index_path = os.path.join(log_dir,name + '.idx')
+        ensure_dir_exists(self.path)
+        self.file = open(self.path,'wb')
+        self.index = open(self.index_path,'w')
+        self.index.write(json.dumps({'task':task,'log':os.path.basename(self.path),'codec':codec,'started':time.time()}) + '\n')
+        self.lock = threading.RLock()
+        self.pending = bytearray()
+        self.pending_issues = []
+        self.lines = 0
+        self.size = 0
+        self.chunk_line = 0
+        self.warnings_shown = 0
+
+    def append(self, block, issues):
+        """Add whole lines of output, along with the (kind,offset in the block) of the errors and warnings in them"""
+        with self.lock:
+            counted=0
+            line=self.lines
+            for kind,offset in issues:
+                line+=block.count(b'\n',counted,offset)
+                counted=offset
+                self.pending_issues.append([line,kind,self.size + offset])
+            self.pending+=block
+            self.lines+=block.count(b'\n')
+            self.size+=len(block)
+            if len(self.pending) >= self.chunk_bytes:
+                self.flush()
+
+    def show(self, kind):
+        """Whether to show an error or warning on the console. Only the first 'max_warnings' warnings are, 'last' for
+        the last of them"""
+        if kind == 'error':
+            return True
+        with self.lock:
+            self.warnings_shown+=1
+            if self.warnings_shown > self.max_warnings:
+                return False
+            return 'last' if self.warnings_shown == self.max_warnings else True
+
+    def flush(self):
+        """Compress and write out what's pending as a chunk. Called from other threads than the appending one too"""
+        with self.lock:
+            if not self.pending:
+                return
+            data=self.compress(bytes(self.pending))
+            chunk=[self.file.tell(),len(data),self.size - len(self.pending),len(self.pending),self.chunk_line,self.lines - self.chunk_line]
+            self.file.write(data)
+            self.file.flush()
+            self.index.write(json.dumps({'chunk':chunk,'issues':self.pending_issues}) + '\n')
+            self.index.flush()
+            self.pending=bytearray()
+            self.pending_issues=[]
+            self.chunk_line=self.lines
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.file.close()
+            self.index.close()
+
+
+class LogReader:
+    """Reads back a TaskLog, only decompressing the chunks asked for"""
+
+    def __init__(self, index_path):
+        entries=[]
+        with open(index_path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    #the last line, cut short by the build being killed
+                    break
+        if not entries:
+            raise BuildError('empty log index ' + index_path)
+        self.task = entries[0]['task']
+        self.path = os.path.join(os.path.dirname(index_path),entries[0]['log'])
+        self.decompress = LOG_CODECS[entries[0]['codec']][2]
+        self.started = entries[0]['started']
+        self.chunks = [entry['chunk'] for entry in entries[1:]]
+        self.issues = [issue for entry in entries[1:] for issue in entry['issues']]
+        self.first_lines = [chunk[4] for chunk in self.chunks]
+        self.lines = sum(chunk[5] for chunk in self.chunks)
+        self.size = sum(chunk[3] for chunk in self.chunks)
+        self.cached = {}
+
+    def chunk(self, i):
+        if i not in self.cached:
+            offset,size=self.chunks[i][:2]
+            with open(self.path,'rb') as f:
+                f.seek(offset)
+                data=f.read(size)
+            #the chunks around the last one are all that's needed for context
+            self.cached={key:value for key,value in self.cached.items() if abs(key - i) <= 1}
+            self.cached[i]=self.decompress(data).decode(errors='replace').split('\n')[:self.chunks[i][5]]
+        return self.cached[i]
+
+    def lines_around(self, line, before, after):
+        """The (line number,text) of the lines from 'before' lines before 'line' to 'after' lines after it"""
+        i=bisect.bisect_right(self.first_lines,line) - 1
+        found=[]
+        for j in range(max(0,i - 1),min(len(self.chunks),i + 2)):
+            first,count=self.chunks[j][4:6]
+            if first + count <= line - before or first > line + after:
+                continue
+            found+=[(first + k,text) for k,text in enumerate(self.chunk(j)) if line - before <= first + k <= line + after]
+        return found
+
+    def write_all(self):
+        for i in range(len(self.chunks)):
+            write_out(''.join(text + '\n' for text in self.chunk(i)))
+
+
+class ProcessOutput:
+    """Where a process's output goes when LOG_CAPTURE is on. All of it to the TaskLog, and to 'out' only its errors and
+    warnings, its latest line every 'tail_secs' to show it's progressing and, if it fails, its last 'tail_lines' lines"""
+
+    def __init__(self, task_log, command, out, prefix, tail_secs, tail_lines):
+        self.log = task_log
+        self.out = out
+        self.prefix = prefix
+        self.tail_secs = tail_secs
+        self.tail_lines = tail_lines
+        self.partial = b''
+        self.tail = bytearray()
+        self.lines = 0
+        self.errors = 0
+        self.warnings = 0
+        self.shown = time.time()
+        self.log.append(('$ ' + command + '\n').encode('utf-8'),[])
+
+    def write(self, chunk):
+        """Take a chunk of output. Called on the process runner's executor, one chunk at a time"""
+        data=self.partial + chunk
+        end=data.rfind(b'\n') + 1
+        if not end and len(data) < self.log.chunk_bytes:
+            self.partial=data
+            return
+        if not end:
+            #a line longer than a chunk, which is logged in pieces
+            end=len(data)
+        block,self.partial=data[:end],data[end:]
+        issues=find_issues(block)
+        shown=[]
+        for kind,start in issues:
+            if kind == 'error':
+                self.errors+=1
+            else:
+                self.warnings+=1
+            show=self.log.show(kind)
+            if show:
+                line_end=block.find(b'\n',start)
+                shown.append(block[start:line_end if line_end >= 0 else len(block)].decode(errors='replace').rstrip('\r'))
+                if show == 'last':
+                    shown.append('... more warnings, only in the log. See them with: build.py logs log_show=warnings')
+        self.log.append(block,issues)
+        self.lines+=block.count(b'\n')
+        self.tail+=block
+        del self.tail[:-64 * 1024]
+        now=time.time()
+        if not shown and now - self.shown >= self.tail_secs:
+            last=block.rstrip(b'\r\n').rsplit(b'\n',1)[-1].decode(errors='replace')
+            shown.append('.. ' + (last[:200] + '..' if len(last) > 200 else last))
+        if shown:
+            self.shown=now
+            self.out(''.join(self.prefix + line + '\n' for line in shown))
+
+    def close(self, failed):
+        if self.partial:
+            self.write(b'\n')
+        if failed:
+            #all of it written out, so the log has everything up to the failure even if the build is then killed
+            self.log.flush()
+            lines=bytes(self.tail).decode(errors='replace').splitlines()[-self.tail_lines:]
+            self.out(self.prefix + 'process failed, its last {} lines of output follow. All of it is in {}\n'.format(len(lines),self.log.path) +
+                ''.join(self.prefix + line + '\n' for line in lines))
+        log('{:,} lines of output, {} errors, {} warnings, logged to {}'.format(self.lines,self.errors,self.warnings,self.log.path))
@@ -0,0 +1,315 @@
+# ----------------- nuget packages and the local repo, for build.py ---------------------------
+
+import os
+import os.path
+import re
+import glob
+import json
+import shutil
+import hashlib
+import base64
+import zipfile
+import contextlib
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+from build_core import BuildError, log, os_path, ensure_dir_exists, hash_file, link_or_copy
+
+
+NUSPEC_NS='http://schemas.microsoft.com/packaging/2011/08/nuspec.xsd'
+#the time given to every file in a package, the earliest a zip can hold, so packing is repeatable
+NUPKG_DATE_TIME=(1980,1,1,0,0,0)
+#the nuspec metadata task serve-feed lists for each package
+NUSPEC_FEED_FIELDS=('id','version','title','authors','owners','description','summary','releaseNotes','copyright','tags',
+    'projectUrl','licenseUrl','iconUrl','requireLicenseAcceptance')
+
+
+def nuspec_files(proj_dir,files):
+    """Return the (package path,file) of each file the nuspec <files> element lists, sorted by package path.
+
+    As with 'nuget pack', a wildcard matching nothing (as in the .pdb files of a build without symbols) is skipped
+    with a warning, and only a missing file named outright fails
+    """
+    found={}
+    for file in (files if files is not None else []):
+        src=file.get('src')
+        target=(file.get('target') or '').replace('\\','/').strip('/')
+        matches=[path for path in glob.glob(os.path.join(proj_dir,os_path(src))) if os.path.isfile(path)]
+        if not matches:
+            if not glob.has_magic(src):
+                raise BuildError('no file {} in {}'.format(src,proj_dir))
+            log('skipping {}, no files match it in {}'.format(src,proj_dir))
+            continue
+        for path in matches:
+            #a target with the same extension as a single file names the file, otherwise it's the dir to put it in
+            if not glob.has_magic(src) and os.path.splitext(target)[1].lower() == os.path.splitext(path)[1].lower():
+                found[target]=path
+            else:
+                found[(target + '/' if target else '') + os.path.basename(path)]=path
+    if files is not None and len(files) and not found:
+        raise BuildError('none of the files the nuspec lists are in ' + proj_dir)
+    return sorted(found.items())
+
+
+class NupkgWriter:
+    """Writes a .nupkg (an OPC zip) with the given manifest and the files added to it.
+
+    Entries are written in a fixed order with fixed timestamps, so the same inputs always give the same bytes.
+    The package only replaces any existing one once it has been written in full
+    """
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.manifest = manifest
+        self.id = manifest.find('metadata').findtext('id')
+        self.extensions = {'nuspec','rels','psmdcp'}
+        self.zip = zipfile.ZipFile(self.tmp_path,'w',zipfile.ZIP_DEFLATED)
+        self.add(self.id + '.nuspec',self.manifest_xml())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        if etype:
+            self.zip.close()
+            os.remove(self.tmp_path)
+            return
+        self.close()
+
+    def add(self, name, data):
+        info=zipfile.ZipInfo(name,NUPKG_DATE_TIME)
+        info.compress_type=zipfile.ZIP_DEFLATED
+        info.external_attr=0o644 << 16
+        self.zip.writestr(info,data)
+        ext=os.path.splitext(name)[1][1:].lower()
+        if ext:
+            self.extensions.add(ext)
+
+    def manifest_xml(self):
+        #nuget expects the nuspec schema namespace, which the templates leave out
+        root=ElementTree.Element('package',xmlns=NUSPEC_NS)
+        root.extend(self.manifest)
+        return ElementTree.tostring(root,encoding='utf-8')
+
+    def close(self):
+        metadata=self.manifest.find('metadata')
+        version=metadata.findtext('version')
+        props_path='package/services/metadata/core-properties/{}.psmdcp'.format(hashlib.sha1((self.id + version).encode()).hexdigest()[:32])
+
+        props=ElementTree.Element('coreProperties',{'xmlns':'http://schemas.openxmlformats.org/package/2006/metadata/core-properties',
+            'xmlns:dc':'http://purl.org/dc/elements/1.1/'})
+        for tag,text in [('dc:creator',metadata.findtext('authors')),('dc:description',metadata.findtext('description')),
+                ('dc:identifier',self.id),('version',version),('keywords',metadata.findtext('tags')),('lastModifiedBy','build.py')]:
+            ElementTree.SubElement(props,tag).text=(text or '').strip()
+        self.add(props_path,ElementTree.tostring(props,encoding='utf-8'))
+
+        rels=ElementTree.Element('Relationships',xmlns='http://schemas.openxmlformats.org/package/2006/relationships')
+        ElementTree.SubElement(rels,'Relationship',Type='http://schemas.microsoft.com/packaging/2010/07/manifest',Target='/' + self.id + '.nuspec',Id='R1')
+        ElementTree.SubElement(rels,'Relationship',Type='http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties',Target='/' + props_path,Id='R2')
+        self.add('_rels/.rels',ElementTree.tostring(rels,encoding='utf-8'))
+
+        types=ElementTree.Element('Types',xmlns='http://schemas.openxmlformats.org/package/2006/content-types')
+        for ext in sorted(self.extensions):
+            content_type={'rels':'application/vnd.openxmlformats-package.relationships+xml',
+                'psmdcp':'application/vnd.openxmlformats-package.core-properties+xml'}.get(ext,'application/octet')
+            ElementTree.SubElement(types,'Default',Extension=ext,ContentType=content_type)
+        self.add('[Content_Types].xml',ElementTree.tostring(types,encoding='utf-8'))
+
+        self.zip.close()
+        os.replace(self.tmp_path,self.path)
+
+
+def extract_nupkg(nupkg,package_dir):
+    """Unpack a .nupkg into 'package_dir' the way 'nuget install' lays it out, without running nuget"""
+    tmp_dir=package_dir + '.' + str(os.getpid()) + '.tmp'
+    shutil.rmtree(tmp_dir,ignore_errors=True)
+    with zipfile.ZipFile(nupkg) as archive:
+        for entry in archive.infolist():
+            name=urllib.parse.unquote(entry.filename)
+            #skip the opc packaging parts, and anything trying to escape the dir
+            if name.startswith(('_rels/','package/')) or name == '[Content_Types].xml' or name.endswith('/'):
+                continue
+            target=os.path.normpath(os.path.join(tmp_dir,os_path(name)))
+            if not target.startswith(tmp_dir + os.sep):
+                continue
+            ensure_dir_exists(target)
+            with archive.open(entry) as src, open(target,'wb') as dest:
+                shutil.copyfileobj(src,dest)
+    shutil.copyfile(nupkg,os.path.join(tmp_dir,os.path.basename(nupkg)))
+    shutil.rmtree(package_dir,ignore_errors=True)
+    os.replace(tmp_dir,package_dir)
+
+
+def nupkg_id_version(name):
+    """Return the (id,version,is symbols) of a package from its file name, as in TestFirst.Net.1.2.3-beta.symbols.nupkg"""
+    base=name[:-len('.nupkg')]
+    symbols=base.lower().endswith('.symbols')
+    if symbols:
+        base=base[:-len('.symbols')]
+    match=re.match(r'^(.+?)\.(\d+(?:\.\d+)*(?:-[0-9A-Za-z.-]+)?)$',base)
+    if not match:
+        raise BuildError("can't tell the id and version of package " + name)
+    return match.group(1),match.group(2),symbols
+
+
+def version_key(version):
+    """Sort key for a nuget version. Numeric parts sort as numbers, and a prerelease before its release"""
+    release,sep,prerelease=version.partition('-')
+    return ([int(part) if part.isdigit() else 0 for part in release.split('.')],
+        not sep,
+        [(0,int(part),'') if part.isdigit() else (1,0,part.lower()) for part in prerelease.split('.')])
+
+
+def normalize_version(version):
+    """The version as the v3 feed gives it, as in 1.2.0.0 -> 1.2.0 and 1.02-Beta -> 1.2.0-beta"""
+    release,sep,prerelease=version.split('+')[0].partition('-')
+    parts=[str(int(part)) if part.isdigit() else part for part in release.split('.')]
+    if len(parts) == 4 and parts[3] == '0':
+        parts=parts[:3]
+    parts+=['0'] * (3 - len(parts))
+    return ('.'.join(parts) + sep + prerelease).lower()
+
+
+def nupkg_metadata(path):
+    """Return what a feed says of a package, as read from its .nuspec: id, version, description, dependencies etc.
+    Along with the sha512 nuget (v2) clients check a download against"""
+    with zipfile.ZipFile(path) as archive:
+        nuspec=next((name for name in archive.namelist() if name.endswith('.nuspec') and '/' not in name),None)
+        if nuspec is None:
+            raise BuildError('no .nuspec in package ' + path)
+        manifest=ElementTree.fromstring(archive.read(nuspec))
+    for elem in manifest.iter():
+        elem.tag=elem.tag.rpartition('}')[2]
+    metadata=manifest.find('metadata')
+    meta={field:(metadata.findtext(field) or '').strip() for field in NUSPEC_FEED_FIELDS}
+    meta['requireLicenseAcceptance']=meta['requireLicenseAcceptance'].lower() == 'true'
+    #[[id,version range,target framework]..], from both the flat and the grouped form
+    meta['dependencies']=[]
+    dependencies=metadata.find('dependencies')
+    if dependencies is not None:
+        for dep in dependencies.findall('dependency'):
+            meta['dependencies'].append([dep.get('id'),dep.get('version',''),''])
+        for group in dependencies.findall('group'):
+            for dep in group.findall('dependency'):
+                meta['dependencies'].append([dep.get('id'),dep.get('version',''),group.get('targetFramework','')])
+    h=hashlib.sha512()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024),b''):
+            h.update(chunk)
+    meta['sha512']=base64.b64encode(h.digest()).decode('ascii')
+    return meta
+
+
+class LocalRepo:
+    """A dir of nuget packages, each a hardlink to a blob named by its content hash under .blobs/.
+
+    Packages with the same content share the one blob, and the same package added again is skipped. The index
+    (.index.json) records the id, version, hash and nuspec metadata of each package, so it can be listed, pruned
+    and served as a feed without walking the dir or reading the packages
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.blobs_dir = os.path.join(root,'.blobs')
+        self.index_path = os.path.join(root,'.index.json')
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError,ValueError):
+            self.index = {'packages':{}}
+            #packages copied in before there was an index
+            if os.path.isdir(root):
+                for name in sorted(os.listdir(root)):
+                    if name.endswith('.nupkg'):
+                        try:
+                            self.add(os.path.join(root,name),hash_file(os.path.join(root,name)))
+                        except BuildError as e:
+                            log('ignoring {} : {}'.format(name,e.msg))
+
+    def save(self):
+        ensure_dir_exists(self.index_path)
+        tmp_path=self.index_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path,'w') as f:
+            json.dump(self.index,f,indent=1,sort_keys=True)
+        os.replace(tmp_path,self.index_path)
+
+    def blob(self, sha):
+        return os.path.join(self.blobs_dir,sha[:2],sha + '.nupkg')
+
+    def packages(self):
+        """Return the (name,entry) of each package, sorted by name"""
+        return sorted(self.index['packages'].items())
+
+    def add(self, path, sha):
+        """Add the package with the given content hash. Return False if the repo already has it"""
+        name=os.path.basename(path)
+        pkg_id,version,symbols=nupkg_id_version(name)
+        target=os.path.join(self.root,name)
+        blob=self.blob(sha)
+        entry=self.index['packages'].get(name)
+        if entry and entry['sha'] == sha and os.path.isfile(target) and os.path.isfile(blob) and os.path.samefile(target,blob):
+            return False
+
+        if not os.path.isfile(blob):
+            #copied rather than linked, as the build may later change its copy in place
+            ensure_dir_exists(blob)
+            shutil.copyfile(path,blob + '.tmp')
+            os.replace(blob + '.tmp',blob)
+        tmp_path=target + '.tmp'
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        link_or_copy(blob,tmp_path)
+        os.replace(tmp_path,target)
+        self.index['packages'][name]={'id':pkg_id,'version':version,'symbols':symbols,'sha':sha,'size':os.path.getsize(blob)}
+        if not symbols:
+            #read once here, rather than by the feed on every restore
+            self.index['packages'][name]['metadata']=nupkg_metadata(blob)
+        return True
+
+    def add_metadata(self):
+        """Add the nuspec metadata of the packages indexed without it, by an older build. Return True if any were"""
+        added=False
+        for name,entry in self.packages():
+            if not entry['symbols'] and 'metadata' not in entry and os.path.isfile(self.blob(entry['sha'])):
+                entry['metadata']=nupkg_metadata(self.blob(entry['sha']))
+                added=True
+        return added
+
+    def remove(self, name):
+        log('\tremoving : ' + name)
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(self.root,name))
+        self.index['packages'].pop(name,None)
+
+    def prune(self, keep):
+        """Remove all but the last 'keep' versions of each package id, along with the blobs no longer used"""
+        versions={}
+        for name,entry in self.index['packages'].items():
+            versions.setdefault(entry['id'].lower(),set()).add(entry['version'])
+        for pkg_id,pkg_versions in versions.items():
+            dropped=sorted(pkg_versions,key=version_key)[:-keep] if keep > 0 else []
+            for name,entry in self.packages():
+                if entry['id'].lower() == pkg_id and entry['version'] in dropped:
+                    self.remove(name)
+        self.remove_unused_blobs()
+
+    def remove_unused_blobs(self):
+        used={entry['sha'] for entry in self.index['packages'].values()}
+        if not os.path.isdir(self.blobs_dir):
+            return
+        for prefix in os.listdir(self.blobs_dir):
+            for name in os.listdir(os.path.join(self.blobs_dir,prefix)):
+                if name[:-len('.nupkg')] not in used:
+                    os.remove(os.path.join(self.blobs_dir,prefix,name))
+
+    def clear(self):
+        for name,entry in self.packages():
+            self.remove(name)
+        #along with those that never made it into the index, such as copied in by hand
+        if os.path.isdir(self.root):
+            for name in sorted(os.listdir(self.root)):
+                if name.endswith('.nupkg'):
+                    self.remove(name)
+        shutil.rmtree(self.blobs_dir,ignore_errors=True)
+        self.save()
@@ -0,0 +1,285 @@
+# ----------------- perf metrics, for build.py ---------------------------
+#
+# Stats of the metrics files PerformanceMetricsWriter writes, and a columnar store of them for querying large ones
+
+import os
+import re
+import json
+import math
+import shutil
+import datetime
+import array
+
+from build_core import BuildError, log
+
+
+def perf_test_name(metrics_file):
+    """The test name from a metrics file named as in 'metrics_<TestName>_<yyyyMMdd-HHmmss>.csv'"""
+    match=re.match(r'metrics_(.*?)_?\d{8}-\d{6}\.csv$',os.path.basename(metrics_file))
+    return (match.group(1) if match else '') or os.path.splitext(os.path.basename(metrics_file))[0]
+
+
+def perf_stats(metrics_files):
+    """Read the metrics lines written by PerformanceMetricsWriter (MetricsFileUtil.ToLine) and return the count, errors,
+    throughput (successful calls/sec) and p50/p95/p99 of the values for each '<test>/<metric name>'
+    """
+    values={}
+    errors={}
+    first={}
+    last={}
+    for path in metrics_files:
+        test=perf_test_name(path)
+        with open(path,errors='replace') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                #MachineId,AgentId,ThreadId,TimeFromStartMs,CallId,Name,Timestamp,Value,IsError,Data
+                parts=line.rstrip('\n').split(',',9)
+                if len(parts) < 9:
+                    continue
+                key=test + '/' + parts[5]
+                try:
+                    value=float(parts[7])
+                except ValueError:
+                    continue
+                #the timestamp format, yyyyMMdd-HHmm:ss.fff, sorts as a string
+                timestamp=parts[6]
+                if key not in values:
+                    values[key]=[]
+                    errors[key]=0
+                    first[key]=last[key]=timestamp
+                first[key]=min(first[key],timestamp)
+                last[key]=max(last[key],timestamp)
+                if parts[8] == 't':
+                    errors[key]+=1
+                else:
+                    values[key].append(value)
+
+    stats={}
+    for key,key_values in values.items():
+        key_values.sort()
+        seconds=(parse_metric_time(last[key]) - parse_metric_time(first[key])).total_seconds()
+        stats[key]={
+            'count':len(key_values),
+            'errors':errors[key],
+            'throughput':len(key_values) / seconds if seconds > 0 else float(len(key_values)),
+            'p50':percentile(key_values,50),
+            'p95':percentile(key_values,95),
+            'p99':percentile(key_values,99) }
+    return stats
+
+
+def parse_metric_time(timestamp):
+    return datetime.datetime.strptime(timestamp,'%Y%m%d-%H%M:%S.%f')
+
+
+def percentile(sorted_values,pct):
+    """Nearest rank percentile"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0,int(math.ceil(pct / 100.0 * len(sorted_values))) - 1)]
+
+
+def print_perf_stats(stats):
+    log('{:<60} {:>9} {:>7} {:>10} {:>9} {:>9} {:>9}'.format('test/metric','count','errors','per sec','p50','p95','p99'))
+    for key in sorted(stats):
+        stat=stats[key]
+        log('{:<60} {:>9} {:>7} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(key,stat['count'],stat['errors'],stat['throughput'],stat['p50'],stat['p95'],stat['p99']))
+
+
+def perf_regressions(stats,baseline,threshold_pct):
+    """Describe each metric whose throughput has dropped, or whose latency percentiles have risen, by more than the threshold"""
+    regressions=[]
+    worse=1 + threshold_pct / 100.0
+    for key in sorted(stats):
+        current=stats[key]
+        base=baseline.get(key)
+        if not base:
+            continue
+        if base['throughput'] > 0 and current['throughput'] * worse < base['throughput']:
+            regressions.append('{} throughput {:.1f}/sec, baseline {:.1f}/sec'.format(key,current['throughput'],base['throughput']))
+        for pct in ('p50','p95','p99'):
+            if base[pct] > 0 and current[pct] > base[pct] * worse:
+                regressions.append('{} {} {:.1f}, baseline {:.1f}'.format(key,pct,current[pct],base[pct]))
+    return regressions
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise BuildError('numpy is needed for the perf metrics store. Install it with "pip install numpy"')
+    return numpy
+
+
+#the column name and array type of each field kept from a metrics line
+PERF_STORE_COLUMNS=[('test','i'),('metric','i'),('time_ms','d'),('timestamp_ms','q'),('value','d'),('error','B')]
+#rows converted, or queried, at a time. Bounds the memory used however big the metrics file is
+PERF_STORE_CHUNK_ROWS=1 << 18
+
+def open_perf_store(path):
+    """Open the columnar store for a metrics file, converting the file first if the store is missing or older"""
+    if os.path.isdir(path):
+        return PerfStore(path)
+    store_dir=path + '.cols'
+    meta=os.path.join(store_dir,'meta.json')
+    if not os.path.isfile(meta) or os.path.getmtime(meta) < os.path.getmtime(path):
+        convert_perf_metrics(path,store_dir)
+    return PerfStore(store_dir)
+
+
+def convert_perf_metrics(metrics_file,store_dir):
+    """Stream a PerformanceMetricsWriter file into a dir of one raw binary array per column.
+
+    The machine/agent/thread test ids and metric names are interned to ints, listed in meta.json. CallId and Data are dropped
+    """
+    log('converting {} to {}'.format(metrics_file,store_dir))
+    tmp_dir=store_dir + '.' + str(os.getpid()) + '.tmp'
+    shutil.rmtree(tmp_dir,ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    tests={}
+    metrics={}
+    epoch_secs={}
+    count=0
+    files={name:open(os.path.join(tmp_dir,name + '.bin'),'wb') for name,typecode in PERF_STORE_COLUMNS}
+    columns={name:array.array(typecode) for name,typecode in PERF_STORE_COLUMNS}
+
+    def flush():
+        for name,column in columns.items():
+            column.tofile(files[name])
+            del column[:]
+
+    try:
+        with open(metrics_file,errors='replace') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                #MachineId,AgentId,ThreadId,TimeFromStartMs,CallId,Name,Timestamp,Value,IsError,Data
+                parts=line.split(',',9)
+                if len(parts) < 9:
+                    continue
+                #timestamp as in yyyyMMdd-HHmm:ss.fff, converted a second at a time
+                timestamp=parts[6]
+                second=timestamp[:16]
+                try:
+                    if second not in epoch_secs:
+                        epoch_secs[second]=int((datetime.datetime.strptime(second,'%Y%m%d-%H%M:%S') - datetime.datetime(1970,1,1)).total_seconds())
+                    timestamp_ms=epoch_secs[second] * 1000 + int(timestamp[17:20] or 0)
+                    time_ms=float(parts[3])
+                    value=float(parts[7])
+                except ValueError:
+                    continue
+                columns['test'].append(tests.setdefault(parts[0] + '/' + parts[1] + '/' + parts[2],len(tests)))
+                columns['metric'].append(metrics.setdefault(parts[5],len(metrics)))
+                columns['time_ms'].append(time_ms)
+                columns['timestamp_ms'].append(timestamp_ms)
+                columns['value'].append(value)
+                columns['error'].append(1 if parts[8] == 't' else 0)
+                count+=1
+                if count % PERF_STORE_CHUNK_ROWS == 0:
+                    flush()
+        flush()
+    finally:
+        for f in files.values():
+            f.close()
+
+    with open(os.path.join(tmp_dir,'meta.json'),'w') as f:
+        json.dump({
+            'source':metrics_file,
+            'count':count,
+            'columns':dict(PERF_STORE_COLUMNS),
+            'tests':sorted(tests,key=tests.get),
+            'metrics':sorted(metrics,key=metrics.get) },f,indent=1)
+    shutil.rmtree(store_dir,ignore_errors=True)
+    os.replace(tmp_dir,store_dir)
+
+
+class PerfStore:
+    """Memory mapped, column per field perf metrics, as written by convert_perf_metrics.
+
+    Queries are vectorized over the columns a chunk of rows at a time, so run in bounded memory
+    """
+
+    def __init__(self, store_dir):
+        np = import_numpy()
+        self.np = np
+        with open(os.path.join(store_dir,'meta.json')) as f:
+            meta=json.load(f)
+        self.source = meta['source']
+        self.count = meta['count']
+        self.tests = meta['tests']
+        self.metrics = meta['metrics']
+        self.columns = {}
+        for name,typecode in PERF_STORE_COLUMNS:
+            dtype=np.dtype(typecode)
+            if self.count:
+                self.columns[name] = np.memmap(os.path.join(store_dir,name + '.bin'),dtype=dtype,mode='r',shape=(self.count,))
+            else:
+                self.columns[name] = np.zeros(0,dtype=dtype)
+
+    def chunks(self):
+        for start in range(0,self.count,PERF_STORE_CHUNK_ROWS):
+            yield {name:column[start:start + PERF_STORE_CHUNK_ROWS] for name,column in self.columns.items()}
+
+    def interval_throughput(self, interval_secs):
+        """Return {metric name: array of the successful calls in each interval from the first metric}"""
+        np=self.np
+        first=min(int(chunk['timestamp_ms'].min()) for chunk in self.chunks())
+        last=max(int(chunk['timestamp_ms'].max()) for chunk in self.chunks())
+        interval_ms=max(1,int(interval_secs * 1000))
+        intervals=(last - first) // interval_ms + 1
+        counts=np.zeros(len(self.metrics) * intervals,dtype=np.int64)
+        for chunk in self.chunks():
+            ok=chunk['error'] == 0
+            index=chunk['metric'][ok].astype(np.int64) * intervals + (chunk['timestamp_ms'][ok] - first) // interval_ms
+            counts+=np.bincount(index,minlength=counts.size)
+        counts=counts.reshape(len(self.metrics),intervals)
+        return {name:counts[i] for i,name in enumerate(self.metrics)}
+
+    def percentiles(self, pcts, bins=4096):
+        """Return {metric name: {pct: value}} for the successful calls, read from a log spaced histogram of each metric's values"""
+        np=self.np
+        lows=np.full(len(self.metrics),np.inf)
+        highs=np.full(len(self.metrics),-np.inf)
+        for chunk in self.chunks():
+            ok=chunk['error'] == 0
+            np.minimum.at(lows,chunk['metric'][ok],chunk['value'][ok])
+            np.maximum.at(highs,chunk['metric'][ok],chunk['value'][ok])
+
+        edges=[]
+        for low,high in zip(lows,highs):
+            if not np.isfinite(low):
+                edges.append(None)
+            elif low < 0 or high == low:
+                edges.append(np.linspace(low,high if high > low else low + 1,bins + 1))
+            else:
+                edges.append(np.expm1(np.linspace(np.log1p(low),np.log1p(high),bins + 1)))
+        hists=np.zeros((len(self.metrics),bins),dtype=np.int64)
+        for chunk in self.chunks():
+            ok=chunk['error'] == 0
+            for i,metric_edges in enumerate(edges):
+                if metric_edges is not None:
+                    hists[i]+=np.histogram(chunk['value'][ok & (chunk['metric'] == i)],bins=metric_edges)[0]
+
+        found={}
+        for i,name in enumerate(self.metrics):
+            total=hists[i].sum()
+            if not total:
+                continue
+            cumulative=np.cumsum(hists[i])
+            found[name]={pct:float(edges[i][min(bins,np.searchsorted(cumulative,pct / 100.0 * total) + 1)]) for pct in pcts}
+        return found
+
+    def thread_breakdown(self):
+        """Return {'machine/agent/thread': (successful calls,errors,mean value)}"""
+        np=self.np
+        calls=np.zeros(len(self.tests),dtype=np.int64)
+        errors=np.zeros(len(self.tests),dtype=np.int64)
+        totals=np.zeros(len(self.tests))
+        for chunk in self.chunks():
+            ok=chunk['error'] == 0
+            calls+=np.bincount(chunk['test'][ok],minlength=len(self.tests))
+            errors+=np.bincount(chunk['test'][~ok],minlength=len(self.tests))
+            totals+=np.bincount(chunk['test'][ok],weights=chunk['value'][ok],minlength=len(self.tests))
+        return {test:(int(calls[i]),int(errors[i]),totals[i] / calls[i] if calls[i] else 0.0) for i,test in enumerate(self.tests)}
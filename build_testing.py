@@ -0,0 +1,281 @@
+# ----------------- test results, shards and coverage, for build.py ---------------------------
+
+import os
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+
+from build_core import BuildError, log
+
+
+class TestRun:
+    """The outcome of running the tests of a test project"""
+
+    def __init__(self, proj):
+        self.proj = proj
+        self.started = time.time()
+        self.finished = None
+        self.error = None
+        self.cached = False
+        self.total = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def passed(self):
+        return not self.error and self.failed == 0
+
+    def seconds(self):
+        return self.finished - self.started
+
+    def describe(self):
+        status='PASS' if self.passed() else 'FAIL'
+        if self.cached:
+            status+=' (cached)'
+        text='{} {} : {} tests, {} failed, {} skipped in {:.1f}s'.format(status,self.proj,self.total,self.failed,self.skipped,self.seconds())
+        if self.error:
+            text+=' (' + self.error + ')'
+        return text
+
+
+def read_test_results(run,result_file):
+    """Fill in the test counts from the NUnit result xml"""
+    try:
+        results=ElementTree.parse(result_file).getroot()
+    except (OSError,ElementTree.ParseError) as e:
+        run.error=run.error or 'no test results in ' + result_file
+        return
+
+    def count(name):
+        return int(results.get(name) or 0)
+    run.total=count('total')
+    run.failed=count('errors') + count('failures') + count('invalid')
+    run.skipped=count('not-run') + count('inconclusive')
+
+
+#a namespace, a class declaration up to its opening brace, or a brace. Matched against the code with the comments and
+#strings blanked out, so the braces counted are the code's own
+SOURCE_SCOPE_RE=re.compile(r'\bnamespace\s+(?P<namespace>[\w.]+)\s*[{;]'
+    r'|^\s*(?:\[[^\]]*\]\s*)*(?P<modifiers>(?:(?:public|private|protected|internal|sealed|static|partial|abstract)\s+)*)class\s+'
+    r'(?P<name>\w+)\s*(?P<generic><[^>{]*>)?(?:\s*:\s*(?P<bases>[\w.,\s<>]+?))?\s*(?:where\b[^{]*)?\{'
+    r'|[{}]',re.MULTILINE)
+SOURCE_NOISE_RE=re.compile(r'//[^\n]*|/\*.*?\*/|@"(?:""|[^"])*"|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'',re.DOTALL)
+SOURCE_TEST_RE=re.compile(r'\[\s*(?:NUnit\.Framework\.)?(?:Test|TestCase|TestCaseSource|Theory)\s*[\](,]')
+
+
+def source_fixtures(paths):
+    """Return the full names of the test fixtures in the sources: the classes with [Test..] methods, and the classes
+    derived from them. Raises BuildError if there are fixtures which can't be run by the name read from the sources:
+    ones nested in other classes, generic ones, and tests in files with #if'd code, which may or may not be built"""
+    classes={}
+    for path in paths:
+        if not path.endswith('.cs'):
+            continue
+        with open(path,encoding='utf-8-sig',errors='replace') as f:
+            text=f.read()
+        code=SOURCE_NOISE_RE.sub(lambda match: re.sub(r'[^\n]',' ',match.group(0)),text)
+        if SOURCE_TEST_RE.search(code) and re.search(r'^\s*#\s*(?:if|elif)\b',code,re.MULTILINE):
+            raise BuildError('{} has tests along with #if\'d code'.format(path))
+        #the namespace or class (with the offset its body starts at) each brace still open opened, None for other braces
+        scopes=[]
+        for match in SOURCE_SCOPE_RE.finditer(code):
+            if match.group('namespace'):
+                #a file scoped namespace (ending in ;) is never closed
+                scopes.append(('namespace',match.group('namespace'),None))
+            elif match.group('name'):
+                name=match.group('name')
+                namespace='.'.join(scope[1] for scope in scopes if scope and scope[0] == 'namespace')
+                classes[name]={
+                    'name':(namespace + '.' if namespace else '') + name,
+                    'path':path,
+                    'abstract':'abstract' in match.group('modifiers').split(),
+                    'generic':match.group('generic') is not None,
+                    'nested':any(scope and scope[0] == 'class' for scope in scopes),
+                    'bases':[base.strip().split('<')[0].split('.')[-1] for base in (match.group('bases') or '').split(',')],
+                    'tests':False}
+                scopes.append(('class',name,match.end()))
+            elif match.group(0) == '{':
+                scopes.append(None)
+            elif scopes:
+                scope=scopes.pop()
+                if scope and scope[0] == 'class' and SOURCE_TEST_RE.search(code,scope[2],match.start()):
+                    classes[scope[1]]['tests']=True
+    #a class inheriting tests is a fixture too, to however many levels
+    changed=True
+    while changed:
+        changed=False
+        for cls in classes.values():
+            if not cls['tests'] and any(classes.get(base,{}).get('tests') for base in cls['bases']):
+                cls['tests']=changed=True
+    derived={base for cls in classes.values() for base in cls['bases']}
+    fixtures=[]
+    for short_name,cls in classes.items():
+        if not cls['tests'] or cls['abstract']:
+            continue
+        if cls['nested']:
+            raise BuildError('{} in {} is a fixture nested in another class'.format(cls['name'],cls['path']))
+        #a generic class is only a fixture of its own when there's none deriving from it
+        if cls['generic'] and short_name not in derived:
+            raise BuildError('{} in {} is a generic fixture'.format(cls['name'],cls['path']))
+        if not cls['generic']:
+            fixtures.append(cls['name'])
+    return sorted(fixtures)
+
+
+def fixture_durations(result_file):
+    """Return {fixture full name: secs} from an NUnit 2.x result xml"""
+    durations={}
+    def walk(suite,prefix):
+        for child in suite.findall('results/test-suite'):
+            kind=child.get('type')
+            if kind in ('TestFixture','ParameterizedFixture','GenericFixture'):
+                durations[prefix + child.get('name')]=float(child.get('time') or 0)
+            elif kind in ('Namespace','SetUpFixture'):
+                walk(child,prefix + child.get('name') + '.')
+            else:
+                walk(child,prefix)
+    try:
+        root=ElementTree.parse(result_file).getroot()
+    except (OSError,ElementTree.ParseError):
+        return durations
+    for suite in root.findall('test-suite'):
+        walk(suite,'')
+    return durations
+
+
+def pack_shards(weights,count):
+    """Longest processing time first: each item, longest first, goes to the shard with the least so far. Returns
+    the items of each shard, longest first"""
+    shards=[[] for i in range(count)]
+    loads=[0.0] * count
+    for item in sorted(weights,key=lambda item: (-weights[item],item)):
+        least=loads.index(min(loads))
+        shards[least].append(item)
+        loads[least]+=weights[item]
+    return shards
+
+
+def merge_test_results(paths,merged_path):
+    """Merge the NUnit 2.x result xml of each shard into one, as if the tests had all been run in one go.
+    Return False if there were no results to merge"""
+    merged=None
+    for path in paths:
+        try:
+            root=ElementTree.parse(path).getroot()
+        except (OSError,ElementTree.ParseError):
+            continue
+        if merged is None:
+            merged=root
+            continue
+        for name in ('total','errors','failures','not-run','inconclusive','ignored','skipped','invalid'):
+            merged.set(name,str(int(merged.get(name) or 0) + int(root.get(name) or 0)))
+        merge_test_suites(merged,root)
+    if merged is None:
+        return False
+    ElementTree.ElementTree(merged).write(merged_path,encoding='utf-8',xml_declaration=True)
+    return True
+
+
+def merge_test_suites(into,source):
+    """Add the suites and test cases under 'source' to those under 'into', merging the suites with the same name"""
+    def children(elem,create=False):
+        found=elem if elem.tag == 'test-results' else elem.find('results')
+        if found is None and create:
+            found=ElementTree.SubElement(elem,'results')
+        return found
+
+    source_children=children(source)
+    if source_children is None:
+        return
+    into_children=children(into,True)
+    by_name={(child.tag,child.get('name')):child for child in into_children}
+    for child in source_children:
+        if child.tag not in ('test-suite','test-case'):
+            continue
+        match=by_name.get((child.tag,child.get('name')))
+        if match is None or child.tag != 'test-suite':
+            into_children.append(child)
+            continue
+        merge_test_suites(match,child)
+        for name in ('time','asserts'):
+            if child.get(name) is not None:
+                total=float(match.get(name) or 0) + float(child.get(name))
+                match.set(name,'{:.3f}'.format(total) if name == 'time' else str(int(total)))
+        if child.get('executed') == 'True':
+            match.set('executed','True')
+        if child.get('success') == 'False':
+            match.set('success','False')
+        results=('Ignored','Inconclusive','Success','Failure','Error')
+        if child.get('result') in results and (match.get('result') not in results or results.index(child.get('result')) > results.index(match.get('result'))):
+            match.set('result',child.get('result'))
+
+
+def merge_coverage(paths,merged_path):
+    """Merge OpenCover results into one file, reading and writing a module at a time so memory stays bounded
+    by the size of a module rather than of all the results.
+
+    A module covered by more than one test run is only held until its last copy is read, and written once with
+    the visit counts of its sequence and branch points summed
+    """
+    def modules(path):
+        #yield each <Module> once fully read, then drop it from the tree being built
+        parent=None
+        for event,elem in ElementTree.iterparse(path,events=('start','end')):
+            if event == 'start' and elem.tag == 'Modules':
+                parent=elem
+            elif event == 'end' and elem.tag == 'Module':
+                yield elem
+                if parent is not None:
+                    parent.remove(elem)
+
+    def module_key(module):
+        return module.get('hash') or module.findtext('ModuleName')
+
+    copies={}
+    for path in paths:
+        for module in modules(path):
+            key=module_key(module)
+            copies[key]=copies.get(key,0) + 1
+
+    pending={}
+    tmp_path=merged_path + '.tmp'
+    with open(tmp_path,'w',encoding='utf-8') as out:
+        out.write('<?xml version="1.0" encoding="utf-8"?>\n<CoverageSession>\n<Modules>\n')
+        for path in paths:
+            for module in modules(path):
+                key=module_key(module)
+                if copies[key] > 1:
+                    if key not in pending:
+                        pending[key]=module
+                    else:
+                        pending[key]=merge_module(pending[key],module)
+                    copies[key]-=1
+                    continue
+                if key in pending:
+                    module=merge_module(pending.pop(key),module)
+                module.tail=None
+                out.write(ElementTree.tostring(module,encoding='unicode'))
+                out.write('\n')
+        out.write('</Modules>\n</CoverageSession>\n')
+    os.replace(tmp_path,merged_path)
+
+
+def merge_module(module,other):
+    """Return the merge of two copies of the same module: the visit counts of both added together, or whichever is
+    covered, as opencover writes the module without points where its filters skipped it"""
+    def covered(copy):
+        return not copy.get('skippedDueTo') and next(copy.iter('SequencePoint'),None) is not None
+
+    if not covered(other):
+        return module
+    if not covered(module):
+        return other
+    for tag in ('SequencePoint','BranchPoint'):
+        points=list(module.iter(tag))
+        other_points=list(other.iter(tag))
+        if len(points) != len(other_points):
+            log('coverage of module {} differs between runs, keeping the first'.format(module.findtext('ModuleName')))
+            return module
+    for tag in ('SequencePoint','BranchPoint'):
+        for point,other_point in zip(module.iter(tag),other.iter(tag)):
+            point.set('vc',str(int(point.get('vc','0')) + int(other_point.get('vc','0'))))
+    return module
@@ -0,0 +1,100 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+import build
+
+
+CSPROJ='''<?xml version="1.0" encoding="utf-8"?>
+<Project ToolsVersion="12.0" xmlns="http://schemas.microsoft.com/developer/msbuild/2003">
+  <ItemGroup>
+{}  </ItemGroup>
+</Project>
+'''
+
+
+class AffectedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.root=self.tmp.name
+        self.saved={name:getattr(build,name) for name in ('SOLUTION_DIR','SOLUTION','NUGET_CONFIG','AFFECTED')}
+        build.SOLUTION_DIR=self.root
+        build.SOLUTION='Test.sln'
+        build.NUGET_CONFIG=os.path.join(self.root,'NuGet.Config')
+        build.AFFECTED=None
+        self.forget_projects()
+        #App -> Lib -> Core, Other on its own, Lib also compiling the shared ..\Shared.cs
+        sln=[]
+        for name,items in [('App',['<ProjectReference Include="..\\Lib\\Lib.csproj" />']),
+                ('Lib',['<ProjectReference Include="..\\Core\\Core.csproj" />','<Compile Include="..\\Shared.cs" />']),
+                ('Core',[]),('Other',[])]:
+            self.write(name + '/' + name + '.csproj',CSPROJ.format(''.join('    ' + item + '\n' for item in items)))
+            self.write(name + '/Class.cs','class C {}')
+            sln.append('Project("{{FAE04EC0-301F-11D3-BF4B-00C04F79EFBC}}") = "{0}", "{0}\\{0}.csproj", "{{0}}"\nEndProject'.format(name))
+        self.write('Shared.cs','class Shared {}')
+        self.write('Test.sln','\n'.join(sln) + '\n')
+
+    def tearDown(self):
+        for name,value in self.saved.items():
+            setattr(build,name,value)
+        self.forget_projects()
+        self.tmp.cleanup()
+
+    def forget_projects(self):
+        build.solution_projects.clear()
+        build.solution_stamps.clear()
+        build.affected_by_ref.clear()
+
+    def write(self,rel,text):
+        path=os.path.join(self.root,build.os_path(rel))
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'w') as f:
+            f.write(text)
+        return path
+
+    def changed(self,*rels):
+        return build.projects_changed([os.path.join(self.root,build.os_path(rel)) for rel in rels])
+
+    def test_projects_are_built_after_their_references(self):
+        self.assertEqual(build.build_order(build.load_projects()),['Core','Lib','App','Other'])
+
+    def test_a_change_affects_its_project_and_those_depending_on_it(self):
+        self.assertEqual(self.changed('Core/Class.cs'),{'Core','Lib','App'})
+        self.assertEqual(self.changed('App/Class.cs'),{'App'})
+        self.assertEqual(self.changed('Other/Other.csproj'),{'Other'})
+
+    def test_a_linked_source_affects_the_projects_compiling_it(self):
+        self.assertEqual(self.changed('Shared.cs'),{'Lib','App'})
+
+    def test_built_outputs_affect_nothing(self):
+        self.assertEqual(self.changed('Core/bin/Release/Core.dll','Core/obj/Release/Core.dll','README.md'),set())
+
+    def test_the_solution_and_nuget_config_affect_everything(self):
+        everything={'App','Lib','Core','Other'}
+        self.assertEqual(self.changed('Test.sln'),everything)
+        self.assertEqual(self.changed('NuGet.Config'),everything)
+
+    def test_affected_since_a_git_ref_includes_uncommitted_and_untracked_changes(self):
+        def git(*args):
+            subprocess.run(['git','-c','user.name=test','-c','user.email=test@example.com'] + list(args),cwd=self.root,
+                check=True,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+        git('init','-q')
+        git('add','-A')
+        git('commit','-qm','base')
+        git('branch','base')
+        self.write('Other/Class.cs','class C { int x; }')
+        git('commit','-qam','other')
+        self.write('Lib/Class.cs','class C { int y; }')
+        self.write('Core/New.cs','class New {}')
+        self.assertEqual(build.affected_projects('base'),{'Other','Lib','Core','App'})
+        git('add','-A')
+        git('commit','-qm','more')
+        self.assertEqual(build.affected_projects('HEAD~1'),{'Lib','Core','App'})
+        build.AFFECTED='HEAD~1'
+        self.assertEqual(build.affected(['App','Core','Other']),['App','Core'])
+
+
+if __name__ == '__main__':
+    unittest.main()
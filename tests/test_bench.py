@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+BUILD_PY=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'build.py')
+
+
+class BenchTest(unittest.TestCase):
+    """Runs build.py bench, as CI would, on the smallest synthetic solution"""
+
+    def run_bench(self,tmp,baseline_secs):
+        sizes={'projects':1,'files':1,'doc_kb':1,'output_mb':0.0,'tasks':10,'repeat':1}
+        baseline=os.path.join(tmp,'bench-baseline.json')
+        with open(baseline,'w') as f:
+            json.dump({'register-tasks':{'secs':baseline_secs,'median_secs':baseline_secs,'peak_kb':1024 * 1024,'blocks':0,'sizes':sizes}},f)
+        return subprocess.run([sys.executable,BUILD_PY,'bench','bench_cases=register-tasks','bench_dir=' + tmp + os.sep,
+            'bench_baseline=' + baseline,'bench_tolerance=0','bench_projects=1','bench_files=1','bench_doc_kb=1',
+            'bench_output_mb=0','bench_tasks=10','bench_repeat=1','trace=false'],
+            stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True)
+
+    def test_slower_than_the_baseline_exits_non_zero(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            proc=self.run_bench(tmp,0.000001)
+        self.assertNotEqual(proc.returncode,0,proc.stdout)
+        self.assertIn('slower or bigger than the baseline',proc.stdout)
+
+    def test_within_the_baseline_exits_zero(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            proc=self.run_bench(tmp,1000.0)
+        self.assertEqual(proc.returncode,0,proc.stdout)
+        self.assertIn('vs baseline',proc.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import hashlib
+import http.server
+import io
+import os
+import stat
+import tempfile
+import threading
+import unittest
+import urllib.error
+import zipfile
+
+import build_cache
+from build_core import BuildError
+
+
+class CacheServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.server=http.server.ThreadingHTTPServer(('localhost',0),build_cache.CacheRequestHandler)
+        self.server.daemon_threads=True
+        self.server.cache=build_cache.DirOutputCache(self.tmp.name,1024 * 1024)
+        self.server.token='s3cret'
+        self.server.max_bytes=1000
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.url='http://localhost:{}/'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def files(self):
+        return sorted(name for root,dirs,files in os.walk(self.tmp.name) for name in files)
+
+    def test_outputs_uploaded_with_the_token_are_served(self):
+        cache=build_cache.HttpOutputCache(self.url,'s3cret')
+        data=b'zipped outputs'
+        digest=hashlib.sha256(data).hexdigest()
+        cache.put_blob(digest,data)
+        cache.put_action('a' * 64,{'digest':digest,'size':len(data)})
+        reader=build_cache.HttpOutputCache(self.url,None)
+        self.assertEqual(reader.get_action('a' * 64),{'digest':digest,'size':len(data)})
+        self.assertEqual(reader.get_blob(digest),data)
+        self.assertIsNone(reader.get_blob('b' * 64))
+
+    def test_uploads_without_the_token_are_refused(self):
+        data=b'zipped outputs'
+        for token in (None,'guess'):
+            with self.subTest(token):
+                with self.assertRaises(urllib.error.HTTPError) as raised:
+                    build_cache.HttpOutputCache(self.url,token).put_blob(hashlib.sha256(data).hexdigest(),data)
+                self.assertEqual(raised.exception.code,403)
+        self.server.token=None
+        with self.assertRaises(urllib.error.HTTPError):
+            build_cache.HttpOutputCache(self.url,'').put_blob(hashlib.sha256(data).hexdigest(),data)
+        self.assertEqual(self.files(),[])
+
+    def test_a_blob_not_matching_its_sha256_is_not_stored(self):
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            build_cache.HttpOutputCache(self.url,'s3cret').put_blob('c' * 64,b'zipped outputs')
+        self.assertEqual(raised.exception.code,400)
+        self.assertEqual(self.files(),[])
+
+    def test_uploads_over_the_max_size_are_refused(self):
+        data=b'x' * 1001
+        with self.assertRaises(OSError):
+            build_cache.HttpOutputCache(self.url,'s3cret').put_blob(hashlib.sha256(data).hexdigest(),data)
+        self.assertEqual(self.files(),[])
+
+    def test_an_action_must_name_a_blob(self):
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            build_cache.HttpOutputCache(self.url,'s3cret').put_action('a' * 64,{'digest':'../../etc/passwd'})
+        self.assertEqual(raised.exception.code,400)
+        self.assertEqual(self.files(),[])
+
+
+class FakeProject:
+
+    def __init__(self, root, name):
+        self.name=name
+        self.dir=os.path.join(root,name)
+        self.assembly=name + '.dll'
+
+
+def digest_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class DirOutputCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.cache=build_cache.DirOutputCache(os.path.join(self.tmp.name,'cache'),250)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def put(self,data,mtime):
+        self.cache.put_blob(digest_of(data),data)
+        os.utime(self.cache.path('cas',digest_of(data)),(mtime,mtime))
+
+    def test_the_least_recently_used_blobs_are_evicted(self):
+        old,older,oldest=b'1' * 100,b'2' * 100,b'3' * 100
+        self.put(oldest,1000)
+        self.put(older,2000)
+        self.put(old,3000)
+        #all three over the 250 bytes, so the oldest went
+        self.assertIsNone(self.cache.get_blob(digest_of(oldest)))
+        #and reading one makes it the latest
+        self.assertEqual(self.cache.get_blob(digest_of(older)),older)
+        self.cache.put_blob(digest_of(b'4' * 100),b'4' * 100)
+        self.assertIsNone(self.cache.get_blob(digest_of(old)))
+        self.assertEqual(self.cache.get_blob(digest_of(older)),older)
+        self.assertEqual(self.cache.get_blob(digest_of(b'4' * 100)),b'4' * 100)
+
+    def test_a_blob_cut_short_or_not_matching_is_not_stored(self):
+        data=b'zipped outputs'
+        with self.assertRaises(BuildError):
+            self.cache.put_blob_from(digest_of(data),io.BytesIO(data[:5]),len(data))
+        with self.assertRaises(BuildError):
+            self.cache.put_blob(digest_of(b'other'),data)
+        with self.assertRaises(BuildError):
+            self.cache.get_blob('../' + 'a' * 61)
+        self.assertEqual([name for root,dirs,files in os.walk(self.tmp.name) for name in files],[])
+
+
+class OutputsTest(unittest.TestCase):
+    """Stores a project's outputs in a DirOutputCache, and fetches them into a clean checkout"""
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.cache=build_cache.DirOutputCache(os.path.join(self.tmp.name,'cache'),1024 * 1024)
+        self.built=FakeProject(os.path.join(self.tmp.name,'built'),'Proj')
+        self.clean=FakeProject(os.path.join(self.tmp.name,'clean'),'Proj')
+        for rel in ('bin/Release/Proj.dll','bin/Release/Proj.pdb','bin/Release/de/Proj.resources.dll','obj/Release/Proj.dll',
+                'obj/Release/Proj.csproj.FileListAbsolute.txt','bin/Debug/Proj.dll'):
+            self.write(self.built,rel,rel.encode())
+        os.chmod(os.path.join(self.built.dir,'bin','Release','Proj.dll'),0o755)
+        self.key='a' * 64
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self,project,rel,data):
+        path=os.path.join(project.dir,build_cache.os_path(rel))
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'wb') as f:
+            f.write(data)
+
+    def files(self,project):
+        return sorted(os.path.relpath(os.path.join(root,name),project.dir).replace(os.sep,'/')
+            for root,dirs,files in os.walk(project.dir) for name in files)
+
+    def test_outputs_are_fetched_as_built(self):
+        self.assertEqual(build_cache.pack_outputs(self.built,'Release'),build_cache.pack_outputs(self.built,'Release'))
+        build_cache.store_outputs(self.cache,self.key,self.built,'Release')
+        self.assertTrue(build_cache.fetch_outputs(self.cache,self.key,self.clean,'Release'))
+        self.assertEqual(self.files(self.clean),['bin/Release/Proj.dll','bin/Release/Proj.pdb','bin/Release/de/Proj.resources.dll',
+            'obj/Release/Proj.dll'])
+        with open(os.path.join(self.clean.dir,'bin','Release','de','Proj.resources.dll'),'rb') as f:
+            self.assertEqual(f.read(),b'bin/Release/de/Proj.resources.dll')
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.clean.dir,'bin','Release','Proj.dll')).st_mode),0o755)
+
+    def test_missing_outputs_are_a_miss(self):
+        self.assertFalse(build_cache.fetch_outputs(self.cache,self.key,self.clean,'Release'))
+        build_cache.store_outputs(self.cache,self.key,self.built,'Release')
+        os.remove(self.cache.path('cas',self.cache.get_action(self.key)['digest']))
+        self.assertFalse(build_cache.fetch_outputs(self.cache,self.key,self.clean,'Release'))
+        self.assertFalse(os.path.exists(self.clean.dir))
+
+    def test_outputs_failing_the_integrity_checks_are_a_miss(self):
+        build_cache.store_outputs(self.cache,self.key,self.built,'Release')
+        with open(self.cache.path('cas',self.cache.get_action(self.key)['digest']),'r+b') as f:
+            f.seek(40)
+            f.write(b'tampered')
+        self.assertFalse(build_cache.fetch_outputs(self.cache,self.key,self.clean,'Release'))
+        #a zip matching its sha256, but of files outside the outputs
+        for name in ('../../escaped.dll','bin/Debug/Proj.dll'):
+            with self.subTest(name):
+                out=io.BytesIO()
+                with zipfile.ZipFile(out,'w') as archive:
+                    archive.writestr('bin/Release/Proj.dll','ok')
+                    archive.writestr(name,'not an output')
+                data=out.getvalue()
+                self.cache.put_blob(digest_of(data),data)
+                self.cache.put_action(self.key,{'digest':digest_of(data)})
+                self.assertFalse(build_cache.fetch_outputs(self.cache,self.key,self.clean,'Release'))
+        self.assertFalse(os.path.exists(self.clean.dir))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name,'escaped.dll')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import time
+import unittest
+
+import build
+from build_core import BuildError
+
+
+class TrashTest(unittest.TestCase):
+    """Cleans a solution dir by moving what's cleaned into the trash, then deleting it"""
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.root=self.tmp.name
+        self.saved={name:getattr(build,name) for name in ('SOLUTION_DIR','NUGET_PKG_DIR','LOCAL_REPO','BUILD_CACHE_DIR',
+            'TRASH_DIR','CLEAN_WAIT','CLEAN_JOBS')}
+        build.SOLUTION_DIR=self.root
+        build.NUGET_PKG_DIR=os.path.join(self.root,'packages')
+        build.LOCAL_REPO=os.path.join(self.root,'repo')
+        build.BUILD_CACHE_DIR=os.path.join(self.root,'.build-cache')
+        build.TRASH_DIR=os.path.join(self.root,'.build-trash')
+        build.CLEAN_WAIT=True
+        build.CLEAN_JOBS=2
+        for rel in ('Proj/bin/Proj.dll','Proj/obj/Proj.dll','Proj/obj/Debug/Gen.cs','packages/Lib.1.0.0/Lib.1.0.0.nupkg',
+                'repo/Proj.1.0.0.nupkg','.build-cache/fingerprints.json'):
+            self.write(rel)
+
+    def tearDown(self):
+        for name,value in self.saved.items():
+            setattr(build,name,value)
+        self.tmp.cleanup()
+
+    def write(self,rel):
+        path=os.path.join(self.root,build.os_path(rel))
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'w') as f:
+            f.write(rel)
+        return path
+
+    def trashed(self):
+        return sorted(name.split('.')[0] for name in os.listdir(build.TRASH_DIR))
+
+    def test_trashed_dirs_are_moved_aside_then_deleted(self):
+        build.trash(os.path.join(self.root,'Proj','bin') + '/')
+        build.trash(os.path.join(self.root,'Proj','obj'))
+        #what's not there is skipped
+        build.trash(os.path.join(self.root,'Proj','missing'))
+        self.assertFalse(os.path.exists(os.path.join(self.root,'Proj','bin')))
+        self.assertFalse(os.path.exists(os.path.join(self.root,'Proj','obj')))
+        self.assertEqual(self.trashed(),['Proj_bin','Proj_obj'])
+        #the same dir again, before the last is deleted
+        self.write('Proj/bin/Proj.dll')
+        build.trash(os.path.join(self.root,'Proj','bin'))
+        self.assertEqual(self.trashed(),['Proj_bin','Proj_bin','Proj_obj'])
+        build.empty_trash()
+        self.assertFalse(os.path.exists(build.TRASH_DIR))
+        self.assertTrue(os.path.isfile(os.path.join(self.root,'packages','Lib.1.0.0','Lib.1.0.0.nupkg')))
+
+    def test_only_whats_in_the_solution_dir_and_unprotected_is_trashed(self):
+        outside=tempfile.TemporaryDirectory()
+        self.addCleanup(outside.cleanup)
+        for path in (outside.name,self.root,build.NUGET_PKG_DIR,os.path.join(build.NUGET_PKG_DIR,'Lib.1.0.0'),
+                build.LOCAL_REPO,build.BUILD_CACHE_DIR,os.path.join(self.root,'.build-cache','fingerprints.json')):
+            with self.assertRaises(BuildError,msg=path):
+                build.trash(path)
+        self.assertTrue(os.path.isdir(outside.name))
+        self.assertTrue(os.path.isfile(os.path.join(self.root,'packages','Lib.1.0.0','Lib.1.0.0.nupkg')))
+        #unless cleaning the packages
+        build.trash(build.NUGET_PKG_DIR,packages=True)
+        self.assertFalse(os.path.exists(build.NUGET_PKG_DIR))
+        self.assertEqual(self.trashed(),['packages'])
+
+    def test_the_trash_is_emptied_in_the_background(self):
+        build.CLEAN_WAIT=False
+        build.trash(os.path.join(self.root,'Proj','obj'))
+        build.empty_trash()
+        deadline=time.time() + 30
+        while os.path.exists(build.TRASH_DIR) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(build.TRASH_DIR))
+        self.assertTrue(os.path.isfile(os.path.join(self.root,'Proj','bin','Proj.dll')))
+
+
+if __name__ == '__main__':
+    unittest.main()
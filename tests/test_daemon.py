@@ -0,0 +1,94 @@
+import contextlib
+import io
+import os
+import socket
+import threading
+import unittest
+
+import build
+import build_core
+from build_core import BuildError
+
+
+@unittest.skipUnless(hasattr(socket,'AF_UNIX'),'the build daemon needs unix domain sockets')
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved=dict(build.all_tasks),dict(build.tasks_run),build.JOBS,build.tracer,build.TRACE
+        build.TRACE=False
+        build.JOBS=1
+        self.ran=[]
+
+    def tearDown(self):
+        all_tasks,tasks_run,build.JOBS,build.tracer,build.TRACE=self.saved
+        build.all_tasks.clear()
+        build.all_tasks.update(all_tasks)
+        build.tasks_run.clear()
+        build.tasks_run.update(tasks_run)
+        build.cancelled.clear()
+
+    def task(self,name,action=None):
+        def run():
+            if action:
+                action()
+            build.log('ran ' + name)
+            self.ran.append(name)
+        run.requires=()
+        build.all_tasks[name]=run
+
+    def serve(self,request,script_stamp=None):
+        """Serve the request as the daemon does, returning what the client printed, its final reply and whether the
+        daemon carries on"""
+        daemon_end,client_end=socket.socketpair()
+        served=[]
+        thread=threading.Thread(target=lambda: served.append(build.serve_build(daemon_end,{},script_stamp or build.scripts_stamp())))
+        thread.start()
+        out=io.StringIO()
+        with contextlib.redirect_stdout(out):
+            reply=build.daemon_request(client_end,request)
+        thread.join(10)
+        daemon_end.close()
+        return out.getvalue(),reply,served[0]
+
+    def test_a_build_runs_in_the_daemon_with_its_output_sent_to_the_client(self):
+        self.task('compile')
+        out,reply,serving=self.serve({'args':['compile'],'env':dict(os.environ)})
+        self.assertEqual(reply,{'exit':0})
+        self.assertTrue(serving)
+        self.assertIn('ran compile',out)
+        self.assertEqual(self.ran,['compile'])
+        self.assertIsInstance(build_core.console,build_core.Console)
+        #each build starts afresh, so the task runs again
+        self.serve({'args':['compile'],'env':dict(os.environ)})
+        self.assertEqual(self.ran,['compile','compile'])
+
+    def test_a_failed_build_exits_non_zero(self):
+        def fail():
+            raise BuildError('compile failed')
+        self.task('compile',fail)
+        out,reply,serving=self.serve({'args':['compile'],'env':dict(os.environ)})
+        self.assertEqual(reply,{'exit':1})
+        self.assertIn('compile failed',out)
+        self.assertTrue(serving)
+
+    def test_changed_scripts_restart_the_daemon(self):
+        self.task('compile')
+        out,reply,serving=self.serve({'args':['compile'],'env':dict(os.environ)},script_stamp=[['build.py',[0,0]]])
+        self.assertEqual(reply,{'restart':True})
+        self.assertFalse(serving)
+        self.assertEqual(self.ran,[])
+
+    def test_a_stop_request_stops_the_daemon(self):
+        out,reply,serving=self.serve({'stop':True})
+        self.assertEqual(reply['exit'],0)
+        self.assertFalse(serving)
+
+    def test_the_script_files_are_build_py_and_its_modules(self):
+        names=[os.path.basename(path) for path in build.script_files()]
+        self.assertEqual(names[0],'build.py')
+        self.assertIn('build_core.py',names)
+        self.assertTrue(all(name.startswith('build') for name in names))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import build_files
+
+
+class FileIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.root=self.tmp.name
+        for rel in ('Proj/A.cs','Proj/Sub/B.CS','Proj/Proj.csproj','Proj/obj/Gen.cs','.git/config.cs'):
+            self.write(rel)
+        self.index=build_files.FileIndex(self.root,['.git','obj'])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self,rel):
+        path=os.path.join(self.root,rel)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'w') as f:
+            f.write(rel)
+        return path
+
+    def found(self,*suffixes):
+        return [os.path.relpath(path,self.root) for path,name in self.index.find(*suffixes)]
+
+    def test_files_are_found_by_suffix_whatever_its_case_outside_the_pruned_dirs(self):
+        self.assertEqual(self.found('.cs'),[os.path.join('Proj','A.cs'),os.path.join('Proj','Sub','B.CS')])
+        self.assertEqual(self.found('.csproj','.cs'),[os.path.join('Proj','A.cs'),os.path.join('Proj','Proj.csproj'),os.path.join('Proj','Sub','B.CS')])
+        self.assertEqual(len(self.found()),3)
+
+    def test_added_and_removed_files_and_dirs_are_picked_up(self):
+        self.write('Proj/C.cs')
+        self.write('Proj/New/Deep/D.cs')
+        os.remove(os.path.join(self.root,'Proj','A.cs'))
+        self.assertEqual(self.found('.cs'),[os.path.join('Proj','C.cs'),os.path.join('Proj','New','Deep','D.cs'),os.path.join('Proj','Sub','B.CS')])
+        shutil.rmtree(os.path.join(self.root,'Proj','New'))
+        self.assertEqual(self.found('.cs'),[os.path.join('Proj','C.cs'),os.path.join('Proj','Sub','B.CS')])
+
+    def test_unchanged_dirs_are_not_rescanned(self):
+        scanned=[]
+        scan=self.index.scan
+        def counting_scan(path):
+            scanned.append(os.path.relpath(path,self.root))
+            scan(path)
+        self.index.scan=counting_scan
+        self.found('.cs')
+        self.assertEqual(scanned,[])
+        self.write('Proj/Sub/E.cs')
+        self.found('.cs')
+        self.assertEqual(scanned,[os.path.join('Proj','Sub')])
+
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.root=self.tmp.name
+        self.write('Proj/A.cs','a')
+        self.write('.build-cache/logs/build.log.gz','log')
+        self.write('Proj/bin/Release/Proj.dll','dll')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self,rel,text):
+        path=os.path.join(self.root,rel)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'w') as f:
+            f.write(text)
+        return path
+
+    def check_watcher(self,watcher):
+        try:
+            self.assertEqual(watcher.changes(0.1),set())
+            changed=self.write('Proj/A.cs','changed')
+            added=self.write('Proj/Sub/B.cs','b')
+            self.write('.build-cache/logs/build.log.gz','more log')
+            self.write('Proj/bin/Release/Proj.dll','rebuilt')
+            found=set()
+            for _ in range(20):
+                found|=watcher.changes(0.5)
+                if {changed,added} <= found:
+                    break
+            self.assertEqual(found,{changed,added})
+            os.remove(changed)
+            self.assertEqual(watcher.changes(5),{changed})
+        finally:
+            watcher.close()
+
+    def test_polling_finds_changed_added_and_removed_files(self):
+        index=build_files.FileIndex(self.root,['.git'])
+        self.check_watcher(build_files.PollWatcher(index,[os.path.join(self.root,'.build-cache'),os.path.join(self.root,'Proj','bin')],0.05))
+
+    def test_inotify_finds_changed_added_and_removed_files(self):
+        try:
+            watcher=build_files.InotifyWatcher(self.root,['.git','bin'],[os.path.join(self.root,'.build-cache')],
+                os.path.join(self.root,'Test.sln'))
+        except OSError as e:
+            self.skipTest('no inotify: {}'.format(e))
+        self.check_watcher(watcher)
+
+
+if __name__ == '__main__':
+    unittest.main()
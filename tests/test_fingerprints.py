@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+
+import build
+
+
+class FakeProject:
+
+    def __init__(self, name, paths, references=()):
+        self.name = name
+        self.paths = paths
+        self.references = list(references)
+
+    def inputs(self):
+        return self.paths
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.saved=build.SOLUTION_DIR,build.BUILD_CACHE_DIR,build.CONFIG,build.hash_file
+        build.SOLUTION_DIR=self.tmp.name
+        build.BUILD_CACHE_DIR=os.path.join(self.tmp.name,'.build-cache')
+        build.CONFIG='Release'
+        self.hashed=[]
+        def hash_file(path):
+            self.hashed.append(os.path.basename(path))
+            return self.saved[3](path)
+        build.hash_file=hash_file
+        self.projects={
+            'Core':FakeProject('Core',[self.source('Core/A.cs','a')]),
+            'Lib':FakeProject('Lib',[self.source('Lib/B.cs','b')],['Core']),
+            'Other':FakeProject('Other',[self.source('Other/C.cs','c')])}
+        self.file_hashes={}
+
+    def tearDown(self):
+        build.SOLUTION_DIR,build.BUILD_CACHE_DIR,build.CONFIG,build.hash_file=self.saved
+        self.tmp.cleanup()
+
+    def source(self,rel,text):
+        path=os.path.join(self.tmp.name,rel)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'w') as f:
+            f.write(text)
+        return path
+
+    def fingerprints(self):
+        return build.project_fingerprints(self.projects,self.file_hashes)
+
+    def test_unchanged_inputs_give_the_same_fingerprints_without_rereading_them(self):
+        first=self.fingerprints()
+        self.assertEqual(sorted(self.hashed),['A.cs','B.cs','C.cs'])
+        self.assertEqual(self.fingerprints(),first)
+        self.assertEqual(len(self.hashed),3)
+
+    def test_a_change_refingerprints_the_project_and_those_referencing_it(self):
+        first=self.fingerprints()
+        self.source('Core/A.cs','changed')
+        second=self.fingerprints()
+        self.assertNotEqual(second['Core'],first['Core'])
+        self.assertNotEqual(second['Lib'],first['Lib'])
+        self.assertEqual(second['Other'],first['Other'])
+
+    def test_the_config_is_in_the_fingerprint(self):
+        first=self.fingerprints()
+        build.CONFIG='Debug'
+        self.assertNotEqual(self.fingerprints()['Other'],first['Other'])
+
+    def test_a_toolchain_change_drops_the_previous_builds(self):
+        saved=build.toolchain_id
+        self.addCleanup(setattr,build,'toolchain_id',saved)
+        build.toolchain_id=lambda: 'xbuild:14.0'
+        cache=build.load_build_cache()
+        cache['projects']['Release']={'Core':'abc'}
+        build.save_cache('build',cache)
+        self.assertEqual(build.load_build_cache()['projects'],{'Release':{'Core':'abc'}})
+        build.toolchain_id=lambda: 'xbuild:15.0'
+        self.assertEqual(build.load_build_cache()['projects'],{})
+
+
+if __name__ == '__main__':
+    unittest.main()
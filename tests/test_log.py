@@ -0,0 +1,84 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+import build_log
+
+
+class TaskLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def task_log(self,chunk_bytes=64,max_warnings=2):
+        return build_log.TaskLog('build:Some.Project',self.tmp.name,'gzip',chunk_bytes,max_warnings)
+
+    def write(self,task_log,lines):
+        for line in lines:
+            block=(line + '\n').encode()
+            task_log.append(block,build_log.find_issues(block))
+        task_log.close()
+
+    def test_the_log_reads_back_whole_and_a_chunk_at_a_time(self):
+        task_log=self.task_log()
+        lines=['line {}'.format(i) for i in range(100)]
+        self.write(task_log,lines)
+        with open(task_log.path,'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()).decode(),''.join(line + '\n' for line in lines))
+        reader=build_log.LogReader(task_log.index_path)
+        self.assertEqual(reader.task,'build:Some.Project')
+        self.assertEqual(reader.lines,100)
+        self.assertGreater(len(reader.chunks),1)
+        self.assertEqual(reader.lines_around(50,2,1),[(48,'line 48'),(49,'line 49'),(50,'line 50'),(51,'line 51')])
+
+    def test_the_errors_and_warnings_are_indexed_by_line(self):
+        task_log=self.task_log()
+        self.write(task_log,['building','Foo.cs(1,2): warning CS0168: unused','ok','Bar.cs(3,4): error CS1002: ; expected',
+            'the error count is 1','done'])
+        reader=build_log.LogReader(task_log.index_path)
+        self.assertEqual([(line,kind) for line,kind,offset in reader.issues],[(1,'warning'),(3,'error')])
+
+    def test_only_the_first_warnings_are_shown(self):
+        task_log=self.task_log(max_warnings=2)
+        self.assertEqual([task_log.show('warning') for i in range(3)],[True,'last',False])
+        self.assertTrue(task_log.show('error'))
+        task_log.close()
+
+
+class ProcessOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.shown=[]
+        self.task_log=build_log.TaskLog('test',self.tmp.name,'gzip',1024 * 1024,50)
+
+    def tearDown(self):
+        self.task_log.close()
+        self.tmp.cleanup()
+
+    def run_process(self,lines,failed):
+        output=build_log.ProcessOutput(self.task_log,'nunit-console Some.Test.dll',self.shown.append,'[test] ',3600.0,3)
+        output.write(''.join(line + '\n' for line in lines).encode())
+        output.close(failed)
+        return ''.join(self.shown)
+
+    def test_a_failed_process_shows_its_last_lines_and_where_its_log_is(self):
+        shown=self.run_process(['Tests run: {}'.format(i) for i in range(10)],True)
+        self.assertIn('[test] process failed, its last 3 lines of output follow. All of it is in ' + self.task_log.path,shown)
+        self.assertIn('[test] Tests run: 7\n[test] Tests run: 8\n[test] Tests run: 9\n',shown)
+        self.assertNotIn('Tests run: 6',shown)
+        #flushed, so the log has it all even before the task ends
+        reader=build_log.LogReader(self.task_log.index_path)
+        self.assertEqual(reader.lines,11)
+
+    def test_a_passing_process_only_shows_its_errors_and_warnings(self):
+        shown=self.run_process(['compiling','Foo.cs(1,2): warning CS0168: unused','Tests run: 1'],False)
+        self.assertEqual(shown,'[test] Foo.cs(1,2): warning CS0168: unused\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
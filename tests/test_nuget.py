@@ -0,0 +1,313 @@
+import http.server
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.request
+import zipfile
+import xml.etree.ElementTree as ElementTree
+
+import build
+import build_feed
+import build_nuget
+from build_core import BuildError, hash_file
+
+
+def nuspec_files_element(*files):
+    element=ElementTree.Element('files')
+    for src,target in files:
+        ElementTree.SubElement(element,'file',src=src,target=target)
+    return element
+
+
+class NuspecFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.proj_dir=self.tmp.name
+        os.makedirs(os.path.join(self.proj_dir,'obj','Release'))
+        for name in ('Lib.dll','Lib.Extra.dll','readme.txt'):
+            with open(os.path.join(self.proj_dir,'obj','Release',name),'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def files(self,*files):
+        return [(target,os.path.relpath(path,self.proj_dir).replace(os.sep,'/')) for target,path in
+            build_nuget.nuspec_files(self.proj_dir,nuspec_files_element(*files))]
+
+    def test_wildcards_go_in_the_target_dir(self):
+        self.assertEqual(self.files(('obj/Release/Lib*.dll','/lib/net40')),
+            [('lib/net40/Lib.Extra.dll','obj/Release/Lib.Extra.dll'),('lib/net40/Lib.dll','obj/Release/Lib.dll')])
+
+    def test_a_single_file_target_with_its_extension_names_the_file(self):
+        self.assertEqual(self.files(('obj/Release/readme.txt','docs/README.txt')),[('docs/README.txt','obj/Release/readme.txt')])
+
+    def test_a_wildcard_matching_nothing_is_skipped(self):
+        self.assertEqual(self.files(('obj/Release/Lib*.dll','lib/net40'),('obj/Release/Lib*.pdb','lib/net40')),
+            [('lib/net40/Lib.Extra.dll','obj/Release/Lib.Extra.dll'),('lib/net40/Lib.dll','obj/Release/Lib.dll')])
+
+    def test_a_missing_literal_file_fails(self):
+        with self.assertRaises(BuildError) as raised:
+            self.files(('obj/Release/Lib*.dll','lib/net40'),('obj/Release/Lib.pdb','lib/net40'))
+        self.assertIn('obj/Release/Lib.pdb',raised.exception.msg)
+
+    def test_nothing_to_pack_fails(self):
+        with self.assertRaises(BuildError):
+            self.files(('obj/Release/*.pdb','lib/net40'))
+
+
+NUSPEC_TEMPLATE='''<?xml version="1.0" encoding="utf-8"?>
+<package>
+  <metadata>
+    <id>Proj</id>
+    <version>$version$</version>
+    <authors>someone</authors>
+    <description>[MAIN_DESCRIPTON]</description>
+    <releaseNotes>[MAIN_RELEASENOTES]</releaseNotes>
+    <projectUrl>https:[/][/]example.com[/]proj</projectUrl>
+  </metadata>
+  <files>
+    <file src="bin[/]$configuration$[/]Proj.dll" target="lib/net40"/>
+    <file src="bin[/]$configuration$[/]Proj*.pdb" target="lib/net40"/>
+  </files>
+</package>
+'''
+
+
+class NugetPackTest(unittest.TestCase):
+    """Packs a project from its nuspec template, in a solution dir of its own"""
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.saved={name:getattr(build,name) for name in ('SOLUTION_DIR','VERSION','CONFIG')}
+        build.SOLUTION_DIR=self.tmp.name
+        build.VERSION='1.2.3-beta'
+        build.CONFIG='Release'
+        self.proj_dir=os.path.join(self.tmp.name,'Proj')
+        os.makedirs(os.path.join(self.proj_dir,'bin','Release'))
+        with open(os.path.join(self.proj_dir,'Proj.nuspec.template'),'w') as f:
+            f.write(NUSPEC_TEMPLATE)
+        for name in ('Proj.dll','Proj.pdb'):
+            with open(os.path.join(self.proj_dir,'bin','Release',name),'wb') as f:
+                f.write(name.encode())
+        self.readme='Tests first, as in `Expect.That(x).Is(AnInt.GreaterThan(1))` & <b>fluent</b> matchers > asserts\n'
+        self.write_doc('README.md',self.readme)
+        self.write_doc('RELEASENOTES.md','1.2.3 : fixed Match<T> & Matchers\n')
+
+    def tearDown(self):
+        for name,value in self.saved.items():
+            setattr(build,name,value)
+        self.tmp.cleanup()
+
+    def write_doc(self,name,text):
+        with open(os.path.join(self.tmp.name,name),'w',encoding='utf-8') as f:
+            f.write(text)
+
+    def manifest(self,nupkg):
+        with zipfile.ZipFile(os.path.join(self.proj_dir,nupkg)) as archive:
+            return ElementTree.fromstring(archive.read('Proj.nuspec')),sorted(archive.namelist())
+
+    def test_the_readme_packs_into_a_nuspec_which_parses_back(self):
+        build.nuget_pack('Proj')
+        manifest,names=self.manifest('Proj.1.2.3-beta.nupkg')
+        ns={'n':build_nuget.NUSPEC_NS}
+        #& kept, < and > as the angle quotes nuget galleries show in their place
+        self.assertEqual(manifest.findtext('n:metadata/n:description',namespaces=ns),
+            self.readme.replace('<','\u2039').replace('>','\u203a'))
+        self.assertEqual(manifest.findtext('n:metadata/n:releaseNotes',namespaces=ns),'1.2.3 : fixed Match\u2039T\u203a & Matchers\n')
+        self.assertEqual(manifest.findtext('n:metadata/n:version',namespaces=ns),'1.2.3-beta')
+        self.assertEqual(manifest.findtext('n:metadata/n:projectUrl',namespaces=ns),'https://example.com/proj')
+        self.assertIsNone(manifest.find('n:files',namespaces=ns))
+        self.assertIn('lib/net40/Proj.dll',names)
+        self.assertNotIn('lib/net40/Proj.pdb',names)
+
+    def test_the_symbols_package_has_the_pdbs(self):
+        build.nuget_pack('Proj')
+        manifest,names=self.manifest('Proj.1.2.3-beta.symbols.nupkg')
+        self.assertIn('lib/net40/Proj.pdb',names)
+
+    def test_packing_again_gives_the_same_bytes(self):
+        build.nuget_pack('Proj')
+        with open(os.path.join(self.proj_dir,'Proj.1.2.3-beta.nupkg'),'rb') as f:
+            first=f.read()
+        build.nuget_pack('Proj')
+        with open(os.path.join(self.proj_dir,'Proj.1.2.3-beta.nupkg'),'rb') as f:
+            self.assertEqual(f.read(),first)
+
+
+def write_nupkg(path,pkg_id,version,content=b''):
+    with zipfile.ZipFile(path,'w') as archive:
+        archive.writestr(pkg_id + '.nuspec','<?xml version="1.0"?><package><metadata><id>{}</id><version>{}</version>'
+            '<description>about {}</description></metadata></package>'.format(pkg_id,version,pkg_id))
+        archive.writestr('lib/net40/' + pkg_id + '.dll',content or pkg_id.encode())
+    return path
+
+
+class LocalRepoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.root=os.path.join(self.tmp.name,'repo')
+        self.built=os.path.join(self.tmp.name,'built')
+        os.makedirs(self.built)
+        self.repo=build_nuget.LocalRepo(self.root)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add(self,name,content=b''):
+        pkg_id,version,symbols=build_nuget.nupkg_id_version(name)
+        path=write_nupkg(os.path.join(self.built,name),pkg_id,version,content)
+        return self.repo.add(path,hash_file(path))
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(root,name),self.root) for root,dirs,files in os.walk(self.root) for name in files)
+
+    def test_a_package_added_again_is_skipped(self):
+        self.assertTrue(self.add('Lib.1.0.0.nupkg'))
+        self.assertFalse(self.add('Lib.1.0.0.nupkg'))
+        entry=dict(self.repo.packages())['Lib.1.0.0.nupkg']
+        self.assertEqual((entry['id'],entry['version'],entry['symbols']),('Lib','1.0.0',False))
+        self.assertEqual(entry['metadata']['description'],'about Lib')
+        self.assertTrue(os.path.samefile(os.path.join(self.root,'Lib.1.0.0.nupkg'),self.repo.blob(entry['sha'])))
+
+    def test_the_index_is_kept_and_rebuilt_when_missing(self):
+        self.add('Lib.1.0.0.nupkg')
+        self.add('Lib.1.0.0.symbols.nupkg',b'with pdbs')
+        self.repo.save()
+        self.assertEqual(build_nuget.LocalRepo(self.root).index,self.repo.index)
+        os.remove(self.repo.index_path)
+        rebuilt=build_nuget.LocalRepo(self.root)
+        self.assertEqual([name for name,entry in rebuilt.packages()],['Lib.1.0.0.nupkg','Lib.1.0.0.symbols.nupkg'])
+        self.assertNotIn('metadata',dict(rebuilt.packages())['Lib.1.0.0.symbols.nupkg'])
+
+    def test_prune_keeps_the_latest_versions_and_is_idempotent(self):
+        for version in ('1.0.0','1.2.0-beta','1.2.0','1.10.0'):
+            self.add('Lib.{}.nupkg'.format(version),version.encode())
+            self.add('Lib.{}.symbols.nupkg'.format(version),b'pdbs ' + version.encode())
+        self.add('Other.0.1.0.nupkg')
+        self.repo.prune(2)
+        self.assertEqual([name for name,entry in self.repo.packages()],['Lib.1.10.0.nupkg','Lib.1.10.0.symbols.nupkg',
+            'Lib.1.2.0.nupkg','Lib.1.2.0.symbols.nupkg','Other.0.1.0.nupkg'])
+        #only the blobs of what's left
+        self.assertEqual(len([name for name in self.files() if name.startswith('.blobs')]),5)
+        files,index=self.files(),json.loads(json.dumps(self.repo.index))
+        self.repo.prune(2)
+        self.assertEqual((self.files(),self.repo.index),(files,index))
+
+    def test_versions_sort_numerically_with_prereleases_first(self):
+        versions=['1.10.0','1.2.0','1.2.0-beta.10','1.2.0-beta.2','1.2.0-alpha','1.9']
+        self.assertEqual(sorted(versions,key=build_nuget.version_key),['1.2.0-alpha','1.2.0-beta.2','1.2.0-beta.10','1.2.0','1.9','1.10.0'])
+
+    def test_clear_removes_every_package(self):
+        self.add('Lib.1.0.0.nupkg')
+        write_nupkg(os.path.join(self.root,'Copied.1.0.0.nupkg'),'Copied','1.0.0')
+        self.repo.clear()
+        self.assertEqual(self.files(),['.index.json'])
+        self.assertEqual(self.repo.packages(),[])
+
+
+class NugetFeedTest(unittest.TestCase):
+    """The feed of a LocalRepo, as the v2 and v3 clients ask it"""
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.root=os.path.join(self.tmp.name,'repo')
+        self.built=os.path.join(self.tmp.name,'built')
+        os.makedirs(self.built)
+        self.repo=build_nuget.LocalRepo(self.root)
+        for name in ('Lib.1.0.0.nupkg','Lib.1.0.0.symbols.nupkg','Lib.1.2.0.nupkg','Lib.2.0.0-beta.nupkg','Other.0.1.nupkg'):
+            self.add(name)
+        self.feed=build_feed.NugetFeed(self.root,'http://localhost:5000/')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add(self,name):
+        pkg_id,version,symbols=build_nuget.nupkg_id_version(name)
+        path=write_nupkg(os.path.join(self.built,name),pkg_id,version,name.encode())
+        self.repo.add(path,hash_file(path))
+        self.repo.save()
+        return path
+
+    def get_json(self,url):
+        status,content_type,body=self.feed.get(url)
+        self.assertEqual((status,content_type),(200,'application/json'))
+        return json.loads(body)
+
+    def get_entries(self,url):
+        status,content_type,body=self.feed.get(url)
+        self.assertEqual(status,200)
+        ns={'a':'http://www.w3.org/2005/Atom','d':'http://schemas.microsoft.com/ado/2007/08/dataservices',
+            'm':'http://schemas.microsoft.com/ado/2007/08/dataservices/metadata'}
+        return [(entry.findtext('m:properties/d:Id',namespaces=ns),entry.findtext('m:properties/d:Version',namespaces=ns))
+            for entry in ElementTree.fromstring(body).iter('{http://www.w3.org/2005/Atom}entry')]
+
+    def test_the_v3_index_points_at_the_feed(self):
+        resources={resource['@type']:resource['@id'] for resource in self.get_json('/v3/index.json')['resources']}
+        self.assertEqual(resources['PackageBaseAddress/3.0.0'],'http://localhost:5000/v3/flatcontainer/')
+        self.assertEqual(resources['RegistrationsBaseUrl'],'http://localhost:5000/v3/registration/')
+
+    def test_v3_lists_the_versions_and_serves_the_package(self):
+        self.assertEqual(self.get_json('/v3/flatcontainer/lib/index.json'),{'versions':['1.0.0','1.2.0','2.0.0-beta']})
+        status,content_type,path=self.feed.get('/v3/flatcontainer/lib/1.2.0/lib.1.2.0.nupkg')
+        self.assertEqual((status,content_type),(200,'application/octet-stream'))
+        self.assertEqual(hash_file(path),hash_file(os.path.join(self.built,'Lib.1.2.0.nupkg')))
+        #normalized, as 0.1 is asked for as 0.1.0
+        self.assertEqual(self.feed.get('/v3/flatcontainer/other/0.1.0/other.0.1.0.nupkg')[0],200)
+        self.assertEqual(self.feed.get('/v3/flatcontainer/missing/index.json')[0],404)
+        self.assertEqual(self.feed.get('/v3/flatcontainer/lib/3.0.0/lib.3.0.0.nupkg')[0],404)
+
+    def test_v3_registration_has_a_leaf_for_each_version(self):
+        page=self.get_json('/v3/registration/lib/index.json')['items'][0]
+        self.assertEqual((page['lower'],page['upper'],page['count']),('1.0.0','2.0.0-beta',3))
+        leaf=self.get_json('/v3/registration/lib/1.2.0.json')
+        self.assertEqual(leaf['packageContent'],'http://localhost:5000/v3/flatcontainer/lib/1.2.0/lib.1.2.0.nupkg')
+        self.assertEqual(leaf['catalogEntry']['description'],'about Lib')
+
+    def test_v2_finds_the_versions_of_a_package_without_its_symbols(self):
+        self.assertEqual(self.get_entries("/api/v2/FindPackagesById()?id='Lib'"),[('Lib','1.0.0'),('Lib','1.2.0'),('Lib','2.0.0-beta')])
+        self.assertEqual(self.feed.get("/api/v2/FindPackagesById()/$count?id='Lib'")[1:],('text/plain','3'))
+        self.assertEqual(self.get_entries("/api/v2/Packages(Id='Lib',Version='1.2.0')"),[('Lib','1.2.0')])
+        self.assertEqual(self.feed.get("/api/v2/Packages(Id='Lib',Version='1.0.0.symbols')")[0],404)
+
+    def test_v2_latest_is_the_latest_release_and_absolute_latest_may_be_a_prerelease(self):
+        self.assertEqual(self.get_entries("/api/v2/Packages()?$filter=IsLatestVersion"),[('Lib','1.2.0'),('Other','0.1')])
+        self.assertEqual(self.get_entries("/api/v2/Packages()?$filter=tolower(Id) eq 'lib' and IsAbsoluteLatestVersion"),
+            [('Lib','2.0.0-beta')])
+        self.assertEqual(self.get_entries("/api/v2/Search()?searchTerm='about'&$filter=IsLatestVersion"),[('Lib','1.2.0'),('Other','0.1')])
+        self.assertEqual(self.get_entries("/api/v2/GetUpdates()?packageIds='Lib|Other'&versions='1.0.0|0.1'&includePrerelease=true"),
+            [('Lib','2.0.0-beta')])
+
+    def test_packages_added_to_the_repo_are_served(self):
+        self.assertEqual(self.get_json('/v3/flatcontainer/lib/index.json'),{'versions':['1.0.0','1.2.0','2.0.0-beta']})
+        #the index rewritten, whether or not its mtime moves on
+        self.add('Lib.2.0.0.nupkg')
+        self.assertEqual(self.get_json('/v3/flatcontainer/lib/index.json'),{'versions':['1.0.0','1.2.0','2.0.0-beta','2.0.0']})
+        self.assertEqual(self.get_entries("/api/v2/Packages()?$filter=tolower(Id) eq 'lib' and IsLatestVersion"),[('Lib','2.0.0')])
+
+    def test_the_server_sends_the_package(self):
+        server=http.server.ThreadingHTTPServer(('127.0.0.1',0),build_feed.FeedRequestHandler)
+        server.feed=self.feed
+        thread=threading.Thread(target=server.serve_forever,daemon=True)
+        thread.start()
+        try:
+            base='http://127.0.0.1:{}'.format(server.server_address[1])
+            with urllib.request.urlopen(base + '/api/v2/package/Lib/1.2.0') as response:
+                body=response.read()
+            with open(os.path.join(self.built,'Lib.1.2.0.nupkg'),'rb') as f:
+                self.assertEqual(body,f.read())
+            with self.assertRaises(urllib.error.HTTPError) as raised:
+                urllib.request.urlopen(base + '/api/v2/package/Lib/9.9.9')
+            self.assertEqual(raised.exception.code,404)
+            raised.exception.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import json
+import os
+import tempfile
+import unittest
+try:
+    import numpy
+except ImportError:
+    numpy=None
+
+import build
+import build_perf
+from build_core import BuildError
+
+
+def metrics_lines(name,values,start_sec=0,errors=0):
+    """Lines as PerformanceMetricsWriter writes them, a call a second"""
+    lines=['#MachineId,AgentId,ThreadId,TimeFromStartMs,CallId,Name,Timestamp,Value,IsError,Data']
+    for i,value in enumerate(values):
+        sec=start_sec + i
+        lines.append('m1,a1,t1,{},{},{},20240101-12{:02d}:{:02d}.000,{},{},'.format(sec * 1000,i,name,sec // 60,sec % 60,value,
+            't' if i < errors else 'f'))
+    return '\n'.join(lines) + '\n'
+
+
+class PerfStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def metrics_file(self,name,text):
+        path=os.path.join(self.tmp.name,name)
+        with open(path,'w') as f:
+            f.write(text)
+        return path
+
+    def test_the_test_name_comes_from_the_file_name(self):
+        self.assertEqual(build_perf.perf_test_name('/x/metrics_LoadTest_20240101-120000.csv'),'LoadTest')
+        self.assertEqual(build_perf.perf_test_name('/x/other.csv'),'other')
+
+    def test_stats_of_each_metric(self):
+        path=self.metrics_file('metrics_LoadTest_20240101-120000.csv',metrics_lines('get',[float(v) for v in range(1,102)],errors=1))
+        stats=build_perf.perf_stats([path])
+        self.assertEqual(list(stats),['LoadTest/get'])
+        stat=stats['LoadTest/get']
+        self.assertEqual((stat['count'],stat['errors']),(100,1))
+        #100 successful calls over the 100 secs from the first call to the last
+        self.assertAlmostEqual(stat['throughput'],1.0)
+        self.assertEqual((stat['p50'],stat['p95'],stat['p99']),(51.0,96.0,100.0))
+
+    def test_regressions_beyond_the_threshold(self):
+        baseline={'T/get':{'throughput':100.0,'p50':10.0,'p95':20.0,'p99':30.0}}
+        within={'T/get':{'throughput':95.0,'p50':10.5,'p95':21.0,'p99':31.0},'T/new':{'throughput':1.0,'p50':1,'p95':1,'p99':1}}
+        self.assertEqual(build_perf.perf_regressions(within,baseline,10),[])
+        worse={'T/get':{'throughput':80.0,'p50':10.0,'p95':25.0,'p99':30.0}}
+        self.assertEqual(build_perf.perf_regressions(worse,baseline,10),
+            ['T/get throughput 80.0/sec, baseline 100.0/sec','T/get p95 25.0, baseline 20.0'])
+
+
+class PerfTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.saved={name:getattr(build,name) for name in ('SOLUTION_DIR','TEST_RESULTS_DIR','PERF_RESULTS_DIR','PERF_BASELINE',
+            'PERF_UPDATE_BASELINE','PERF_THRESHOLD','CONFIG','win_invoke')}
+        build.SOLUTION_DIR=self.tmp.name
+        build.TEST_RESULTS_DIR=os.path.join(self.tmp.name,'test-results')
+        build.PERF_RESULTS_DIR=os.path.join(self.tmp.name,'perf-results')
+        build.PERF_BASELINE=os.path.join(self.tmp.name,'perf-baseline.json')
+        build.PERF_UPDATE_BASELINE=False
+        build.PERF_THRESHOLD=10
+        build.CONFIG='Release'
+        self.values=[10.0] * 20
+        def win_invoke(prog,args=None,cwd=None,timeout=None):
+            os.makedirs(os.path.join(cwd,'perf-metrics'),exist_ok=True)
+            with open(os.path.join(cwd,'perf-metrics','metrics_LoadTest_20240101-120000.csv'),'w') as f:
+                f.write(metrics_lines('get',self.values))
+        build.win_invoke=win_invoke
+
+    def tearDown(self):
+        for name,value in self.saved.items():
+            setattr(build,name,value)
+        self.tmp.cleanup()
+
+    def test_the_first_run_saves_the_baseline_and_a_slower_one_fails(self):
+        build.task_perf()
+        with open(build.PERF_BASELINE) as f:
+            self.assertEqual(json.load(f)['LoadTest/get']['p50'],10.0)
+        build.task_perf()
+        self.values=[20.0] * 20
+        with self.assertRaises(BuildError) as raised:
+            build.task_perf()
+        self.assertIn('regressed',raised.exception.msg)
+
+
+@unittest.skipIf(numpy is None,'the perf store needs numpy')
+class PerfStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.chunk_rows=build_perf.PERF_STORE_CHUNK_ROWS
+        #more than one chunk, converted and queried
+        build_perf.PERF_STORE_CHUNK_ROWS=7
+        self.metrics_file=os.path.join(self.tmp.name,'metrics_LoadTest_20240101-120000.csv')
+        lines=['#MachineId,AgentId,ThreadId,TimeFromStartMs,CallId,Name,Timestamp,Value,IsError,Data']
+        #over 4 secs, 't1' calls 'get' 3 times a sec taking 10ms, 't2' 'put' once a sec taking 100ms, failing the last time
+        for sec in range(4):
+            for i in range(3):
+                lines.append('m1,a1,t1,{},{},get,20240101-1200:{:02d}.{:03d},10,f,'.format(sec * 1000 + i * 300,sec * 3 + i,sec,i * 300))
+            lines.append('m1,a1,t2,{},{},put,20240101-1200:{:02d}.500,100,{},'.format(sec * 1000 + 500,sec,sec,'t' if sec == 3 else 'f'))
+        with open(self.metrics_file,'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def tearDown(self):
+        build_perf.PERF_STORE_CHUNK_ROWS=self.chunk_rows
+        self.tmp.cleanup()
+
+    def test_queries_of_the_converted_metrics(self):
+        store=build_perf.open_perf_store(self.metrics_file)
+        self.assertEqual((store.count,store.metrics,store.tests),(16,['get','put'],['m1/a1/t1','m1/a1/t2']))
+        throughput=store.interval_throughput(1)
+        self.assertEqual(throughput['get'].tolist(),[3,3,3,3])
+        self.assertEqual(throughput['put'].tolist(),[1,1,1,0])
+        self.assertEqual(store.interval_throughput(2)['get'].tolist(),[6,6])
+        percentiles=store.percentiles([50,99])
+        self.assertAlmostEqual(percentiles['get'][50],10,delta=0.1)
+        self.assertAlmostEqual(percentiles['put'][99],100,delta=0.1)
+        self.assertEqual(store.thread_breakdown(),{'m1/a1/t1':(12,0,10.0),'m1/a1/t2':(3,1,100.0)})
+
+    def test_the_store_is_converted_again_once_the_metrics_change(self):
+        self.assertEqual(build_perf.open_perf_store(self.metrics_file).count,16)
+        with open(self.metrics_file,'a') as f:
+            f.write('m1,a1,t1,9000,99,get,20240101-1200:09.000,10,f,\n')
+        os.utime(self.metrics_file,(os.path.getmtime(self.metrics_file) + 10,) * 2)
+        self.assertEqual(build_perf.open_perf_store(self.metrics_file).count,17)
+        self.assertEqual(build_perf.open_perf_store(self.metrics_file + '.cols').count,17)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+import build
+from build_core import BuildError
+
+
+def python(code):
+    return [sys.executable,'-c',code]
+
+
+class ProcessRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.out=[]
+
+    def test_output_is_written_a_line_at_a_time_with_the_prefix(self):
+        returncode,seconds,timed_out=build.process_runner.run(
+            python('import sys; sys.stdout.write("one\\ntwo\\n"); sys.stdout.flush(); sys.stderr.write("three")'),
+            None,None,self.out.append,'[task] ')
+        self.assertEqual((returncode,timed_out),(0,False))
+        self.assertEqual(''.join(self.out),'[task] one\n[task] two\n[task] three\n')
+
+    def test_the_exit_code_is_returned(self):
+        returncode,seconds,timed_out=build.process_runner.run(python('raise SystemExit(3)'),None,None,self.out.append,'')
+        self.assertEqual((returncode,timed_out),(3,False))
+
+    @unittest.skipIf(build.is_windows(),'checks the child is gone with os.kill')
+    def test_a_process_and_what_it_started_are_killed_on_timeout(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pid_file=os.path.join(tmp,'child.pid')
+            started=time.time()
+            returncode,seconds,timed_out=build.process_runner.run(python(
+                'import subprocess,sys,time\n'
+                'child=subprocess.Popen([sys.executable,"-c","import time; time.sleep(60)"])\n'
+                'open(sys.argv[1],"w").write(str(child.pid))\n'
+                'time.sleep(60)\n') + [pid_file],None,1.0,self.out.append,'')
+            self.assertTrue(timed_out)
+            self.assertLess(time.time() - started,30)
+            with open(pid_file) as f:
+                child=int(f.read())
+            for _ in range(50):
+                try:
+                    os.kill(child,0)
+                except ProcessLookupError:
+                    break
+                time.sleep(0.1)
+            else:
+                self.fail('the child process was left running')
+
+
+class InvokeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved=build.LOG_CAPTURE,build.TASK_TIMEOUT
+        build.LOG_CAPTURE=False
+        build.cancelled.clear()
+
+    def tearDown(self):
+        build.LOG_CAPTURE,build.TASK_TIMEOUT=self.saved
+
+    def test_a_failing_process_fails_the_task(self):
+        with self.assertRaises(BuildError) as raised:
+            build.invoke(sys.executable,['-c','raise SystemExit(2)'])
+        self.assertIn('non zero exit code: 2',raised.exception.msg)
+
+    def test_a_process_running_too_long_fails_the_task(self):
+        with self.assertRaises(BuildError) as raised:
+            build.invoke(sys.executable,['-c','import time; time.sleep(60)'],timeout=0.5)
+        self.assertIn('timed out',raised.exception.msg)
+
+    def test_the_timeout_is_the_soonest_of_those_set(self):
+        build.TASK_TIMEOUT=100
+        build.current_task.started=time.time() - 90
+        self.addCleanup(setattr,build.current_task,'started',None)
+        self.assertAlmostEqual(build.invoke_timeout(),10,delta=1)
+        self.assertAlmostEqual(build.invoke_timeout(5),5,delta=1)
+        build.TASK_TIMEOUT=0
+        self.assertIsNone(build.invoke_timeout())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import threading
+import unittest
+
+import build
+from build_core import BuildError
+
+
+class TaskGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved=dict(build.all_tasks),dict(build.tasks_run),build.JOBS
+        build.tasks_run.clear()
+        build.cancelled.clear()
+        self.ran=[]
+
+    def tearDown(self):
+        all_tasks,tasks_run,build.JOBS=self.saved
+        build.all_tasks.clear()
+        build.all_tasks.update(all_tasks)
+        build.tasks_run.clear()
+        build.tasks_run.update(tasks_run)
+        build.cancelled.clear()
+
+    def task(self,name,*requires,action=None):
+        def run():
+            if action:
+                action()
+            self.ran.append(name)
+        run.requires=requires
+        build.all_tasks[name]=run
+
+    def test_dependencies_are_planned_first(self):
+        self.task('init')
+        self.task('compile','init')
+        self.task('pack','compile','docs')
+        self.task('docs','init')
+        self.assertEqual([node.name for node in build.plan_tasks(['pack'])],['init','compile','docs','pack'])
+
+    def test_later_tasks_wait_on_the_earlier_ones_given(self):
+        self.task('clean')
+        self.task('init')
+        self.task('compile','init')
+        plan={node.name:node for node in build.plan_tasks(['clean','compile'])}
+        self.assertEqual(plan['init'].deps,['clean'])
+        self.assertEqual(plan['compile'].deps,['init','clean'])
+
+    def test_a_cycle_fails(self):
+        self.task('a','b')
+        self.task('b','c')
+        self.task('c','a')
+        with self.assertRaises(BuildError) as raised:
+            build.plan_tasks(['a'])
+        self.assertEqual(raised.exception.msg,'Task dependency cycle: a -> b -> c -> a')
+
+    def test_independent_tasks_run_at_the_same_time(self):
+        #each waits for the other to start, so only passes when both run at once
+        both=threading.Barrier(2,timeout=10)
+        self.task('init')
+        self.task('left','init',action=both.wait)
+        self.task('right','init',action=both.wait)
+        self.task('all','left','right')
+        build.JOBS=2
+        build.run_tasks(['all'])
+        self.assertEqual(self.ran[0],'init')
+        self.assertEqual(sorted(self.ran[1:3]),['left','right'])
+        self.assertEqual(self.ran[3],'all')
+
+    def test_a_failure_stops_what_depends_on_it(self):
+        def fail():
+            raise BuildError('compile failed')
+        self.task('init')
+        self.task('compile','init',action=fail)
+        self.task('test','compile')
+        build.JOBS=2
+        with self.assertRaises(BuildError):
+            build.run_tasks(['test'])
+        self.assertEqual(self.ran,['init'])
+        self.assertTrue(build.cancelled.is_set())
+
+    def test_jobs_must_be_a_positive_integer(self):
+        self.task('init')
+        for jobs in ('0','-1','two','true'):
+            with self.subTest(jobs):
+                with self.assertRaises(BuildError):
+                    build.run_cmdline_tasks(['jobs=' + jobs,'init'])
+        build.run_cmdline_tasks(['-j','3','init'])
+        self.assertEqual(build.JOBS,3)
+        self.assertEqual(self.ran,['init'])
+
+
+if __name__ == '__main__':
+    unittest.main()
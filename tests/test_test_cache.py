@@ -0,0 +1,81 @@
+import os
+import tempfile
+import time
+import unittest
+
+import build
+
+
+class TestResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.saved=build.SOLUTION_DIR,build.BUILD_CACHE_DIR,build.CONFIG,build.TESTS,build.TEST_CACHE_MAX_MB
+        build.SOLUTION_DIR=self.tmp.name
+        build.BUILD_CACHE_DIR=os.path.join(self.tmp.name,'.build-cache')
+        build.CONFIG='Release'
+        build.TESTS=None
+        self.bin_dir=os.path.join(self.tmp.name,'Proj.Test','bin','Release')
+        os.makedirs(self.bin_dir)
+        self.write(os.path.join(self.bin_dir,'Proj.Test.dll'),'tests')
+        self.write(os.path.join(self.bin_dir,'Proj.dll'),'code')
+
+    def tearDown(self):
+        build.SOLUTION_DIR,build.BUILD_CACHE_DIR,build.CONFIG,build.TESTS,build.TEST_CACHE_MAX_MB=self.saved
+        self.tmp.cleanup()
+
+    def write(self,path,text):
+        with open(path,'w') as f:
+            f.write(text)
+        return path
+
+    def result(self,name,size=100):
+        return self.write(os.path.join(self.tmp.name,name + '.xml'),'<test-results/>'.ljust(size))
+
+    def test_the_key_changes_with_the_assemblies_and_the_tests_run(self):
+        key=build.test_cache_key('Proj.Test')
+        self.write(os.path.join(self.bin_dir,'notes.txt'),'not loaded')
+        self.assertEqual(build.test_cache_key('Proj.Test'),key)
+        self.write(os.path.join(self.bin_dir,'Proj.dll'),'changed code')
+        changed=build.test_cache_key('Proj.Test')
+        self.assertNotEqual(changed,key)
+        build.TESTS='Proj.Test.OneTest'
+        self.assertNotEqual(build.test_cache_key('Proj.Test'),changed)
+
+    def test_a_stored_result_is_restored(self):
+        out=os.path.join(self.tmp.name,'out.xml')
+        self.assertFalse(build.restore_test_result('key1',out))
+        build.store_test_result('key1',self.result('passed'))
+        self.assertTrue(build.restore_test_result('key1',out))
+        with open(out) as f:
+            self.assertEqual(f.read().strip(),'<test-results/>')
+
+    def test_coverage_is_only_restored_when_it_was_stored(self):
+        out,coverage_out=os.path.join(self.tmp.name,'out.xml'),os.path.join(self.tmp.name,'coverage.xml')
+        build.store_test_result('key1',self.result('passed'))
+        self.assertFalse(build.restore_test_result('key1',out,coverage_out))
+        build.store_test_result('key1',self.result('passed'),self.write(os.path.join(self.tmp.name,'run.coverage.xml'),'<CoverageSession/>'))
+        #a later run without coverage keeps it
+        build.store_test_result('key1',self.result('passed'))
+        self.assertTrue(build.restore_test_result('key1',out,coverage_out))
+        with open(coverage_out) as f:
+            self.assertEqual(f.read(),'<CoverageSession/>')
+
+    def test_the_least_recently_used_results_are_evicted(self):
+        build.TEST_CACHE_MAX_MB=250 / (1024 * 1024)
+        out=os.path.join(self.tmp.name,'out.xml')
+        for key in ('key1','key2'):
+            build.store_test_result(key,self.result(key))
+            time.sleep(0.01)
+        #used, so key2 is now the least recently used
+        self.assertTrue(build.restore_test_result('key1',out))
+        time.sleep(0.01)
+        build.store_test_result('key3',self.result('key3'))
+        self.assertTrue(build.restore_test_result('key1',out))
+        self.assertFalse(build.restore_test_result('key2',out))
+        self.assertTrue(build.restore_test_result('key3',out))
+        self.assertEqual(sorted(os.listdir(os.path.join(build.BUILD_CACHE_DIR,'test-results'))),['key1.xml','key3.xml'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import json
+import socket
+import threading
+import unittest
+
+import build
+from build_core import BuildError
+
+
+class TestWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.token=build.TEST_WORKER_TOKEN
+        build.TEST_WORKER_TOKEN='s3cret'
+        self.server=socket.create_server(('localhost',0))
+        self.address='localhost:{}'.format(self.server.getsockname()[1])
+        self.thread=threading.Thread(target=lambda: build.serve_test_shard(self.server.accept()[0]),daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.join(10)
+        self.server.close()
+        build.TEST_WORKER_TOKEN=self.token
+
+    def request(self,request):
+        with socket.create_connection(self.server.getsockname(),timeout=10) as conn:
+            conn.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            return json.loads(conn.makefile('r',encoding='utf-8').readline())
+
+    def test_a_client_without_the_token_is_refused(self):
+        reply=self.request({'token':'guess','proj':'TestFirst.Net.Test','config':build.CONFIG,'key':'','fixtures':['A.Test']})
+        self.assertEqual(reply['exit'],1)
+        self.assertIn('test_worker_token',reply['error'])
+        self.assertIsNone(reply['result'])
+
+    def test_only_test_projects_are_run(self):
+        reply=self.request({'token':'s3cret','proj':'../../somewhere','config':build.CONFIG,'key':'','fixtures':['A.Test']})
+        self.assertEqual(reply['exit'],1)
+        self.assertIn('not a test project',reply['error'])
+
+    def test_the_client_sends_its_token(self):
+        original=build.test_cache_key
+        build.test_cache_key=lambda proj: 'key'
+        self.addCleanup(setattr,build,'test_cache_key',original)
+        #the worker refusing the project shows it got past the token check
+        with self.assertRaises(BuildError) as raised:
+            build.RemoteTestWorker(self.address).run('Not.A.Test.Project',['A.Test'],'unused.xml')
+        self.assertIn('not a test project',raised.exception.msg)
+
+    def test_the_worker_needs_a_token_to_start(self):
+        build.TEST_WORKER_TOKEN=None
+        with self.assertRaises(BuildError):
+            build.task_test_worker()
+        #lets setUp's server go
+        build.TEST_WORKER_TOKEN='s3cret'
+        self.request({})
+
+
+if __name__ == '__main__':
+    unittest.main()
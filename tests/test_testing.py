@@ -0,0 +1,388 @@
+import os
+import tempfile
+import textwrap
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+import build
+from build_core import BuildError
+import build_testing
+
+
+NUNIT_RESULTS='''<?xml version="1.0" encoding="utf-8"?>
+<test-results name="Proj.Test.dll" total="{total}" errors="{errors}" failures="{failures}" not-run="1" inconclusive="0"
+  ignored="1" skipped="0" invalid="0">
+</test-results>
+'''
+
+
+class TestSummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.saved=dict(build.test_runs),build.TEST_SKIP
+        build.test_runs.clear()
+        build.TEST_SKIP=False
+
+    def tearDown(self):
+        build.test_runs.clear()
+        build.test_runs.update(self.saved[0])
+        build.TEST_SKIP=self.saved[1]
+        self.tmp.cleanup()
+
+    def run_of(self,proj,started,finished,total=4,errors=0,failures=0):
+        result_file=os.path.join(self.tmp.name,proj + '.xml')
+        with open(result_file,'w') as f:
+            f.write(NUNIT_RESULTS.format(total=total,errors=errors,failures=failures))
+        run=build_testing.TestRun(proj)
+        run.started,run.finished=started,finished
+        build_testing.read_test_results(run,result_file)
+        build.test_runs[proj]=run
+        return run
+
+    def test_the_counts_are_read_from_the_results(self):
+        run=self.run_of('A.Test',100.0,102.5,total=7,errors=1,failures=2)
+        self.assertEqual((run.total,run.failed,run.skipped),(7,3,1))
+        self.assertEqual(run.describe(),'FAIL A.Test : 7 tests, 3 failed, 1 skipped in 2.5s')
+
+    def test_missing_results_fail_the_run(self):
+        run=build_testing.TestRun('A.Test')
+        build_testing.read_test_results(run,os.path.join(self.tmp.name,'none.xml'))
+        self.assertFalse(run.passed())
+
+    def test_the_summary_passes_when_every_project_does(self):
+        self.run_of('A.Test',100.0,102.0)
+        self.run_of('B.Test',100.5,103.0)
+        build.test_summary(['A.Test','B.Test'])
+
+    def test_the_summary_fails_naming_the_projects_that_failed(self):
+        self.run_of('A.Test',100.0,102.0,failures=1)
+        self.run_of('B.Test',100.5,103.0)
+        self.run_of('C.Test',100.5,103.0,errors=2)
+        with self.assertRaises(BuildError) as raised:
+            build.test_summary(['A.Test','B.Test','C.Test'])
+        self.assertEqual(raised.exception.msg,'tests failed in A.Test,C.Test')
+
+
+class SourceFixturesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.paths=[]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def source(self,name,text):
+        path=os.path.join(self.tmp.name,name)
+        with open(path,'w') as f:
+            f.write(textwrap.dedent(text))
+        self.paths.append(path)
+
+    def test_fixtures_and_the_classes_inheriting_their_tests(self):
+        self.source('Base.cs','''
+            using NUnit.Framework;
+            namespace Proj.Test
+            {
+                public abstract class StoreTestBase
+                {
+                    [Test]
+                    public void Stores() { var s = "class NotAClass {"; }
+                }
+                // class NotAClassEither : StoreTestBase {
+            }
+            ''')
+        self.source('Stores.cs','''
+            namespace Proj.Test.Stores
+            {
+                public class MemoryStoreTest : StoreTestBase
+                {
+                }
+                [TestFixture]
+                public class FileStoreTest : StoreTestBase
+                {
+                    [TestCase(1)]
+                    public void Reopens(int times) { }
+                }
+                public class Helper
+                {
+                    public void Help() { }
+                }
+            }
+            namespace Proj.Test.Other
+            {
+                public class OtherTest
+                {
+                    [Test] public void Runs() { }
+                }
+            }
+            ''')
+        self.assertEqual(build_testing.source_fixtures(self.paths),
+            ['Proj.Test.Other.OtherTest','Proj.Test.Stores.FileStoreTest','Proj.Test.Stores.MemoryStoreTest'])
+
+    def test_a_generic_base_of_fixtures_is_not_one(self):
+        self.source('Generic.cs','''
+            namespace Proj.Test
+            {
+                public class ConverterTest<T> where T : class
+                {
+                    [Test] public void Converts() { }
+                }
+                public class StringConverterTest : ConverterTest<string>
+                {
+                }
+            }
+            ''')
+        self.assertEqual(build_testing.source_fixtures(self.paths),['Proj.Test.StringConverterTest'])
+
+    def test_fixtures_which_cannot_be_run_by_name_fail(self):
+        for name,text in [
+            ('Generic.cs','''
+                namespace Proj.Test
+                {
+                    [TestFixture(typeof(int))]
+                    public class ConverterTest<T>
+                    {
+                        [Test] public void Converts() { }
+                    }
+                }
+                '''),
+            ('Nested.cs','''
+                namespace Proj.Test
+                {
+                    public class Outer
+                    {
+                        public class InnerTest
+                        {
+                            [Test] public void Runs() { }
+                        }
+                    }
+                }
+                '''),
+            ('Guarded.cs','''
+                namespace Proj.Test
+                {
+                #if WINDOWS
+                    public class RegistryTest
+                    {
+                        [Test] public void Reads() { }
+                    }
+                #endif
+                }
+                ''')]:
+            with self.subTest(name):
+                self.paths=[]
+                self.source(name,text)
+                with self.assertRaises(BuildError) as raised:
+                    build_testing.source_fixtures(self.paths)
+                self.assertIn(name,raised.exception.msg)
+
+
+def coverage_module(name,visits=None,branch_visits=None,skipped=False):
+    if skipped:
+        return '<Module hash="{0}" skippedDueTo="Filter"><ModuleName>{0}</ModuleName></Module>'.format(name)
+    points=''.join('<SequencePoint vc="{}" sl="{}"/>'.format(vc,i) for i,vc in enumerate(visits))
+    branches=''.join('<BranchPoint vc="{}" sl="{}"/>'.format(vc,i) for i,vc in enumerate(branch_visits or []))
+    return ('<Module hash="{0}"><ModuleName>{0}</ModuleName><Classes><Class><Methods><Method><SequencePoints>{1}</SequencePoints>'
+        '<BranchPoints>{2}</BranchPoints></Method></Methods></Class></Classes></Module>').format(name,points,branches)
+
+
+class MergeCoverageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def coverage(self,name,*modules):
+        path=os.path.join(self.tmp.name,name)
+        with open(path,'w') as f:
+            f.write('<?xml version="1.0" encoding="utf-8"?>\n<CoverageSession><Summary/><Modules>{}</Modules></CoverageSession>'.format(''.join(modules)))
+        return path
+
+    def merged(self,*paths):
+        merged_path=os.path.join(self.tmp.name,'coverage.xml')
+        build_testing.merge_coverage(list(paths),merged_path)
+        root=ElementTree.parse(merged_path).getroot()
+        return {module.findtext('ModuleName'):([int(point.get('vc')) for point in module.iter('SequencePoint')],
+            [int(point.get('vc')) for point in module.iter('BranchPoint')]) for module in root.iter('Module')},root
+
+    def test_the_visits_of_a_module_covered_by_several_runs_are_summed(self):
+        merged,root=self.merged(
+            self.coverage('a.xml',coverage_module('Core',[1,0,2],[1,0]),coverage_module('A.Test',[3])),
+            self.coverage('b.xml',coverage_module('Core',[0,0,5],[0,4]),coverage_module('B.Test',[1])),
+            self.coverage('c.xml',coverage_module('Core',[1,1,1],[1,1])))
+        self.assertEqual(merged,{'Core':([2,1,8],[2,5]),'A.Test':([3],[]),'B.Test':([1],[])})
+        self.assertEqual(len(root.findall('Modules/Module')),3)
+
+    def test_a_module_skipped_by_a_run_keeps_the_coverage_of_the_others(self):
+        merged,root=self.merged(
+            self.coverage('a.xml',coverage_module('Core',skipped=True)),
+            self.coverage('b.xml',coverage_module('Core',[2,0])),
+            self.coverage('c.xml',coverage_module('Core',skipped=True)))
+        self.assertEqual(merged,{'Core':([2,0],[])})
+        self.assertIsNone(root.find('Modules/Module').get('skippedDueTo'))
+
+    def test_differing_copies_of_a_module_keep_the_first(self):
+        merged,root=self.merged(
+            self.coverage('a.xml',coverage_module('Core',[1,1])),
+            self.coverage('b.xml',coverage_module('Core',[1,1,1])))
+        self.assertEqual(merged,{'Core':([1,1],[])})
+
+
+def nunit_fixtures(fixtures,failed=()):
+    """NUnit 2.x results of the full named fixtures, each a namespace suite per part of its name, taking 'secs' each"""
+    def suite(kind,name,children,secs,result):
+        return '<test-suite type="{}" name="{}" executed="True" result="{}" success="{}" time="{:.3f}" asserts="1"><results>{}</results></test-suite>'.format(
+            kind,name,result,result == 'Success',secs,children)
+    def tree(names,depth):
+        out=''
+        for part in sorted({name.split('.')[depth] for name,secs in names}):
+            under=[(name,secs) for name,secs in names if name.split('.')[depth] == part]
+            result='Failure' if any(name in failed for name,secs in under) else 'Success'
+            if len(under) == 1 and len(under[0][0].split('.')) == depth + 1:
+                name,secs=under[0]
+                case='<test-case name="{}.Test" executed="True" result="{}" success="{}" time="{:.3f}" asserts="1" />'.format(
+                    name,result,result == 'Success',secs)
+                out+=suite('TestFixture',part,case,secs,result)
+            else:
+                out+=suite('Namespace',part,tree(under,depth + 1),sum(secs for name,secs in under),result)
+        return out
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<test-results name="Proj.Test.dll" total="{}" errors="0" failures="{}" not-run="0" '
+        'inconclusive="0" ignored="0" skipped="0" invalid="0">{}</test-results>').format(len(fixtures),len(failed),
+            suite('Assembly','Proj.Test.dll',tree(list(fixtures.items()),0),sum(fixtures.values()),'Failure' if failed else 'Success'))
+
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def results(self,name,fixtures,failed=()):
+        path=os.path.join(self.tmp.name,name)
+        with open(path,'w') as f:
+            f.write(nunit_fixtures(fixtures,failed))
+        return path
+
+    def test_shards_are_packed_longest_first_onto_the_least_loaded(self):
+        weights={'A':7.0,'B':5.0,'C':4.0,'D':3.0,'E':1.0}
+        self.assertEqual(build_testing.pack_shards(weights,2),[['A','D'],['B','C','E']])
+        self.assertEqual(build_testing.pack_shards(weights,3),[['A'],['B','E'],['C','D']])
+        self.assertEqual(build_testing.pack_shards({'A':1.0},3),[['A'],[],[]])
+        #equal weights spread evenly, in name order
+        self.assertEqual(build_testing.pack_shards(dict.fromkeys('FEDCBA',2.0),2),[['A','C','E'],['B','D','F']])
+
+    def test_fixture_durations_are_read_by_full_name(self):
+        path=self.results('a.xml',{'Proj.Test.Core.MatchTest':1.5,'Proj.Test.Core.ListTest':0.25,'Proj.Test.OtherTest':2.0})
+        self.assertEqual(build_testing.fixture_durations(path),
+            {'Proj.Test.Core.MatchTest':1.5,'Proj.Test.Core.ListTest':0.25,'Proj.Test.OtherTest':2.0})
+        self.assertEqual(build_testing.fixture_durations(os.path.join(self.tmp.name,'none.xml')),{})
+
+    def test_shard_results_merge_as_if_run_in_one_go(self):
+        merged_path=os.path.join(self.tmp.name,'merged.xml')
+        self.assertTrue(build_testing.merge_test_results([
+            self.results('a.xml',{'Proj.Test.Core.MatchTest':1.5,'Proj.Test.OtherTest':2.0}),
+            os.path.join(self.tmp.name,'missing.xml'),
+            self.results('b.xml',{'Proj.Test.Core.ListTest':0.25},failed=['Proj.Test.Core.ListTest'])],merged_path))
+        self.assertEqual(build_testing.fixture_durations(merged_path),
+            {'Proj.Test.Core.MatchTest':1.5,'Proj.Test.Core.ListTest':0.25,'Proj.Test.OtherTest':2.0})
+        root=ElementTree.parse(merged_path).getroot()
+        self.assertEqual((root.get('total'),root.get('failures')),('3','1'))
+        #the one assembly suite, with a namespace suite per name, failed if any under it did
+        assembly=root.findall('test-suite')
+        self.assertEqual(len(assembly),1)
+        core=assembly[0].find("results/test-suite[@name='Proj']/results/test-suite[@name='Test']/results/test-suite[@name='Core']")
+        self.assertEqual((core.get('result'),core.get('success'),core.get('time')),('Failure','False','1.750'))
+        self.assertEqual(assembly[0].get('result'),'Failure')
+        run=build_testing.TestRun('Proj.Test')
+        build_testing.read_test_results(run,merged_path)
+        self.assertEqual((run.total,run.failed),(3,1))
+
+    def test_no_shard_results_is_nothing_merged(self):
+        merged_path=os.path.join(self.tmp.name,'merged.xml')
+        self.assertFalse(build_testing.merge_test_results([os.path.join(self.tmp.name,'missing.xml')],merged_path))
+        self.assertFalse(os.path.exists(merged_path))
+
+
+class ShardedRunTest(unittest.TestCase):
+    """Runs a project's fixtures on fake workers, one of which can't be reached"""
+
+    FIXTURES={'Proj.Test.A':4.0,'Proj.Test.B':3.0,'Proj.Test.C':2.0,'Proj.Test.D':1.0,'Proj.Test.E':1.0,'Proj.Test.F':0.5}
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.saved={name:getattr(build,name) for name in ('BUILD_CACHE_DIR','TEST_RESULTS_DIR','TEST_BATCH_SECS','test_workers','test_fixtures')}
+        build.BUILD_CACHE_DIR=os.path.join(self.tmp.name,'cache')
+        build.TEST_RESULTS_DIR=os.path.join(self.tmp.name,'results')
+        build.TEST_BATCH_SECS=3
+        build.test_fixtures=lambda proj: sorted(self.FIXTURES)
+        self.ran=[]
+        self.down=set()
+        test=self
+
+        class FakeWorker:
+            def __init__(self,name):
+                self.name=name
+
+            def run(self,proj,fixtures,result_file):
+                if self.name in test.down:
+                    return False
+                test.ran.append((self.name,fixtures))
+                with open(result_file,'w') as f:
+                    f.write(nunit_fixtures({fixture:test.FIXTURES[fixture] for fixture in fixtures}))
+                return True
+        self.workers=[FakeWorker('w1'),FakeWorker('w2')]
+        build.test_workers=lambda: self.workers
+
+    def tearDown(self):
+        for name,value in self.saved.items():
+            setattr(build,name,value)
+        self.tmp.cleanup()
+
+    def run_tests(self):
+        run=build_testing.TestRun('Proj.Test')
+        result_file=os.path.join(self.tmp.name,'Proj.Test.xml')
+        ran=build.run_sharded_tests('Proj.Test',run,result_file)
+        if ran:
+            build_testing.read_test_results(run,result_file)
+        return ran,run,result_file
+
+    def test_without_durations_the_tests_are_run_in_one_go(self):
+        self.assertFalse(self.run_tests()[0])
+        self.assertEqual(self.ran,[])
+
+    def test_each_fixture_is_run_once_in_batches(self):
+        build.save_cache('test-durations',{'Proj.Test':{name:secs for name,secs in self.FIXTURES.items() if name != 'Proj.Test.F'}})
+        ran,run,result_file=self.run_tests()
+        self.assertTrue(ran)
+        self.assertEqual(sorted(fixture for worker,fixtures in self.ran for fixture in fixtures),sorted(self.FIXTURES))
+        #batches of up to 3s, but a longer fixture on its own
+        self.assertIn(('w1',['Proj.Test.A']),self.ran)
+        self.assertTrue(all(len(fixtures) == 1 or sum(self.FIXTURES[fixture] for fixture in fixtures) <= 3 for worker,fixtures in self.ran))
+        self.assertEqual((run.total,run.failed,run.error),(6,0,None))
+        self.assertEqual(sorted(build_testing.fixture_durations(result_file)),sorted(self.FIXTURES))
+
+    def test_the_shard_of_a_worker_which_cannot_be_reached_is_taken_over(self):
+        build.save_cache('test-durations',{'Proj.Test':self.FIXTURES})
+        self.down.add('w2')
+        ran,run,result_file=self.run_tests()
+        self.assertTrue(ran)
+        self.assertEqual({worker for worker,fixtures in self.ran},{'w1'})
+        self.assertEqual(sorted(fixture for worker,fixtures in self.ran for fixture in fixtures),sorted(self.FIXTURES))
+        self.assertTrue(run.passed())
+
+    def test_fixtures_left_when_no_worker_can_be_reached_fail_the_run(self):
+        build.save_cache('test-durations',{'Proj.Test':self.FIXTURES})
+        self.down.update(['w1','w2'])
+        ran,run,result_file=self.run_tests()
+        self.assertTrue(ran)
+        self.assertFalse(run.passed())
+        self.assertIn('no test workers left to run 6 fixtures',run.error)
+
+
+if __name__ == '__main__':
+    unittest.main()
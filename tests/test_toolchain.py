@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+
+import build
+
+
+class ToolchainManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.saved={name:getattr(build,name) for name in build.TOOLCHAIN_VARS + ['BUILD_CACHE_DIR','TOOLCHAIN_REFRESH','NUNIT_VERSION','tool_version']}
+        self.saved_versions=dict(build.toolchain_versions)
+        build.BUILD_CACHE_DIR=os.path.join(self.tmp.name,'.build-cache')
+        build.TOOLCHAIN_REFRESH=False
+        self.probed=[]
+        def tool_version(exe,args):
+            self.probed.append(os.path.basename(exe))
+            return '4.2'
+        build.tool_version=tool_version
+        build.probed_versions.clear()
+        for name in build.TOOLCHAIN_VARS:
+            setattr(build,name,None)
+        build.XBUILD_EXE=self.tool('xbuild')
+        build.MONO_EXE=self.tool('mono')
+        build.NUNIT_CONSOLE_EXE=self.tool('nunit-console.exe')
+
+    def tearDown(self):
+        for name,value in self.saved.items():
+            setattr(build,name,value)
+        build.toolchain_versions.clear()
+        build.toolchain_versions.update(self.saved_versions)
+        build.probed_versions.clear()
+        self.tmp.cleanup()
+
+    def tool(self,name,text='tool'):
+        path=os.path.join(self.tmp.name,name)
+        with open(path,'w') as f:
+            f.write(text)
+        return path
+
+    def test_the_toolchain_found_is_used_until_it_changes(self):
+        build.save_toolchain_manifest()
+        self.assertEqual(sorted(self.probed),['mono','xbuild'])
+        manifest=build.load_toolchain_manifest()
+        self.assertEqual(manifest['tools']['XBUILD_EXE'],build.XBUILD_EXE)
+        self.assertEqual(manifest['versions'],{'XBUILD_EXE':'4.2','MONO_EXE':'4.2'})
+        self.tool('mono','upgraded mono')
+        self.assertIsNone(build.load_toolchain_manifest())
+
+    def test_a_tool_gone_finds_the_toolchain_again(self):
+        build.save_toolchain_manifest()
+        os.remove(build.NUNIT_CONSOLE_EXE)
+        self.assertIsNone(build.load_toolchain_manifest())
+
+    def test_other_tool_versions_or_a_refresh_find_the_toolchain_again(self):
+        build.save_toolchain_manifest()
+        build.NUNIT_VERSION='3.0.0'
+        self.assertIsNone(build.load_toolchain_manifest())
+        build.NUNIT_VERSION=self.saved['NUNIT_VERSION']
+        self.assertIsNotNone(build.load_toolchain_manifest())
+        build.TOOLCHAIN_REFRESH=True
+        self.assertIsNone(build.load_toolchain_manifest())
+
+    def test_unchanged_tools_are_not_asked_their_version_again(self):
+        build.save_toolchain_manifest()
+        build.save_toolchain_manifest()
+        self.assertEqual(sorted(self.probed),['mono','xbuild'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+import build
+from build_core import BuildError, run_concurrently
+
+
+def tool_nupkg(path,exe_name):
+    with zipfile.ZipFile(path,'w') as archive:
+        archive.writestr('[Content_Types].xml','<Types/>')
+        archive.writestr('tools/' + exe_name,'exe')
+    return path
+
+
+class ToolInstallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.saved={name:getattr(build,name) for name in ('SOLUTION_DIR','NUGET_PKG_DIR','NUGET_MIRROR','OFFLINE','MIRROR_SEED',
+            'LOCAL_REPO','download_package')}
+        build.SOLUTION_DIR=self.tmp.name
+        build.NUGET_PKG_DIR=os.path.join(self.tmp.name,'packages')
+        build.NUGET_MIRROR=os.path.join(self.tmp.name,'mirror')
+        build.LOCAL_REPO=os.path.join(self.tmp.name,'repo')
+        build.OFFLINE=False
+        os.makedirs(build.NUGET_MIRROR)
+        self.downloaded=[]
+        def download_package(pkg,version,dest,src=None):
+            self.downloaded.append(pkg)
+            os.makedirs(os.path.join(dest,'tools'))
+            with open(os.path.join(dest,'tools','downloaded.exe'),'w') as f:
+                f.write('exe')
+        build.download_package=download_package
+
+    def tearDown(self):
+        for name,value in self.saved.items():
+            setattr(build,name,value)
+        self.tmp.cleanup()
+
+    def test_tools_are_installed_from_the_mirror_at_the_same_time(self):
+        tools=[('OpenCover','4.6.166','OpenCover.Console.exe'),('ReportGenerator','2.4.4.0','ReportGenerator.exe'),
+            ('NUnit.Runners','2.6.4','nunit-console.exe')]
+        for pkg,version,exe_name in tools:
+            tool_nupkg(os.path.join(build.NUGET_MIRROR,(pkg + '.' + version).lower() + '.nupkg'),exe_name)
+        exes=run_concurrently(lambda tool: build.nuget_install_if_not_exists(*tool),tools)
+        self.assertEqual(exes,[os.path.join(build.NUGET_PKG_DIR,pkg + '.' + version,'tools',exe_name) for pkg,version,exe_name in tools])
+        self.assertTrue(all(os.path.isfile(exe) for exe in exes))
+        self.assertEqual(self.downloaded,[])
+
+    def test_tools_not_in_the_mirror_are_downloaded(self):
+        exe=build.nuget_install_if_not_exists('Some.Tool','1.0.0','downloaded.exe')
+        self.assertTrue(os.path.isfile(exe))
+        self.assertEqual(self.downloaded,['Some.Tool'])
+        #and not again once installed
+        build.nuget_install_if_not_exists('Some.Tool','1.0.0','downloaded.exe')
+        self.assertEqual(self.downloaded,['Some.Tool'])
+
+    def test_offline_only_the_mirror_is_used(self):
+        build.OFFLINE=True
+        with self.assertRaises(BuildError) as raised:
+            build.nuget_install_if_not_exists('Some.Tool','1.0.0','downloaded.exe')
+        self.assertIn('mirror-seed',raised.exception.msg)
+        self.assertEqual(self.downloaded,[])
+
+    def test_the_mirror_is_seeded_from_a_tarball(self):
+        tool_nupkg(os.path.join(build.NUGET_MIRROR,'Kept.1.0.0.nupkg'),'kept.exe')
+        build.MIRROR_SEED=os.path.join(self.tmp.name,'seed.tar.gz')
+        with tarfile.open(build.MIRROR_SEED,'w:gz') as tar:
+            for name,data in [('seed/Added.2.0.0.nupkg',b'added'),('seed/Kept.1.0.0.nupkg',b'replaced'),('seed/readme.txt',b'not a package')]:
+                info=tarfile.TarInfo(name)
+                info.size=len(data)
+                tar.addfile(info,io.BytesIO(data))
+        build.task_mirror_seed()
+        self.assertEqual(sorted(os.listdir(build.NUGET_MIRROR)),['Added.2.0.0.nupkg','Kept.1.0.0.nupkg'])
+        self.assertTrue(zipfile.is_zipfile(os.path.join(build.NUGET_MIRROR,'Kept.1.0.0.nupkg')))
+
+
+PACKAGES_CONFIG='<?xml version="1.0" encoding="utf-8"?>\n<packages>\n{}</packages>\n'
+
+
+class NugetRestoreTest(unittest.TestCase):
+    """Restores two projects' packages from a mirror, through the shared cache"""
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.root=os.path.join(self.tmp.name,'checkout')
+        self.saved={name:getattr(build,name) for name in ('SOLUTION_DIR','SOLUTION','NUGET_PKG_DIR','NUGET_CONFIG','NUGET_CACHE',
+            'NUGET_MIRROR','BUILD_CACHE_DIR','OFFLINE','RESTORE_FORCE','RESTORE_JOBS','restore_package','download_package')}
+        build.SOLUTION_DIR=self.root
+        build.SOLUTION='Test.sln'
+        build.NUGET_PKG_DIR=os.path.join(self.root,'packages')
+        build.NUGET_CONFIG=os.path.join(self.root,'NuGet.Config')
+        build.NUGET_CACHE=os.path.join(self.tmp.name,'cache')
+        build.NUGET_MIRROR=os.path.join(self.tmp.name,'mirror')
+        build.BUILD_CACHE_DIR=os.path.join(self.root,'.build-cache')
+        build.OFFLINE=True
+        build.RESTORE_FORCE=False
+        build.RESTORE_JOBS=4
+        self.forget_projects()
+        os.makedirs(build.NUGET_MIRROR)
+        for name in ('lib.1.0.0.nupkg','Tool.2.0.0.nupkg','Extra.3.0.0.nupkg'):
+            tool_nupkg(os.path.join(build.NUGET_MIRROR,name),name.partition('.')[0].lower() + '.exe')
+        sln=[]
+        for name,packages in [('App',[('Lib','1.0.0'),('Tool','2.0.0')]),('Tests',[('Lib','1.0.0')])]:
+            self.write(name + '/' + name + '.csproj','<Project />')
+            self.write_config(name,packages)
+            sln.append('Project("{{FAE04EC0-301F-11D3-BF4B-00C04F79EFBC}}") = "{0}", "{0}\\{0}.csproj", "{{0}}"\nEndProject'.format(name))
+        self.write('Test.sln','\n'.join(sln) + '\n')
+        self.restored=[]
+        restore_package=build.restore_package
+        def counted(pkg):
+            self.restored.append(pkg)
+            restore_package(pkg)
+        build.restore_package=counted
+
+    def tearDown(self):
+        for name,value in self.saved.items():
+            setattr(build,name,value)
+        self.forget_projects()
+        self.tmp.cleanup()
+
+    def forget_projects(self):
+        build.solution_projects.clear()
+        build.solution_stamps.clear()
+
+    def write(self,rel,text):
+        path=os.path.join(self.root,build.os_path(rel))
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'w') as f:
+            f.write(text)
+
+    def write_config(self,proj,packages):
+        self.write(proj + '/packages.config',PACKAGES_CONFIG.format(''.join(
+            '  <package id="{}" version="{}" />\n'.format(pkg,version) for pkg,version in packages)))
+
+    def restore(self):
+        self.restored=[]
+        build.task_nuget_restore()
+        return sorted(self.restored)
+
+    def test_packages_are_restored_once_hardlinked_from_the_cache(self):
+        self.assertEqual(self.restore(),[('Lib','1.0.0'),('Tool','2.0.0')])
+        #named as in packages.config, whatever the mirror's case
+        nupkg=os.path.join(build.NUGET_PKG_DIR,'Lib.1.0.0','Lib.1.0.0.nupkg')
+        self.assertTrue(os.path.samefile(nupkg,os.path.join(build.NUGET_CACHE,'Lib.1.0.0','Lib.1.0.0.nupkg')))
+        self.assertTrue(os.path.isfile(os.path.join(build.NUGET_PKG_DIR,'Tool.2.0.0','tools','tool.exe')))
+        self.assertEqual(self.restore(),[])
+
+    def test_a_changed_packages_config_or_missing_package_is_restored(self):
+        self.restore()
+        self.write_config('Tests',[('Lib','1.0.0'),('Extra','3.0.0')])
+        self.assertEqual(self.restore(),[('Extra','3.0.0')])
+        os.remove(os.path.join(build.NUGET_PKG_DIR,'Tool.2.0.0','Tool.2.0.0.nupkg'))
+        self.assertEqual(self.restore(),[('Tool','2.0.0')])
+        build.RESTORE_FORCE=True
+        self.assertEqual(self.restore(),[('Extra','3.0.0'),('Lib','1.0.0'),('Tool','2.0.0')])
+
+    def test_another_checkout_restores_from_the_cache(self):
+        self.restore()
+        #the mirror gone, and offline, so only the cache has them
+        shutil.rmtree(build.NUGET_MIRROR)
+        shutil.rmtree(build.NUGET_PKG_DIR)
+        shutil.rmtree(build.BUILD_CACHE_DIR)
+        self.assertEqual(self.restore(),[('Lib','1.0.0'),('Tool','2.0.0')])
+        self.assertTrue(os.path.isfile(os.path.join(build.NUGET_PKG_DIR,'Lib.1.0.0','Lib.1.0.0.nupkg')))
+
+    def test_offline_a_package_in_neither_the_cache_nor_the_mirror_fails(self):
+        self.write_config('Tests',[('Missing','1.0.0')])
+        with self.assertRaises(BuildError) as raised:
+            self.restore()
+        self.assertIn('Missing.1.0.0',raised.exception.msg)
+        #and online it's downloaded
+        build.OFFLINE=False
+        downloaded=[]
+        def download_package(pkg,version,dest,src=None):
+            downloaded.append(pkg)
+            tmp_nupkg=tool_nupkg(os.path.join(self.tmp.name,pkg + '.' + version + '.nupkg'),'downloaded.exe')
+            build.extract_nupkg(tmp_nupkg,dest)
+        build.download_package=download_package
+        self.restore()
+        self.assertEqual(downloaded,['Missing'])
+        self.assertTrue(os.path.isfile(os.path.join(build.NUGET_PKG_DIR,'Missing.1.0.0','tools','downloaded.exe')))
+
+
+if __name__ == '__main__':
+    unittest.main()
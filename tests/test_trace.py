@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+import build
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved=build.tracer,build.LOG_CAPTURE,dict(build.all_tasks),dict(build.tasks_run),build.JOBS
+        build.tracer=build.Tracer()
+        build.LOG_CAPTURE=False
+        build.tasks_run.clear()
+        build.cancelled.clear()
+
+    def tearDown(self):
+        build.tracer,build.LOG_CAPTURE,all_tasks,tasks_run,build.JOBS=self.saved
+        build.all_tasks.clear()
+        build.all_tasks.update(all_tasks)
+        build.tasks_run.clear()
+        build.tasks_run.update(tasks_run)
+
+    def test_spans_nest_and_carry_their_args(self):
+        with build.tracer.span('outer','task') as args:
+            with build.tracer.span('inner','process',{'command':'x'}):
+                pass
+            args['exit_code']=0
+        inner,outer=build.tracer.spans()
+        self.assertEqual((inner['name'],inner['cat'],inner['args']),('inner','process',{'command':'x'}))
+        self.assertEqual(outer['args'],{'exit_code':0})
+        self.assertLessEqual(outer['ts'],inner['ts'])
+        self.assertGreaterEqual(outer['ts'] + outer['dur'],inner['ts'] + inner['dur'])
+
+    def test_each_thread_is_named_in_the_trace(self):
+        def work():
+            with build.tracer.span('work','task'):
+                pass
+        thread=threading.Thread(target=work,name='worker-1')
+        thread.start()
+        thread.join()
+        work()
+        names=[event for event in build.tracer.events if event['ph'] == 'M']
+        self.assertEqual([event['args']['name'] for event in names],['worker-1',threading.current_thread().name])
+        self.assertEqual(len({span['tid'] for span in build.tracer.spans()}),2)
+
+    def test_the_tasks_and_processes_run_are_traced_to_a_file(self):
+        def compile():
+            build.invoke(sys.executable,['-c','pass'])
+        compile.requires=()
+        build.all_tasks['compile']=compile
+        build.JOBS=1
+        build.run_tasks(['compile'])
+        with tempfile.TemporaryDirectory() as tmp:
+            path=os.path.join(tmp,'trace','build-trace.json')
+            build.tracer.save(path)
+            with open(path) as f:
+                trace=json.load(f)
+        spans={event['name']:event for event in trace['traceEvents'] if event['ph'] == 'X'}
+        self.assertEqual(spans['compile']['cat'],'task')
+        process=spans[os.path.basename(sys.executable)]
+        self.assertEqual(process['cat'],'process')
+        self.assertEqual(process['args']['exit_code'],0)
+        self.assertIn('-c pass',process['args']['command'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import tempfile
+import unittest
+
+import build
+
+
+class AssemblyVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp=tempfile.TemporaryDirectory()
+        self.path=os.path.join(self.tmp.name,'BuildVersionAssemblyInfo.cs')
+        with open(self.path,'w') as f:
+            f.write('// set by the build script\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_the_version_is_written_as_a_numeric_assembly_version(self):
+        build.write_assembly_version(self.path,'1.2.3-beta')
+        text=self.read()
+        for attribute in ('AssemblyVersion','AssemblyFileVersion','AssemblyInformationalVersion'):
+            self.assertIn('[assembly: {}("1.2.3.0")]'.format(attribute),text)
+
+    def test_the_same_version_leaves_the_file_alone(self):
+        #so the projects compiling it aren't rebuilt
+        build.write_assembly_version(self.path,'1.2.3')
+        os.utime(self.path,(1000,1000))
+        build.write_assembly_version(self.path,'1.2.3')
+        self.assertEqual(os.stat(self.path).st_mtime,1000)
+        build.write_assembly_version(self.path,'1.2.4')
+        self.assertNotEqual(os.stat(self.path).st_mtime,1000)
+        self.assertIn('"1.2.4"',self.read())
+
+
+if __name__ == '__main__':
+    unittest.main()